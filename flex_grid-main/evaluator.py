@@ -15,10 +15,12 @@ from ev2gym.models import ev2gym_env
 
 from ev2gym.baselines.heuristics import RoundRobin, ChargeAsLateAsPossible, ChargeAsFastAsPossible
 from ev2gym.baselines.heuristics import ChargeAsFastAsPossibleToDesiredCapacity
+from ev2gym.baselines.heuristics import EarliestDeadlineFirst, LeastLaxityFirst
 
 from ev2gym.baselines.mpc.ocmf_mpc import OCMF_V2G, OCMF_G2V
 from ev2gym.baselines.mpc.eMPC import eMPC_V2G, eMPC_G2V
 from ev2gym.baselines.mpc.V2GProfitMax import V2GProfitMaxOracle, V2GProfitMaxLoadsOracle
+from ev2gym.baselines.mpc.mpc import MPC
 
 from stable_baselines3 import PPO, A2C, DDPG, SAC, TD3
 from sb3_contrib import TQC, TRPO, ARS, RecurrentPPO
@@ -122,6 +124,8 @@ def evaluator():
         # # ARS,
         # # RecurrentPPO,
         RoundRobin,
+        EarliestDeadlineFirst,
+        LeastLaxityFirst,
         # eMPC_V2G,
         # # V2GProfitMaxLoadsOracle,
         # V2GProfitMaxOracleGB,
@@ -283,9 +287,14 @@ def evaluator():
                                             'battery_degradation_cycling': stats['battery_degradation_cycling'],
                                             'total_reward': sum(rewards),
                                             'time': time.time() - timer,
-                                            # 'time_gb': model.total_exec_time,
+                                            'time_gb': model.total_exec_time if isinstance(model, MPC) else np.nan,
                                             }, index=[counter])
 
+                    # per phase latency of the MPC controllers
+                    if isinstance(model, MPC):
+                        for key, value in model.timing_summary().items():
+                            results_i[key] = value
+
                     if counter == 1:
                         results = results_i
                     else:
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy import sparse
 import gurobipy as gp
 from gurobipy import GRB
 from gurobipy import *
@@ -71,309 +72,229 @@ class V2GProfitMaxOracleGB():
         if timelimit is not None:
             self.m.setParam('TimeLimit', timelimit)
 
+        P = self.number_of_ports_per_cs
+        N = self.n_cs
+        T = self.sim_length
+        shape = (P, N, T)
+
         # energy of EVs t timeslot t
-        energy = self.m.addVars(self.number_of_ports_per_cs,
-                                self.n_cs,
-                                self.sim_length,
+        energy = self.m.addMVar(shape,
                                 vtype=GRB.CONTINUOUS,
                                 name='energy')
-                
 
-        current_ev_dis = self.m.addVars(self.number_of_ports_per_cs,
-                                        self.n_cs,
-                                        self.sim_length,
+        current_ev_dis = self.m.addMVar(shape,
                                         vtype=GRB.CONTINUOUS,
                                         name='current_ev_dis')
-        current_ev_ch = self.m.addVars(self.number_of_ports_per_cs,
-                                       self.n_cs,
-                                       self.sim_length,
+        current_ev_ch = self.m.addMVar(shape,
                                        vtype=GRB.CONTINUOUS,
                                        name='current_ev_ch')
 
-        act_current_ev_dis = self.m.addVars(self.number_of_ports_per_cs,
-                                            self.n_cs,
-                                            self.sim_length,
+        act_current_ev_dis = self.m.addMVar(shape,
                                             vtype=GRB.CONTINUOUS,
                                             name='act_current_ev_dis')
-        act_current_ev_ch = self.m.addVars(self.number_of_ports_per_cs,
-                                           self.n_cs,
-                                           self.sim_length,
+        act_current_ev_ch = self.m.addMVar(shape,
                                            vtype=GRB.CONTINUOUS,
                                            name='act_current_ev_ch')
 
-        current_cs_ch = self.m.addVars(self.n_cs,
-                                       self.sim_length,
+        current_cs_ch = self.m.addMVar((N, T),
                                        vtype=GRB.CONTINUOUS,
                                        name='current_cs_ch')
 
-        current_cs_dis = self.m.addVars(self.n_cs,
-                                        self.sim_length,
+        current_cs_dis = self.m.addMVar((N, T),
                                         vtype=GRB.CONTINUOUS,
                                         name='current_cs_dis')
 
-        omega_ch = self.m.addVars(self.number_of_ports_per_cs,
-                                  self.n_cs,
-                                  self.sim_length,
+        omega_ch = self.m.addMVar(shape,
                                   vtype=GRB.BINARY,
                                   name='omega_ch')
-        omega_dis = self.m.addVars(self.number_of_ports_per_cs,
-                                   self.n_cs,
-                                   self.sim_length,
+        omega_dis = self.m.addMVar(shape,
                                    vtype=GRB.BINARY,
                                    name='omega_dis')
 
-        current_tr_ch = self.m.addVars(self.n_transformers,
-                                       self.sim_length,
+        current_tr_ch = self.m.addMVar((self.n_transformers, T),
                                        vtype=GRB.CONTINUOUS,
                                        name='current_tr_ch')
-        current_tr_dis = self.m.addVars(self.n_transformers,
-                                        self.sim_length,
+        current_tr_dis = self.m.addMVar((self.n_transformers, T),
                                         vtype=GRB.CONTINUOUS,
                                         name='current_tr_dis')
 
-        power_cs_ch = self.m.addVars(self.n_cs,
-                                     self.sim_length,
+        power_cs_ch = self.m.addMVar((N, T),
                                      vtype=GRB.CONTINUOUS,
                                      name='power_cs_ch')
 
-        power_cs_dis = self.m.addVars(self.n_cs,
-                                      self.sim_length,
+        power_cs_dis = self.m.addMVar((N, T),
                                       vtype=GRB.CONTINUOUS,
                                       name='power_cs_dis')
 
-        # power_error = self.m.addVars(self.sim_length,
-        #                              vtype=GRB.CONTINUOUS,
-        #                              name='power_error')
-
-        total_power = self.m.addVars(self.sim_length,
+        total_power = self.m.addMVar(T,
                                      vtype=GRB.CONTINUOUS,
                                      name='total_power')
 
-        power_tr_ch = self.m.addVars(self.n_transformers,
-                                     self.sim_length,
+        power_tr_ch = self.m.addMVar((self.n_transformers, T),
                                      vtype=GRB.CONTINUOUS,
                                      name='power_tr_ch')
 
-        power_tr_dis = self.m.addVars(self.n_transformers,
-                                      self.sim_length,
+        power_tr_dis = self.m.addMVar((self.n_transformers, T),
                                       vtype=GRB.CONTINUOUS,
                                       name='power_tr_dis')
 
-        is_exceeding_limit = self.m.addVars(self.sim_length,
-                                            vtype=GRB.BINARY,
-                                            name='is_exceeding_limit')
-        
-        user_satisfaction = self.m.addVars(self.number_of_ports_per_cs,
-                                           self.n_cs,
-                                           self.sim_length,
+        user_satisfaction = self.m.addMVar(shape,
                                            vtype=GRB.CONTINUOUS,
                                            name='user_satisfaction')
 
-        costs = self.m.addVar(vtype=GRB.CONTINUOUS,
-                              name='total_soc')
         # Constrains
+        # The constraints are built on flattened (1-D) views of the variables, which
+        # is much faster in gurobipy than on the (port, cs, t) tensors.
+        def flat(values, shape=shape):
+            return np.broadcast_to(values, shape).reshape(-1)
+
+        energy_ = energy.reshape(-1)
+        current_ev_ch_ = current_ev_ch.reshape(-1)
+        current_ev_dis_ = current_ev_dis.reshape(-1)
+        act_current_ev_ch_ = act_current_ev_ch.reshape(-1)
+        act_current_ev_dis_ = act_current_ev_dis.reshape(-1)
+        omega_ch_ = omega_ch.reshape(-1)
+        omega_dis_ = omega_dis.reshape(-1)
+        current_cs_ch_ = current_cs_ch.reshape(-1)
+        current_cs_dis_ = current_cs_dis.reshape(-1)
+        power_cs_ch_ = power_cs_ch.reshape(-1)
+        power_cs_dis_ = power_cs_dis.reshape(-1)
+        current_tr_ch_ = current_tr_ch.reshape(-1)
+        current_tr_dis_ = current_tr_dis.reshape(-1)
+        power_tr_ch_ = power_tr_ch.reshape(-1)
+        power_tr_dis_ = power_tr_dis.reshape(-1)
+
+        # sums over the charging stations of every transformer, over the transformers
+        # and over the ports of every charging station
+        tr_cs = sparse.csr_matrix((np.ones(N),
+                                   (np.asarray(cs_transformer), np.arange(N))),
+                                  shape=(self.n_transformers, N))
+        tr_sum = sparse.kron(tr_cs, sparse.eye(T), format='csr')
+        total_sum = sparse.kron(np.ones((1, self.n_transformers)), sparse.eye(T),
+                                format='csr')
+        port_sum = sparse.kron(np.ones((1, P)), sparse.eye(N * T), format='csr')
+
         # transformer current and power variables
-        for t in range(self.sim_length):
-            for i in range(self.n_transformers):
-                self.m.addConstr(current_tr_ch[i, t] == gp.quicksum(current_cs_ch[m, t]
-                                                                    for m in range(self.n_cs)
-                                                                    if cs_transformer[m] == i))
-                self.m.addConstr(current_tr_dis[i, t] == gp.quicksum(current_cs_dis[m, t]
-                                                                     for m in range(self.n_cs)
-                                                                     if cs_transformer[m] == i))
-
-                self.m.addConstr(power_tr_ch[i, t] == gp.quicksum(power_cs_ch[m, t]
-                                                                  for m in range(self.n_cs)
-                                                                  if cs_transformer[m] == i),
-                                 name=f'power_tr_ch.{i}.{t}')
-                self.m.addConstr(power_tr_dis[i, t] == gp.quicksum(power_cs_dis[m, t]
-                                                                   for m in range(self.n_cs)
-                                                                   if cs_transformer[m] == i),
-                                 name=f'power_tr_dis.{i}.{t}')
-
-            self.m.addConstr(total_power[t] == gp.quicksum(power_tr_ch[i, t] - power_tr_dis[i, t]
-                                                           for i in range(self.n_transformers)),
-                             name=f'total_power.{t}')
-
-            # M = 1e8
-            # self.m.addConstr(power_error[t] >= total_power[t] - power_setpoints[t],
-            #                  name=f'power_error_max.{t}')
-            # self.m.addConstr(power_error[t] <= (total_power[t] - power_setpoints[t])* is_exceeding_limit[t],
-            #                  name=f'power_error_min.{t}')
-            # self.m.addConstr(power_error[t] <= 0,
-            #                     name=f'power_error_min2.{t}')
-            
-            # self.m.addConstr(power_error[t] <= M * is_exceeding_limit[t],
-            #                     name=f'power_error_max.{t}')
-            # self.m.addConstr(power_error[t] >= 1-M * (1-is_exceeding_limit[t]),
-            #                     name=f'power_error_max2.{t}')
-
-            # add contraint for aggregated power limit
-            # self.m.addConstr(total_power[t] <= power_setpoints[t],
-            #                  name=f'total_power_limit_max.{t}')
-
-
-        costs = gp.quicksum(act_current_ev_ch[p, i, t] * voltages[i] * cs_ch_efficiency[i, t] * dt * charge_prices[i, t] +
-                            act_current_ev_dis[p, i, t] * voltages[i] *
-                            cs_dis_efficiency[i, t] *
-                            dt * discharge_prices[i, t]
-                            for p in range(self.number_of_ports_per_cs)
-                            for i in range(self.n_cs)
-                            for t in range(self.sim_length))
-
-        self.m.addConstrs(power_cs_ch[i, t] == (current_cs_ch[i, t] * voltages[i])
-                          for i in range(self.n_cs)
-                          for t in range(self.sim_length))
-        self.m.addConstrs(power_cs_dis[i, t] == (current_cs_dis[i, t] * voltages[i])
-                          for i in range(self.n_cs)
-                          for t in range(self.sim_length))
+        self.m.addConstr(current_tr_ch_ == tr_sum @ current_cs_ch_,
+                         name='current_tr_ch')
+        self.m.addConstr(current_tr_dis_ == tr_sum @ current_cs_dis_,
+                         name='current_tr_dis')
+
+        self.m.addConstr(power_tr_ch_ == tr_sum @ power_cs_ch_,
+                         name='power_tr_ch')
+        self.m.addConstr(power_tr_dis_ == tr_sum @ power_cs_dis_,
+                         name='power_tr_dis')
+
+        self.m.addConstr(total_power == total_sum @ power_tr_ch_ - total_sum @ power_tr_dis_,
+                         name='total_power')
+
+        costs = flat(voltages[:, None] * cs_ch_efficiency * dt * charge_prices) @ act_current_ev_ch_ + \
+            flat(voltages[:, None] * cs_dis_efficiency * dt * discharge_prices) @ act_current_ev_dis_
+
+        self.m.addConstr(power_cs_ch_ == current_cs_ch_ * flat(voltages[:, None], (N, T)),
+                         name='power_cs_ch')
+        self.m.addConstr(power_cs_dis_ == current_cs_dis_ * flat(voltages[:, None], (N, T)),
+                         name='power_cs_dis')
 
         # transformer current output constraint (circuit breaker)
-        self.m.addConstrs((current_tr_ch[i, t] - current_tr_dis[i, t] <= tra_max_amps[i, t]
-                           for i in range(self.n_transformers)
-                           for t in range(self.sim_length)), name='tr_current_limit_max')
-        self.m.addConstrs((current_tr_ch[i, t] - current_tr_dis[i, t] >= tra_min_amps[i, t]
-                           for i in range(self.n_transformers)
-                           for t in range(self.sim_length)), name='tr_current_limit_min')
+        self.m.addConstr(current_tr_ch_ - current_tr_dis_ <= tra_max_amps.reshape(-1),
+                         name='tr_current_limit_max')
+        self.m.addConstr(current_tr_ch_ - current_tr_dis_ >= tra_min_amps.reshape(-1),
+                         name='tr_current_limit_min')
 
         # charging station total current output (sum of ports) constraint
-        self.m.addConstrs((current_cs_ch[i, t] == act_current_ev_ch.sum('*', i, t)
-                           for i in range(self.n_cs)
-                           for t in range(self.sim_length)), name='cs_ch_current_output')
-        self.m.addConstrs((current_cs_dis[i, t] == act_current_ev_dis.sum('*', i, t)
-                           for i in range(self.n_cs)
-                           for t in range(self.sim_length)), name='cs_dis_current_output')
+        self.m.addConstr(current_cs_ch_ == port_sum @ act_current_ev_ch_,
+                         name='cs_ch_current_output')
+        self.m.addConstr(current_cs_dis_ == port_sum @ act_current_ev_dis_,
+                         name='cs_dis_current_output')
 
         # charging station current output constraint
-        self.m.addConstrs((-current_cs_dis[i, t] + current_cs_ch[i, t] >= port_max_discharge_current[i]
-                           for i in range(self.n_cs)
-                           for t in range(self.sim_length)), name='cs_current_dis_limit_max')
-        self.m.addConstrs((-current_cs_dis[i, t] + current_cs_ch[i, t] <= port_max_charge_current[i]
-                           for i in range(self.n_cs)
-                           for t in range(self.sim_length)), name='cs_curent_ch_limit_max')
-
-        self.m.addConstrs((act_current_ev_ch[p, i, t] == current_ev_ch[p, i, t] * omega_ch[p, i, t]
-                           for p in range(self.number_of_ports_per_cs)
-                           for i in range(self.n_cs)
-                           for t in range(self.sim_length)
-                           #    if u[p, i, t] == 1 and ev_arrival[p, i, t] == 0
-                           ), name='act_ev_current_ch')
-
-        self.m.addConstrs((act_current_ev_dis[p, i, t] == current_ev_dis[p, i, t] * omega_dis[p, i, t]
-                           for p in range(self.number_of_ports_per_cs)
-                           for i in range(self.n_cs)
-                           for t in range(self.sim_length)
-                           #    if u[p, i, t] == 1 and ev_arrival[p, i, t] == 0
-                           ), name='act_ev_current_dis')
+        self.m.addConstr(-current_cs_dis_ + current_cs_ch_ >=
+                         flat(port_max_discharge_current[:, None], (N, T)),
+                         name='cs_current_dis_limit_max')
+        self.m.addConstr(-current_cs_dis_ + current_cs_ch_ <=
+                         flat(port_max_charge_current[:, None], (N, T)),
+                         name='cs_curent_ch_limit_max')
+
+        self.m.addConstr(act_current_ev_ch_ == current_ev_ch_ * omega_ch_,
+                         name='act_ev_current_ch')
+        self.m.addConstr(act_current_ev_dis_ == current_ev_dis_ * omega_dis_,
+                         name='act_ev_current_dis')
 
         # ev current output constraint
-        self.m.addConstrs((current_ev_ch[p, i, t] >= port_min_charge_current[i]  # * omega_ch[p, i, t]
-                           for p in range(self.number_of_ports_per_cs)
-                           for i in range(self.n_cs)
-                           for t in range(self.sim_length)
-                           #    if u[p, i, t] == 1 and ev_arrival[p, i, t] == 0
-                           ), name='ev_current_ch_limit_min')
-        self.m.addConstrs((current_ev_dis[p, i, t] >= -port_min_discharge_current[i]  # * omega_dis[p, i, t]
-                           for p in range(self.number_of_ports_per_cs)
-                           for i in range(self.n_cs)
-                           for t in range(self.sim_length)
-                           #    if u[p, i, t] == 1 and ev_arrival[p, i, t] == 0
-                           ), name='ev_current_dis_limit_min')
+        self.m.addConstr(current_ev_ch_ >= flat(port_min_charge_current[None, :, None]),
+                         name='ev_current_ch_limit_min')
+        self.m.addConstr(current_ev_dis_ >= flat(-port_min_discharge_current[None, :, None]),
+                         name='ev_current_dis_limit_min')
+
+        connected = ((u == 1) & (ev_arrival == 0)).reshape(-1)
 
         # ev max charging current constraint
-        self.m.addConstrs((current_ev_ch[p, i, t] <= min(ev_max_ch_power[p, i, t]/voltages[i], port_max_charge_current[i])
-                           for p in range(self.number_of_ports_per_cs)
-                           for i in range(self.n_cs)
-                           for t in range(self.sim_length)
-                           if u[p, i, t] == 1 and ev_arrival[p, i, t] == 0
-                           ),
-                          name='ev_current_ch_limit_max')
+        max_ch_current = flat(np.minimum(ev_max_ch_power / voltages[None, :, None],
+                                         port_max_charge_current[None, :, None]))
+        self.m.addConstr(current_ev_ch_[connected] <= max_ch_current[connected],
+                         name='ev_current_ch_limit_max')
 
         # ev max discharging current constraint
-        self.m.addConstrs((current_ev_dis[p, i, t] <= min(-ev_max_dis_power[p, i, t]/voltages[i], -port_max_discharge_current[i])
-                           for p in range(self.number_of_ports_per_cs)
-                           for i in range(self.n_cs)
-                           for t in range(self.sim_length)
-                           if u[p, i, t] == 1 and ev_arrival[p, i, t] == 0
-                           ),
-                          name='ev_current_dis_limit_max')
+        max_dis_current = flat(np.minimum(-ev_max_dis_power / voltages[None, :, None],
+                                          -port_max_discharge_current[None, :, None]))
+        self.m.addConstr(current_ev_dis_[connected] <= max_dis_current[connected],
+                         name='ev_current_dis_limit_max')
 
         # ev charge power if empty port constraint
-        for t in range(self.sim_length):
-            for i in range(self.n_cs):
-                for p in range(self.number_of_ports_per_cs):
-                    if u[p, i, t] == 0 or ev_arrival[p, i, t] == 1:
-                        #     self.m.addLConstr((act_current_ev_ch[p, i, t] == 0),
-                        #                       name=f'ev_empty_port_ch.{p}.{i}.{t}')
-                        #     self.m.addLConstr((act_current_ev_dis[p, i, t] == 0),
-                        #                       name=f'ev_empty_port_dis.{p}.{i}.{t}')
-
-                        self.m.addLConstr((omega_ch[p, i, t] == 0),
-                                          name=f'omega_empty_port_ch.{p}.{i}.{t}')
-                        self.m.addLConstr((omega_dis[p, i, t] == 0),
-                                          name=f'omega_empty_port_dis.{p}.{i}.{t}')
-
-                    if u[p, i, t] == 0 and t_dep[p, i, t] == 0:
-                        self.m.addLConstr(energy[p, i, t] == 0,
-                                          name=f'ev_empty_port_energy.{p}.{i}.{t}')
-
-        # energy of EVs after charge/discharge constraint
-        for t in range(1, self.sim_length):
-            for i in range(self.n_cs):
-                for p in range(self.number_of_ports_per_cs):
-                    if ev_arrival[p, i, t] == 1:
-                        self.m.addLConstr(
-                            energy[p, i, t] == energy_at_arrival[p, i, t],
-                            name=f'ev_arrival_energy.{p}.{i}.{t}')
-
-                    if u[p, i, t-1] == 1:
-                        self.m.addConstr(energy[p, i, t] == (energy[p, i, t-1] +
-                                                             act_current_ev_ch[p, i, t] * voltages[i] * cs_ch_efficiency[i, t] * dt -
-                                                             act_current_ev_dis[p, i, t] * voltages[i] * cs_dis_efficiency[i, t] * dt),
-                                         name=f'ev_energy.{p}.{i}.{t}')
+        empty_port = ((u == 0) | (ev_arrival == 1)).reshape(-1)
+        self.m.addConstr(omega_ch_[empty_port] == 0,
+                         name='omega_empty_port_ch')
+        self.m.addConstr(omega_dis_[empty_port] == 0,
+                         name='omega_empty_port_dis')
+
+        empty_energy = ((u == 0) & (t_dep == 0)).reshape(-1)
+        self.m.addConstr(energy_[empty_energy] == 0,
+                         name='ev_empty_port_energy')
+
+        # energy of EVs after charge/discharge constraint (t >= 1)
+        arrival = np.zeros(shape, dtype=bool)
+        arrival[:, :, 1:] = ev_arrival[:, :, 1:] == 1
+        arrival = arrival.reshape(-1)
+        self.m.addConstr(energy_[arrival] == flat(energy_at_arrival)[arrival],
+                         name='ev_arrival_energy')
+
+        stay = np.zeros(shape, dtype=bool)
+        stay[:, :, 1:] = u[:, :, :-1] == 1
+        # the previous step of every entry of stay (t is the last axis)
+        previous = np.roll(stay, -1, axis=2).reshape(-1)
+        stay = stay.reshape(-1)
+        energy_ch = flat(voltages[:, None] * cs_ch_efficiency * dt)[stay]
+        energy_dis = flat(voltages[:, None] * cs_dis_efficiency * dt)[stay]
+        self.m.addConstr(energy_[stay] == energy_[previous] +
+                         act_current_ev_ch_[stay] * energy_ch -
+                         act_current_ev_dis_[stay] * energy_dis,
+                         name='ev_energy')
 
         # energy level of EVs constraint
-        self.m.addConstrs((energy[p, i, t] >= 0
-                           for p in range(self.number_of_ports_per_cs)
-                           for i in range(self.n_cs)
-                           for t in range(self.sim_length)), name='ev_energy_level_min')
-        self.m.addConstrs((energy[p, i, t] <= ev_max_energy[p, i, t]
-                           for p in range(self.number_of_ports_per_cs)
-                           for i in range(self.n_cs)
-                           for t in range(self.sim_length)
-                           if t_dep[p, i, t] != 1
-                           ), name='ev_energy_level_max')
+        self.m.addConstr(energy_ >= 0, name='ev_energy_level_min')
+        not_departing = (t_dep != 1).reshape(-1)
+        self.m.addConstr(energy_[not_departing] <= flat(ev_max_energy)[not_departing],
+                         name='ev_energy_level_max')
 
         # Power output of EVs constraint
-        self.m.addConstrs((omega_dis[p, i, t] * omega_ch[p, i, t] == 0
-                           for p in range(self.number_of_ports_per_cs)
-                           for i in range(self.n_cs)
-                           for t in range(self.sim_length)), name='ev_power_mode_2')
+        self.m.addConstr(omega_dis_ * omega_ch_ == 0, name='ev_power_mode_2')
 
         # time of departure of EVs
-        for t in range(self.sim_length):
-            for i in range(self.n_cs):
-                for p in range(self.number_of_ports_per_cs):
-                    if t_dep[p, i, t] == 1:
-                        
-                        
-                    #     self.m.addLConstr(energy[p, i, t] >= ev_max_energy_at_departure[p, i, t]-5,
-                    #                       name=f'ev_departure_energy.{p}.{i}.{t}')
-                        
-                        self.m.addConstr(user_satisfaction[p, i, t] == \
-                            (ev_des_energy[p, i, t] * ev_max_energy[p, i, t-1] - energy[p, i, t])**2,
-                            name=f'ev_user_satisfaction.{p}.{i}.{t}')
-                        
-                        
-
-        # self.m.setObjective(costs - 0.01*power_error.sum(),
-        #                     GRB.MAXIMIZE)
+        departure = (t_dep == 1).reshape(-1)
+        if departure.any():
+            # desired energy w.r.t. the battery capacity of the previous step
+            energy_error = flat(ev_des_energy * np.roll(ev_max_energy, 1, axis=2))[departure] - \
+                energy_[departure]
+            self.m.addConstr(user_satisfaction.reshape(-1)[departure] ==
+                             energy_error * energy_error,
+                             name='ev_user_satisfaction')
 
         self.m.setObjective(costs - 100 * user_satisfaction.sum(),
                             GRB.MAXIMIZE)
 
         # print constraints
-        self.m.write("model.lp")
+        # self.m.write("model.lp")
         print(f'Optimizing...')
         self.m.params.NonConvex = 2
 
@@ -395,18 +316,16 @@ class V2GProfitMaxOracleGB():
         This function returns the actions of the EVs in the simulation normalized to [-1, 1]
         '''
 
-        self.actions = np.zeros([self.number_of_ports_per_cs,
-                                 self.n_cs, self.sim_length])
-
-        for t in range(self.sim_length):
-            for i in range(self.n_cs):
-                for p in range(self.number_of_ports_per_cs):
-                    if self.act_current_ev_ch[p, i, t].x > 0:
-                        self.actions[p, i, t] = self.act_current_ev_ch[p, i, t].x  \
-                            / self.port_max_charge_current[i]
-                    elif self.act_current_ev_dis[p, i, t].x > 0:
-                        self.actions[p, i, t] = self.act_current_ev_dis[p, i, t].x \
-                            / self.port_max_discharge_current[i]
+        # read the whole (port, cs, t) solution tensors at once
+        act_current_ev_ch = self.act_current_ev_ch.X
+        act_current_ev_dis = self.act_current_ev_dis.X
+
+        self.actions = np.where(
+            act_current_ev_ch > 0,
+            act_current_ev_ch / self.port_max_charge_current[None, :, None],
+            np.where(act_current_ev_dis > 0,
+                     act_current_ev_dis / self.port_max_discharge_current[None, :, None],
+                     0))
 
         return self.actions
 
@@ -1,9 +1,117 @@
 # this class contains heurisyic algorithms for the power setpoint tracking problem
 import math
+import heapq
 import numpy as np
+from collections import deque
 from typing import List
 
 
+class RoundRobinQueue():
+    '''
+    This is a class that contains the round robin queue of the port ids used by the Round Robin heuristics.
+    New ports join the front of the queue and served ports move to its back.
+    A removed port leaves a stale entry in the deque that is skipped later,
+    so that adding, removing and serving a port are O(1) (amortized).
+    '''
+
+    def __init__(self, n_ports):
+        # entries are (port, token), an entry is stale if the token of its port changed
+        self.queue = deque()
+        self.token = [0] * n_ports
+        # membership of every port
+        self.member = np.zeros(n_ports, dtype=bool)
+
+    def __len__(self):
+        return int(self.member.sum())
+
+    def __contains__(self, port):
+        return bool(self.member[port])
+
+    def __iter__(self):
+        token = self.token
+        for port, t in self.queue:
+            if token[port] == t:
+                yield port
+
+    def __repr__(self):
+        return str(list(self))
+
+    def update(self, active) -> np.ndarray:
+        '''
+        This function adds the active ports that are not in the queue to its front, in the same order
+        as inserting them one by one at position 0, and removes the inactive ones.
+        Returns the ids of the added ports.
+        '''
+        added = np.flatnonzero(active & ~self.member)
+        removed = np.flatnonzero(~active & self.member)
+
+        token = self.token
+        for port in removed.tolist():
+            token[port] += 1
+        for port in added.tolist():
+            token[port] += 1
+            self.queue.appendleft((port, token[port]))
+
+        self.member[removed] = False
+        self.member[added] = True
+
+        # drop the stale entries once they outnumber the valid ones
+        if len(self.queue) > 2 * len(self) + 64:
+            self.queue = deque((port, t) for port, t in self.queue
+                               if token[port] == t)
+
+        return added
+
+    def serve(self, n) -> List[int]:
+        '''
+        This function moves the first n ports of the queue to its back and returns them.
+        '''
+        served = []
+        token = self.token
+        while len(served) < n and self.queue:
+            port, t = self.queue.popleft()
+            if token[port] == t:
+                served.append(port)
+
+        self.queue.extend((port, token[port]) for port in served)
+        return served
+
+
+def get_active_ports(env) -> np.ndarray:
+    '''
+    This function returns a boolean array with the ports that have an EV connected that is not fully charged.
+    '''
+    return np.array([EV is not None and EV.get_soc() < 1
+                     for cs in env.charging_stations
+                     for EV in cs.evs_connected], dtype=bool)
+
+
+def get_port_state(env) -> dict:
+    '''
+    This function returns the port state of the environment used by the batched heuristics (get_batch_action):
+        - connected: boolean array, True if an EV is connected to the port
+        - active: boolean array, True if the EV connected to the port is not fully charged
+        - power_setpoint: the power setpoint of the current step in kW
+    '''
+    connected = np.array([EV is not None
+                          for cs in env.charging_stations
+                          for EV in cs.evs_connected], dtype=bool)
+    step = min(env.current_step, env.simulation_length - 1)
+
+    return {'connected': connected,
+            'active': connected & get_active_ports(env),
+            'power_setpoint': env.power_setpoints[step]}
+
+
+def stack_port_states(envs) -> dict:
+    '''
+    This function stacks the port states of N environments with the same number of ports,
+    every array gets a leading dimension of size N.
+    '''
+    states = [get_port_state(env) for env in envs]
+    return {key: np.stack([state[key] for state in states]) for key in states[0]}
+
+
 class RoundRobin():
     '''
     This is a class that contains the Round Robin heuristic algorithm for the power setpoint tracking problem.
@@ -24,8 +132,10 @@ class RoundRobin():
         self.average_power /= len(env.charging_stations)
 
         self.number_of_ports_per_cs = env.number_of_ports_per_cs
-        # list with the ids of EVs that were already served in this round
-        self.ev_buffer = []
+        # queue with the ids of EVs, the ones already served in this round are at the back
+        self.ev_buffer = RoundRobinQueue(env.number_of_ports)
+        # round robin order of get_batch_action
+        self.batch_rank = None
 
     def get_env(self):
         return self.env
@@ -34,22 +144,7 @@ class RoundRobin():
         '''
         This function updates the EV buffer list with the EVs that are currently parked by adding or removing them.
         '''
-        counter = 0
-        # iterate over all ports
-        for cs in env.charging_stations:
-            for port in range(cs.n_ports):
-                if cs.evs_connected[port] is not None:
-                    if cs.evs_connected[port].get_soc() < 1:
-
-                        if counter not in self.ev_buffer:
-                            self.ev_buffer.insert(0, counter)
-                    else:
-                        if counter in self.ev_buffer:
-                            self.ev_buffer.remove(counter)
-                else:
-                    if counter in self.ev_buffer:
-                        self.ev_buffer.remove(counter)
-                counter += 1
+        self.ev_buffer.update(get_active_ports(env))
 
     def get_action(self, env) -> np.ndarray:
 
@@ -72,28 +167,75 @@ class RoundRobin():
         if self.verbose:
             print(f'EV buffer: {self.ev_buffer}')
 
-        # get the EVs to charge in this round
-        evs_to_charge = self.ev_buffer[:min(
-            int(np.ceil(number_of_EVs_to_charge)), max_number_of_EVs_to_charge)]
-        self.ev_buffer = self.ev_buffer[min(
-            int(np.ceil(number_of_EVs_to_charge)), max_number_of_EVs_to_charge):]
-
-        self.ev_buffer.extend(evs_to_charge)
+        # get the EVs to charge in this round and move them to the back of the buffer
+        evs_to_charge = self.ev_buffer.serve(min(
+            int(np.ceil(number_of_EVs_to_charge)), max_number_of_EVs_to_charge))
 
         # create action list
         action_list = np.zeros(env.number_of_ports)
 
         # set the action for the EVs to charge
-        for i, ev in enumerate(evs_to_charge):
-            action_list[ev] = 1 / env.number_of_ports_per_cs
-            if i == len(evs_to_charge) - 1 and number_of_EVs_to_charge < len(evs_to_charge):
-                action_list[ev] = (number_of_EVs_to_charge - i)
+        action_list[evs_to_charge] = 1 / env.number_of_ports_per_cs
+        if len(evs_to_charge) > 0 and number_of_EVs_to_charge < len(evs_to_charge):
+            action_list[evs_to_charge[-1]] = number_of_EVs_to_charge - \
+                (len(evs_to_charge) - 1)
 
         if self.verbose:
             print(f'Evs to charge: {evs_to_charge}')
 
         return action_list
 
+    def get_batch_action(self, state) -> np.ndarray:
+        '''
+        This function returns the (N, ports) actions of N environments from their stacked port state
+        (see stack_port_states). Every environment keeps its own round robin order, which is the same as
+        the one of get_action. The order is stored as a rank per port, lower ranks are served first.
+        '''
+        active = np.atleast_2d(state['active'])
+        n_envs, n_ports = active.shape
+
+        if self.batch_rank is None or self.batch_rank.shape != active.shape:
+            self.batch_rank = np.zeros((n_envs, n_ports), dtype=np.int64)
+            self.batch_active = np.zeros((n_envs, n_ports), dtype=bool)
+            self.batch_front = np.zeros(n_envs, dtype=np.int64)
+            self.batch_back = np.zeros(n_envs, dtype=np.int64)
+
+        # new EVs join the front, the ones with higher port ids first
+        added = active & ~self.batch_active
+        order = np.cumsum(added, axis=1)
+        self.batch_rank = np.where(added, self.batch_front[:, None] - order, self.batch_rank)
+        self.batch_front -= order[:, -1]
+        self.batch_active = active.copy()
+
+        total_power = np.atleast_1d(state['power_setpoint']) * 1000  # in W
+        number_of_EVs_to_charge = total_power / self.average_power
+        n_charged = np.minimum(np.ceil(number_of_EVs_to_charge).astype(np.int64),
+                               active.sum(axis=1))
+
+        # ports sorted by their position in the round robin order
+        queue = np.argsort(np.where(active, self.batch_rank, np.iinfo(np.int64).max),
+                           axis=1, kind='stable')
+        position = np.arange(n_ports)[None, :]
+        charged = position < n_charged[:, None]
+
+        rows, columns = np.nonzero(charged)
+        ports = queue[rows, columns]
+
+        # the EVs charged in this round move to the back
+        self.batch_rank[rows, ports] = self.batch_back[rows] + columns + 1
+        self.batch_back += n_charged
+
+        action_list = np.zeros((n_envs, n_ports))
+        action_list[rows, ports] = 1 / self.number_of_ports_per_cs
+
+        # the last EV gets the remaining fraction
+        last = (n_charged > 0) & (number_of_EVs_to_charge < n_charged)
+        env_ids = np.flatnonzero(last)
+        action_list[env_ids, queue[env_ids, n_charged[env_ids] - 1]] = \
+            number_of_EVs_to_charge[env_ids] - (n_charged[env_ids] - 1)
+
+        return action_list
+
 
 class ChargeAsLateAsPossible():
     '''
@@ -161,6 +303,12 @@ class ChargeAsFastAsPossible():
         action_list = np.ones(env.number_of_ports)
         return action_list
 
+    def get_batch_action(self, state) -> np.ndarray:
+        '''
+        This function returns the (N, ports) actions of N environments from their stacked port state.
+        '''
+        return np.ones(np.atleast_2d(state['connected']).shape)
+
 class ChargeAsFastAsPossibleWithPowerLimit():
     '''
     This class contains the Charge As Fast As Possible heuristic algorithm with power limit capacity.
@@ -178,28 +326,14 @@ class ChargeAsFastAsPossibleWithPowerLimit():
         self.average_power /= len(env.charging_stations)
         print(f'Average power: {self.average_power}')
         self.power_limit = power_limit * 1000  # in W
-        self.ev_buffer = []
+        self.number_of_ports_per_cs = env.number_of_ports_per_cs
+        self.ev_buffer = RoundRobinQueue(env.number_of_ports)
         
     def update_ev_buffer(self, env) -> None:
         '''
         This function updates the EV buffer list with the EVs that are currently parked by adding or removing them.
         '''
-        counter = 0
-        # iterate over all ports
-        for cs in env.charging_stations:
-            for port in range(cs.n_ports):
-                if cs.evs_connected[port] is not None:
-                    if cs.evs_connected[port].get_soc() < 1:
-
-                        if counter not in self.ev_buffer:
-                            self.ev_buffer.insert(0, counter)
-                    else:
-                        if counter in self.ev_buffer:
-                            self.ev_buffer.remove(counter)
-                else:
-                    if counter in self.ev_buffer:
-                        self.ev_buffer.remove(counter)
-                counter += 1
+        self.ev_buffer.update(get_active_ports(env))
 
     def get_action(self, env) -> np.ndarray:
         '''
@@ -211,7 +345,7 @@ class ChargeAsFastAsPossibleWithPowerLimit():
         self.update_ev_buffer(env)
         # print(f'EV buffer: {self.ev_buffer}')
         
-        evs_to_charge = np.random.choice(self.ev_buffer, min(int(np.ceil(number_of_EVs_to_charge)), len(self.ev_buffer)), replace=False)
+        evs_to_charge = np.random.choice(list(self.ev_buffer), min(int(np.ceil(number_of_EVs_to_charge)), len(self.ev_buffer)), replace=False)
         # print(f'Evs to charge: {evs_to_charge}')
         # print(f'Number of EVs to charge: {len(evs_to_charge)}')
                 
@@ -224,6 +358,33 @@ class ChargeAsFastAsPossibleWithPowerLimit():
         # print(action_list)
         return action_list
 
+    def get_batch_action(self, state, rng=np.random) -> np.ndarray:
+        '''
+        This function returns the (N, ports) actions of N environments from their stacked port state.
+        Like get_action, it charges a random subset of the EVs that are not fully charged.
+        '''
+        active = np.atleast_2d(state['active'])
+        n_envs, n_ports = active.shape
+
+        number_of_EVs_to_charge = self.power_limit / self.average_power
+        n_charged = np.minimum(int(np.ceil(number_of_EVs_to_charge)), active.sum(axis=1))
+
+        # a random order of the active ports of every environment
+        queue = np.argsort(np.where(active, rng.random_sample((n_envs, n_ports)), np.inf),
+                           axis=1)
+        position = np.arange(n_ports)[None, :]
+        rows, columns = np.nonzero(position < n_charged[:, None])
+
+        action_list = np.zeros((n_envs, n_ports))
+        action_list[rows, queue[rows, columns]] = 1 / self.number_of_ports_per_cs
+
+        last = (n_charged > 0) & (number_of_EVs_to_charge < n_charged)
+        env_ids = np.flatnonzero(last)
+        action_list[env_ids, queue[env_ids, n_charged[env_ids] - 1]] = \
+            number_of_EVs_to_charge - (n_charged[env_ids] - 1)
+
+        return action_list
+
 class ChargeAsFastAsPossibleToDesiredCapacity():
     '''
     This class contains the Charge As Fast As Possible heuristic algorithm.
@@ -283,10 +444,13 @@ class RoundRobin_GF():
             self.max_cs_power[i] = cs.get_max_power()
 
         self.number_of_ports_per_cs = env.number_of_ports_per_cs
-        # list with the ids of EVs that were already served in this round
-        self.ev_buffer = []
-        self.min_power = []
-        self.max_power = []
+        # queue with the ids of EVs, the ones already served in this round are at the back
+        self.ev_buffer = RoundRobinQueue(env.number_of_ports)
+        # min and max power of the EV of every port, set when it joins the buffer
+        self.min_power = np.zeros(env.number_of_ports)
+        self.max_power = np.zeros(env.number_of_ports)
+        self.ports = [(cs, port) for cs in env.charging_stations
+                      for port in range(cs.n_ports)]
 
     def get_env(self):
         return self.env
@@ -295,34 +459,14 @@ class RoundRobin_GF():
         '''
         This function updates the EV buffer list with the EVs that are currently parked by adding or removing them.
         '''
-        counter = 0
-        # iterate over all ports
-        for cs in env.charging_stations:
-            for port in range(cs.n_ports):
-                if cs.evs_connected[port] is not None:
-                    if cs.evs_connected[port].get_soc() < 1:
-
-                        if counter not in self.ev_buffer:
-                            self.ev_buffer.insert(0, counter)
-                            min_power = max(cs.get_min_charge_power(), cs.evs_connected[port].min_ac_charge_power)
-                            self.min_power.insert(0, min_power)
-                            max_power = min(cs.get_max_power(), cs.evs_connected[port].max_ac_charge_power)
-                            self.max_power.insert(0, max_power)
-                    else:
-                        if counter in self.ev_buffer:
-                            # find index of the EV in the buffer
-                            index = self.ev_buffer.index(counter)
-                            self.ev_buffer.remove(counter)
-                            self.min_power.pop(index)
-                            self.max_power.pop(index)
-
-                else:
-                    if counter in self.ev_buffer:
-                        index = self.ev_buffer.index(counter)
-                        self.ev_buffer.remove(counter)
-                        self.min_power.pop(index)
-                        self.max_power.pop(index)
-                counter += 1
+        added = self.ev_buffer.update(get_active_ports(env))
+
+        for counter in added.tolist():
+            cs, port = self.ports[counter]
+            self.min_power[counter] = max(cs.get_min_charge_power(),
+                                          cs.evs_connected[port].min_ac_charge_power)
+            self.max_power[counter] = min(cs.get_max_power(),
+                                          cs.evs_connected[port].max_ac_charge_power)
 
     def get_action(self, env) -> np.ndarray:
 
@@ -340,37 +484,25 @@ class RoundRobin_GF():
         # max_number_of_EVs_to_charge = len(self.ev_buffer)
 
         if self.verbose:
-            print(f'EV buffer: {self.ev_buffer}')
-            print(f'Min power: {self.min_power}')
-            print(f'Max power: {self.max_power}')
+            evs = list(self.ev_buffer)
+            print(f'EV buffer: {evs}')
+            print(f'Min power: {self.min_power[evs]}')
+            print(f'Max power: {self.max_power[evs]}')
             
         
-        total_power_potential = sum(self.min_power)        
+        total_power_potential = self.min_power[self.ev_buffer.member].sum()
         
-        evs_to_charge = []
-        temp_ev_buffer = self.ev_buffer.copy()
         counter = 0
-        for EV in temp_ev_buffer:
-            next_power = self.max_power[temp_ev_buffer.index(EV)] - \
-                                self.min_power[temp_ev_buffer.index(EV)]
+        for EV in self.ev_buffer:
+            next_power = self.max_power[EV] - self.min_power[EV]
             
             if total_power_potential > power_setpoint:
                 break
             total_power_potential += next_power
             counter += 1
 
-        # get the EVs to charge in this round
-        evs_to_charge = self.ev_buffer[:counter]
-        min_power = self.min_power[:counter]
-        max_power = self.max_power[:counter]
-        
-        self.ev_buffer = self.ev_buffer[counter:]
-        self.min_power = self.min_power[counter:]
-        self.max_power = self.max_power[counter:]
-        
-        self.ev_buffer.extend(evs_to_charge)
-        self.min_power.extend(min_power)
-        self.max_power.extend(max_power)
+        # get the EVs to charge in this round and move them to the back of the buffer
+        evs_to_charge = self.ev_buffer.serve(counter)
 
         # create action list
         
@@ -380,14 +512,10 @@ class RoundRobin_GF():
         action_list = np.ones(env.number_of_ports) * self.min_action
 
         # set the action for the EVs to charge
-        for i, ev in enumerate(evs_to_charge):            
-            
-            if i == len(evs_to_charge) - 1 and total_power_potential >= power_setpoint:
-                if total_power_potential - power_setpoint < 0:
-                    break
-                action_list[ev] = 1 - (total_power_potential - power_setpoint) / self.max_cs_power[ev]
-            else:
-                action_list[ev] = 1
+        action_list[evs_to_charge] = 1
+        if len(evs_to_charge) > 0 and total_power_potential >= power_setpoint:
+            ev = evs_to_charge[-1]
+            action_list[ev] = 1 - (total_power_potential - power_setpoint) / self.max_cs_power[ev]
                 
         if self.verbose:
             print(f'Evs to charge: {evs_to_charge}')      
@@ -416,10 +544,13 @@ class RoundRobin_GF_off_allowed():
             self.max_cs_power[i] = cs.get_max_power()
         
         self.number_of_ports_per_cs = env.number_of_ports_per_cs
-        # list with the ids of EVs that were already served in this round
-        self.ev_buffer = []
-        self.min_power = []
-        self.max_power = []
+        # queue with the ids of EVs, the ones already served in this round are at the back
+        self.ev_buffer = RoundRobinQueue(env.number_of_ports)
+        # min and max power of the EV of every port, set when it joins the buffer
+        self.min_power = np.zeros(env.number_of_ports)
+        self.max_power = np.zeros(env.number_of_ports)
+        self.ports = [(cs, port) for cs in env.charging_stations
+                      for port in range(cs.n_ports)]
 
     def get_env(self):
         return self.env
@@ -428,34 +559,14 @@ class RoundRobin_GF_off_allowed():
         '''
         This function updates the EV buffer list with the EVs that are currently parked by adding or removing them.
         '''
-        counter = 0
-        # iterate over all ports
-        for cs in env.charging_stations:
-            for port in range(cs.n_ports):
-                if cs.evs_connected[port] is not None:
-                    if cs.evs_connected[port].get_soc() < 1:
-
-                        if counter not in self.ev_buffer:
-                            self.ev_buffer.insert(0, counter)
-                            min_power = max(cs.get_min_charge_power(), cs.evs_connected[port].min_ac_charge_power)
-                            self.min_power.insert(0, min_power)
-                            max_power = min(cs.get_max_power(), cs.evs_connected[port].max_ac_charge_power)
-                            self.max_power.insert(0, max_power)
-                    else:
-                        if counter in self.ev_buffer:
-                            # find index of the EV in the buffer
-                            index = self.ev_buffer.index(counter)
-                            self.ev_buffer.remove(counter)
-                            self.min_power.pop(index)
-                            self.max_power.pop(index)
-
-                else:
-                    if counter in self.ev_buffer:
-                        index = self.ev_buffer.index(counter)
-                        self.ev_buffer.remove(counter)
-                        self.min_power.pop(index)
-                        self.max_power.pop(index)
-                counter += 1
+        added = self.ev_buffer.update(get_active_ports(env))
+
+        for counter in added.tolist():
+            cs, port = self.ports[counter]
+            self.min_power[counter] = max(cs.get_min_charge_power(),
+                                          cs.evs_connected[port].min_ac_charge_power)
+            self.max_power[counter] = min(cs.get_max_power(),
+                                          cs.evs_connected[port].max_ac_charge_power)
 
     def get_action(self, env) -> np.ndarray:
 
@@ -472,36 +583,25 @@ class RoundRobin_GF_off_allowed():
         # max_number_of_EVs_to_charge = len(self.ev_buffer)
 
         if self.verbose:
-            print(f'EV buffer: {self.ev_buffer}')
-            print(f'Min power: {self.min_power}')
-            print(f'Max power: {self.max_power}')
+            evs = list(self.ev_buffer)
+            print(f'EV buffer: {evs}')
+            print(f'Min power: {self.min_power[evs]}')
+            print(f'Max power: {self.max_power[evs]}')
             
         
         total_power_potential = 0
         
-        evs_to_charge = []
-        temp_ev_buffer = self.ev_buffer.copy()
         counter = 0
-        for EV in temp_ev_buffer:
-            next_power = self.max_power[temp_ev_buffer.index(EV)]
+        for EV in self.ev_buffer:
+            next_power = self.max_power[EV]
                         
             if total_power_potential > power_setpoint:
                 break
             total_power_potential += next_power
             counter += 1
 
-        # # get the EVs to charge in this round
-        evs_to_charge = self.ev_buffer[:counter]
-        min_power = self.min_power[:counter]
-        max_power = self.max_power[:counter]
-        
-        self.ev_buffer = self.ev_buffer[counter:]
-        self.min_power = self.min_power[counter:]
-        self.max_power = self.max_power[counter:]
-        
-        self.ev_buffer.extend(evs_to_charge)
-        self.min_power.extend(min_power)
-        self.max_power.extend(max_power)
+        # get the EVs to charge in this round and move them to the back of the buffer
+        evs_to_charge = self.ev_buffer.serve(counter)
 
         # create action list
         
@@ -511,14 +611,10 @@ class RoundRobin_GF_off_allowed():
         action_list = np.zeros(env.number_of_ports)
 
         # set the action for the EVs to charge
-        for i, ev in enumerate(evs_to_charge):            
-            
-            if i == len(evs_to_charge) - 1 and total_power_potential > power_setpoint:
-                if total_power_potential - power_setpoint <= 0:
-                    break
-                action_list[ev] = 1 - (total_power_potential - power_setpoint) / self.max_cs_power[ev]
-            else:
-                action_list[ev] = 1
+        action_list[evs_to_charge] = 1
+        if len(evs_to_charge) > 0 and total_power_potential > power_setpoint:
+            ev = evs_to_charge[-1]
+            action_list[ev] = 1 - (total_power_potential - power_setpoint) / self.max_cs_power[ev]
         
         if self.verbose:
             print(f'Evs to charge: {evs_to_charge}')
@@ -538,6 +634,12 @@ class DoNothing():
         action_list = np.zeros(env.number_of_ports)
         return action_list
 
+    def get_batch_action(self, state) -> np.ndarray:
+        '''
+        This function returns the (N, ports) actions of N environments from their stacked port state.
+        '''
+        return np.zeros(np.atleast_2d(state['connected']).shape)
+
 
 class RandomAgent():
 
@@ -611,4 +713,162 @@ class ChargeAsLateAsPossibleToDesiredCapacity():
         for i, ev in enumerate(ev_buffer):
             action_list[ev] = ev_action_list[i]
 
-        return action_list
\ No newline at end of file
+        return action_list
+
+
+class EarliestDeadlineFirst():
+    '''
+    This class contains the Earliest Deadline First heuristic algorithm.
+    The connected EVs are kept in a heap keyed by their priority, which is updated
+    when EVs arrive, depart or are charged, so every event costs O(log n).
+    At every step, the EVs are charged as fast as possible in priority order until
+    the power limits of their charger and transformer are reached.
+    The transformer limits are the ones known by the controller (Transformer.get_forecast_windows)
+    minus the inflexible loads and PV generation of the current step.
+    '''
+    algo_name = "Earliest Deadline First"
+
+    def __init__(self, env, verbose=False, **kwargs):
+
+        self.verbose = verbose
+        self.timescale = env.timescale
+
+        # charger and transformer of every port
+        self.port_offset = []
+        self.port_cs = []
+        for cs in env.charging_stations:
+            self.port_offset.append(len(self.port_cs))
+            self.port_cs += [cs.id] * cs.n_ports
+        self.cs_transformer = [cs.connected_transformer for cs in env.charging_stations]
+        self.cs_max_power = [cs.get_max_power() for cs in env.charging_stations]
+        self.cs_min_power = [cs.get_min_charge_power() for cs in env.charging_stations]
+
+        self.reset(env)
+
+    def reset(self, env) -> None:
+        '''
+        This function clears the heap, it is called again if the environment is reset.
+        '''
+        # entries are (priority, port, token), an entry is stale if the token of its port changed
+        self.heap = []
+        self.token = [0] * env.number_of_ports
+        # EV connected to every port that is in the heap
+        self.evs = [None] * env.number_of_ports
+        self.n_queued = 0
+        # number of env.EVs already added to the heap
+        self.n_seen = 0
+        self.current_step = env.current_step
+
+    def priority(self, port, EV, energy) -> float:
+        '''
+        This function returns the priority (lower is served first) of an EV that still needs energy (kWh).
+        '''
+        return EV.time_of_departure
+
+    def push(self, port, EV, energy) -> None:
+        heapq.heappush(self.heap, (self.priority(port, EV, energy), port, self.token[port]))
+
+    def drop(self, port) -> None:
+        self.token[port] += 1
+        self.evs[port] = None
+        self.n_queued -= 1
+
+    def update_ev_buffer(self, env) -> None:
+        '''
+        This function updates the heap with the EVs that arrived or departed in the last step.
+        '''
+        if env.current_step < self.current_step or len(env.EVs) < self.n_seen:
+            self.reset(env)
+        self.current_step = env.current_step
+
+        for EV in getattr(env, 'departing_evs', []):
+            port = self.port_offset[EV.location] + EV.id
+            if self.evs[port] is EV:
+                self.drop(port)
+
+        for EV in env.EVs[self.n_seen:]:
+            port = self.port_offset[EV.location] + EV.id
+            if env.charging_stations[EV.location].evs_connected[EV.id] is EV:
+                self.token[port] += 1
+                self.evs[port] = EV
+                self.n_queued += 1
+                self.push(port, EV, EV.desired_capacity - EV.current_capacity)
+        self.n_seen = len(env.EVs)
+
+        # drop the stale entries once they outnumber the valid ones
+        if len(self.heap) > 2 * self.n_queued + 64:
+            self.heap = [entry for entry in self.heap
+                         if self.token[entry[1]] == entry[2]]
+            heapq.heapify(self.heap)
+
+    def get_action(self, env) -> np.ndarray:
+
+        t = env.current_step
+        self.update_ev_buffer(env)
+
+        # power available for the EVs of every transformer in this step
+        tr_power = np.array([power_limits[0] - loads[0] - pv[0]
+                             for loads, pv, power_limits in
+                             (tr.get_forecast_windows(step=t, horizon=1)
+                              for tr in env.transformers)])
+        tr_power = np.maximum(tr_power, 0).tolist()
+        cs_power = list(self.cs_max_power)
+        open_transformers = sum(power > 0 for power in tr_power)
+
+        action_list = np.zeros(env.number_of_ports)
+
+        served = []
+        while self.heap and open_transformers > 0:
+            _, port, token = heapq.heappop(self.heap)
+            if token != self.token[port]:
+                continue
+
+            EV = self.evs[port]
+            cs = self.port_cs[port]
+            tr = self.cs_transformer[cs]
+
+            energy = EV.desired_capacity - EV.current_capacity
+            if energy < 0.001:
+                # the EV is charged, it is not added back to the heap
+                self.drop(port)
+                continue
+
+            power = min(energy * 60 / self.timescale,
+                        EV.max_ac_charge_power,
+                        cs_power[cs],
+                        tr_power[tr])
+
+            if power < max(self.cs_min_power[cs], EV.min_ac_charge_power):
+                power = 0
+
+            if power > 0:
+                action_list[port] = power / self.cs_max_power[cs]
+                cs_power[cs] -= power
+                tr_power[tr] -= power
+                if tr_power[tr] <= 1e-6:
+                    open_transformers -= 1
+
+            served.append((port, EV, energy - power * self.timescale / 60))
+
+        # add the served EVs back to the heap with their updated priority
+        for port, EV, energy in served:
+            self.push(port, EV, energy)
+
+        if self.verbose:
+            print(f'Evs charged: {np.flatnonzero(action_list)}')
+
+        return action_list
+
+
+class LeastLaxityFirst(EarliestDeadlineFirst):
+    '''
+    This class contains the Least Laxity First heuristic algorithm.
+    The priority of an EV is the latest step it can start charging at full power and still reach
+    its desired capacity at departure. This is its laxity plus the current step, so only
+    the EVs charged in a step change priority.
+    '''
+    algo_name = "Least Laxity First"
+
+    def priority(self, port, EV, energy) -> float:
+        max_power = min(self.cs_max_power[self.port_cs[port]], EV.max_ac_charge_power)
+        return EV.time_of_departure - max(energy, 0) / (max_power * self.timescale / 60)
@@ -5,32 +5,49 @@ Authors: Cesar Diaz-Londono, Stavros Orfanoudakis
 '''
 
 
-import gurobipy as gp
-from gurobipy import GRB
-from gurobipy import *
+import copy
 import numpy as np
 
 from ev2gym.baselines.mpc.mpc import MPC
+from ev2gym.baselines.mpc.solvers import MILP
 
 
 class V2GProfitMaxOracle(MPC):
 
     algo_name = "Optimal (Offline)"
 
-    def __init__(self, env, verbose=False, **kwargs):
+    def __init__(self, env, verbose=False, window=None, overlap=0, **kwargs):
         """
         Initialize the MPC baseline.
         Args:
             env: The environment to be used for the MPC baseline.
             horizon: The horizon of the MPC baseline.
             verbose: Whether to print debug information.
+            window: If None, the whole simulation is solved as one problem. Otherwise,
+                the simulation is solved in rolling windows of this many steps.
+            overlap: Number of steps shared by consecutive windows, only the first
+                window - overlap steps of every window are kept.
         """
-        control_horizon = env.simulation_length
-        super().__init__(env, control_horizon, verbose)
+        if window is None or window >= env.simulation_length:
+            window = None
+            control_horizon = env.simulation_length
+        else:
+            assert 0 <= overlap < window, "The overlap must be smaller than the window."
+            control_horizon = window
+
+        kwargs.setdefault('MIPGap', 0.01)
+        kwargs.setdefault('time_limit', None)
+        kwargs.setdefault('output_flag', 1)
+        super().__init__(env, control_horizon, verbose, **kwargs)
 
         self.na = self.n_ports
         self.nb = 2 * self.na
 
+        self.window = window
+        self.overlap = overlap
+        # objective value of every solved window
+        self.window_objectives = []
+
         self.actions = None
 
     def get_action(self, env):
@@ -40,172 +57,70 @@ class V2GProfitMaxOracle(MPC):
 
         t = env.current_step
 
-        if self.actions is not None:
-            return self.actions[t, :]
-
-        # update transformer limits using the exact values (not forecasts)
-        self.update_tr_power_oracle(t)
-
-        # reconstruct self.x_next using the environment
-        self.reconstruct_state(t)
-        self.calculate_XF_V2G(t)
-
-        # Station models: Amono and Bmono
-        self.v2g_station_models(t)
+        if self.actions is None:
+            self.actions = self.plan()
 
-        # Complete model calculation Gu, and inequality constraints Au and bu
-        self.calculate_InequalityConstraints(t)
-
-        # Set power limits
-        self.set_power_limits_V2G(t)
-
-        # Print information if verbose
-        if self.verbose:
-            self.print_info(t)
-
-        # Generate the min cost function
-        f = []
-
-        for i in range(self.control_horizon):
-            for j in range(self.n_ports):
-                f.append(self.T * self.ch_prices[t + i])
-                f.append(-self.T * self.disch_prices[t + i])
-
-        f = np.array(f).reshape(-1, 1)
-
-        nb = self.nb
-        n = self.n_ports
-        h = self.control_horizon
+        return self.actions[t, :]
 
-        model = gp.Model("optimization_model")
-        u = model.addVars(range(nb*h),
-                          vtype=GRB.CONTINUOUS,
-                          name="u")  # Power
-
-        # Binary for charging or discharging
-        Zbin = model.addVars(range(n*h),
-                             vtype=GRB.BINARY,
-                             name="Zbin")
-
-        # Constraints
-        model.addConstrs((gp.quicksum(self.AU[i, j] * u[j]
-                                      for j in range(nb*h))
-                          <= self.bU[i]
-                          for i in range(nb*h)), name="constr1")  # Constraint with prediction model
-
-        # Constraints for charging P
-        model.addConstrs((0 <= u[j]
-                          for j in range(0, nb*h, 2)), name="constr3a")
-
-        model.addConstrs((u[j] <= self.UB[j] * Zbin[j//2]
-                          for j in range(0, nb*h, 2)), name="constr3b")
-
-        # Constraints for discharging P
-        model.addConstrs((0 <= u[j]
-                          for j in range(1, nb*h, 2)),
-                         name="constr4a")
-
-        model.addConstrs((u[j] <= self.UB[j]*(1-Zbin[j//2])
-                          for j in range(1, nb*h, 2)),
-                         name="constr4b")
-
-        # Add the transformer constraints
-        # for tr_index in range(self.number_of_transformers):
-        #     for i in range(self.control_horizon):
-        #         model.addConstr((gp.quicksum((u[j] - u[j+1])
-        #                                      for index, j in enumerate(
-        #                                          range(i*self.nb, (i+1)*self.nb, 2))
-        #                                      if self.cs_transformers[index] == tr_index) +
-        #                          self.tr_loads[tr_index, i] +
-        #                          self.tr_pv[tr_index, i] <=
-        #                          self.tr_power_limit[tr_index, i]),
-        #                         name=f'constr5_{tr_index}_t{i}')
-
-        obj_expr = gp.LinExpr()
-        for i in range(nb*h):
-            obj_expr.addTerms(f[i], u[i])
-
-        model.setObjective(obj_expr, GRB.MINIMIZE)
-        model.params.NonConvex = 2
-        model.params.MIPGap = 0.01
-
-        # model.write('model.lp')
-        model.optimize()
-
-        if model.status != GRB.Status.OPTIMAL:
-            print(f'Objective value: {model.status}')
-            print("Optimal solution not found !!!!!")
-            exit()
-
-        a = np.zeros((self.simulation_length, nb*h))
-        # z_bin = np.zeros((n*h, 1))
+    def plan(self):
+        """
+        This function computes the actions of the whole simulation.
 
-        for step in range(self.simulation_length):
-            for i in range(2*self.n_ports):
-                a[step, i] = u[step*2*self.n_ports + i].x
+        In rolling-window mode, the windows are solved in order. Only the first
+        window - overlap steps of every window are kept. The state at the start of
+        every window comes from applying the kept actions to a copy of the environment.
+        The solver model is reused between windows because they all have the same size.
+        """
+        if self.window is None:
+            a = self.solve_window(0, self.env)
+            actions = self.normalize_actions(a)
+            self.stop_timing()
+            return actions
 
-        # build normalized actions
         actions = np.zeros((self.simulation_length, self.n_ports))
-        if self.verbose:
-            print(f'Actions:\n {a.reshape(-1,self.n_ports, 2)}')
+        stride = self.window - self.overlap
+        env = copy.deepcopy(self.env)
 
-        e = 0.001
-        for step in range(self.simulation_length):
-            for i in range(0, 2*self.n_ports, 2):
-                if a[step, i] > e and a[step, i + 1] > e:
-                    raise ValueError(f'Charging and discharging at the same time\
-                                        {i} {a[step,i]} {a[step,i+1]}')
-                elif a[step, i] > e:
-                    actions[step, i//2] = a[step, i]/self.max_ch_power[i//2]
-                elif a[step, i + 1] > e:
-                    actions[step, i//2] = -a[step, i+1] / \
-                        abs(self.max_disch_power[i//2])
+        for t in range(0, self.simulation_length, stride):
+            a = self.solve_window(t, env)
 
-        if self.verbose:
-            print(f'actions: {actions.shape} \n {actions}')
-
-        self.actions = actions
-        
-        return actions[t, :]
+            steps = min(stride, self.simulation_length - t)
+            actions[t:t + steps, :] = self.normalize_actions(a[:steps])
+            self.stop_timing()
 
+            if t + steps >= self.simulation_length:
+                break
 
-class V2GProfitMaxLoadsOracle(MPC):
-
-    algo_name = "Optimal (Offline)"
+            done = False
+            for step in range(t, t + steps):
+                _, _, done, _, _ = env.step(actions[step, :])
+                if done:
+                    break
 
-    def __init__(self, env, verbose=False, **kwargs):
-        """
-        Initialize the MPC baseline.
-        Args:
-            env: The environment to be used for the MPC baseline.
-            horizon: The horizon of the MPC baseline.
-            verbose: Whether to print debug information.
-        """
-        control_horizon = env.simulation_length
-        super().__init__(env, control_horizon, verbose)
-
-        self.na = self.n_ports
-        self.nb = 2 * self.na
+            # the environment ended early (e.g. transformer overload)
+            if done:
+                break
 
-        self.actions = None
+        return actions
 
-    def get_action(self, env):
+    def solve_window(self, t, env):
         """
-        This function computes the MPC actions for the economic problem including V2G.
+        This function solves the problem of the control horizon starting at step t.
+        The state at step t is read from env.
         """
-
-        t = env.current_step
-
-        if self.actions is not None:
-            return self.actions[t, :]
+        self.start_timing(t)
 
         # update transformer limits using the exact values (not forecasts)
         self.update_tr_power_oracle(t)
 
         # reconstruct self.x_next using the environment
-        self.reconstruct_state(t)
+        self.reconstruct_state(t, env)
         self.calculate_XF_V2G(t)
 
+        if self.window is not None:
+            self.calculate_terminal_energy(t)
+        self.lap('state')
+
         # Station models: Amono and Bmono
         self.v2g_station_models(t)
 
@@ -214,99 +129,92 @@ class V2GProfitMaxLoadsOracle(MPC):
 
         # Set power limits
         self.set_power_limits_V2G(t)
+        self.lap('matrices')
 
         # Print information if verbose
         if self.verbose:
             self.print_info(t)
 
-        # Generate the min cost function
-        f = []
+        result = self.solve_v2g(
+            lambda relaxed: self.build_problem(t, relaxed), t)
 
-        for i in range(self.control_horizon):
-            for j in range(self.n_ports):
-                f.append(self.T * self.ch_prices[t + i])
-                f.append(-self.T * self.disch_prices[t + i])
+        if result.status != "optimal":
+            print(f'Objective value: {result.status}')
+            print("Optimal solution not found !!!!!")
+            exit()
 
-        f = np.array(f).reshape(-1, 1)
+        self.window_objectives.append(result.objective)
 
-        nb = self.nb
-        n = self.n_ports
-        h = self.control_horizon
+        return result.get("u").reshape(self.control_horizon, self.nb)
 
-        model = gp.Model("optimization_model")
-        u = model.addVars(range(nb*h),
-                          vtype=GRB.CONTINUOUS,
-                          name="u")  # Power
+    def calculate_terminal_energy(self, t):
+        """
+        This function adds terminal energy constraints to the last step of the window.
 
-        # Binary for charging or discharging
-        Zbin = model.addVars(range(n*h),
-                             vtype=GRB.BINARY,
-                             name="Zbin")
+        An EV that is still connected after the window must end the window with
+        enough energy to reach its desired energy at departure when charging at
+        full power. Without this, the window would discharge it for profit.
+        EVs arriving at the last step of the window are skipped, their arrival
+        energy is only part of the prediction model from the next step.
+        """
+        end = t + self.control_horizon
+        staying = (self.arrival_times < end - 1) & (self.departure_times > end)
 
-        # Constraints
-        model.addConstrs((gp.quicksum(self.AU[i, j] * u[j]
-                                      for j in range(nb*h))
-                          <= self.bU[i]
-                          for i in range(nb*h)), name="constr1")  # Constraint with prediction model
+        for ev in np.flatnonzero(staying):
+            port = self.ev_locations[ev]
+            remaining = self.departure_times[ev] - end
+            terminal = self.Cxf[ev] - \
+                remaining * self.T * self.ch_eff * self.p_max_MT[port, end]
 
-        # Constraints for charging P
-        model.addConstrs((0 <= u[j]
-                          for j in range(0, nb*h, 2)), name="constr3a")
+            index = (self.control_horizon - 1) * self.n_ports + port
+            self.XF[index] = max(self.XF[index], terminal)
 
-        model.addConstrs((u[j] <= self.UB[j] * Zbin[j//2]
-                          for j in range(0, nb*h, 2)), name="constr3b")
+    def build_problem(self, t, relaxed=False):
+        """
+        This function builds the optimization problem of the control horizon starting at step t.
+        If relaxed, the charge/discharge binaries are left out.
+        """
+        # Generate the min cost function
+        f = np.stack((self.T * self.ch_prices[t:t + self.control_horizon],
+                      -self.T * self.disch_prices[t:t + self.control_horizon]),
+                     axis=1)
+        f = np.repeat(f[:, np.newaxis, :], self.n_ports, axis=1)
 
-        # Constraints for discharging P
-        model.addConstrs((0 <= u[j]
-                          for j in range(1, nb*h, 2)),
-                         name="constr4a")
+        nb = self.nb
+        n = self.n_ports
+        h = self.control_horizon
 
-        model.addConstrs((u[j] <= self.UB[j]*(1-Zbin[j//2])
-                          for j in range(1, nb*h, 2)),
-                         name="constr4b")
+        problem = MILP("optimization_model")
+        problem.add_variables("u", nb*h, lb=self.LB, ub=self.UB)  # Power
 
-        # Add the transformer constraints
-        for tr_index in range(self.number_of_transformers):
-            for i in range(self.control_horizon):
-                model.addConstr((gp.quicksum((u[j] - u[j+1])
-                                             for index, j in enumerate(
-                                                 range(i*self.nb, (i+1)*self.nb, 2))
-                                             if self.cs_transformers[index] == tr_index) +
-                                 self.tr_loads[tr_index, i] +
-                                 self.tr_pv[tr_index, i] <=
-                                 self.tr_power_limit[tr_index, i]),
-                                name=f'constr5_{tr_index}_t{i}')
-
-        obj_expr = gp.LinExpr()
-        for i in range(nb*h):
-            obj_expr.addTerms(f[i], u[i])
-
-        model.setObjective(obj_expr, GRB.MINIMIZE)
-        model.params.NonConvex = 2
-        model.params.MIPGap = 0.01
-
-        # model.write('model.lp')
-        model.optimize()
-
-        if model.status != GRB.Status.OPTIMAL:
-            print(f'Objective value: {model.status}')
-            print("Optimal solution not found !!!!!")
-            exit()
+        if not relaxed:
+            # Binary for charging or discharging
+            problem.add_variables("Zbin", n*h, binary=True)
 
-        a = np.zeros((self.simulation_length, nb*h))
-        # z_bin = np.zeros((n*h, 1))
+        # Constraint with prediction model
+        problem.add_constraints({"u": self.AU}, ub=self.bU)
 
-        for step in range(self.simulation_length):
-            for i in range(2*self.n_ports):
-                a[step, i] = u[step*2*self.n_ports + i].x
+        if not relaxed:
+            # Constraints for charging and discharging P
+            self.add_charge_discharge_constraints(problem)
 
-        # build normalized actions
-        actions = np.zeros((self.simulation_length, self.n_ports))
+        # Add the shared limits of the multi-port chargers
+        self.add_charger_constraints(problem)
+
+        problem.set_objective({"u": f.reshape(-1)})
+
+        return problem
+
+    def normalize_actions(self, a):
+        """
+        This function builds the normalized actions from the charging and discharging powers.
+        """
+        actions = np.zeros((len(a), self.n_ports))
         if self.verbose:
             print(f'Actions:\n {a.reshape(-1,self.n_ports, 2)}')
 
         e = 0.001
-        for step in range(self.simulation_length):
+        for step in range(len(a)):
             for i in range(0, 2*self.n_ports, 2):
                 if a[step, i] > e and a[step, i + 1] > e:
                     raise ValueError(f'Charging and discharging at the same time\
@@ -320,6 +228,22 @@ class V2GProfitMaxLoadsOracle(MPC):
         if self.verbose:
             print(f'actions: {actions.shape} \n {actions}')
 
-        self.actions = actions
-        
-        return actions[t, :]
+        return actions
+
+
+class V2GProfitMaxLoadsOracle(V2GProfitMaxOracle):
+    """
+    The V2GProfitMaxOracle with the transformer power limits (inflexible loads and PV included).
+    """
+
+    def build_problem(self, t, relaxed=False):
+        """
+        This function builds the optimization problem of the control horizon starting at step t.
+        If relaxed, the charge/discharge binaries are left out.
+        """
+        problem = super().build_problem(t, relaxed)
+
+        # Add the transformer constraints
+        self.add_transformer_constraints(problem, lower_limit=False)
+
+        return problem
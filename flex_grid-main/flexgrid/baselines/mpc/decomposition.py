@@ -0,0 +1,454 @@
+'''
+This file contains the decomposed solver used by the MPC baselines for large networks.
+
+The MPC problems only couple the ports of the same transformer (and, optionally, all
+transformers through a shared site limit). The problem is split in one subproblem per
+group of variables (transformer or cluster of transformers) that are solved concurrently
+in a process pool. Coupling constraints are handled with dual decomposition: a small master
+problem updates their prices with projected subgradient steps until the duality gap between
+the best feasible solution and the Lagrangian bound is closed. If the iterates do not
+converge, a feasible solution is recovered by splitting the coupling limits between the
+groups in proportion to the average of the iterates.
+
+Authors: Cesar Diaz-Londono, Stavros Orfanoudakis
+'''
+
+import time
+import numpy as np
+from scipy import sparse
+from concurrent.futures import ProcessPoolExecutor
+
+from ev2gym.baselines.mpc.solvers import MILP, SolverResult, get_solver
+
+
+def _solve_subproblem(solver_name, solver_kwargs, problem):
+    '''
+    Solves a subproblem in a worker process.
+    '''
+    solver = get_solver(solver_name, **dict(solver_kwargs, persistent=False))
+    result = solver.solve(problem)
+
+    return result.status, result.x, result.build_time, result.solve_time
+
+
+class DecomposedSolver():
+    '''
+    Solves a MILP with block-angular structure by splitting it in one subproblem per group.
+
+    Args:
+        solver: The backend used for the subproblems ("gurobi" or "highs").
+        n_workers: Number of worker processes, subproblems are solved sequentially
+            in the current process if n_workers <= 1.
+        max_iterations: Maximum number of master (dual update) iterations.
+        dual_step: Initial change of the coupling prices at every dual update (the steps
+            are normalized by the violation and decrease as 1/k), if None it is set from
+            the objective and the coupling coefficients.
+        tolerance: Maximum violation of the coupling constraints.
+        gap_tolerance: Maximum relative gap between the solution and the Lagrangian bound.
+        recovery_interval: Number of master iterations between two recoveries of a feasible
+            solution from the iterates. For a MILP, the iterations stop when a feasible solution
+            is known and the Lagrangian bound did not improve since the last recovery, as the
+            duality gap of the binaries usually can not be closed.
+        time_limit: Time limit (s) of a solve, the iterations stop once it is reached. It is
+            also the time limit of the subproblems.
+        solver_kwargs: Parameters of the subproblem solver backend.
+
+    The result is "optimal" only if all subproblems are solved to optimality, the solution
+    satisfies the coupling constraints and the duality gap is closed. It is "suboptimal" if a
+    solution that satisfies the coupling constraints was recovered without closing the gap
+    (the gap is kept in the gap attribute), "not_converged" if no such solution was found, or
+    the status of the failed subproblem.
+    '''
+
+    def __init__(self,
+                 solver="gurobi",
+                 n_workers=1,
+                 max_iterations=50,
+                 dual_step=None,
+                 tolerance=1e-3,
+                 gap_tolerance=1e-4,
+                 recovery_interval=10,
+                 time_limit=None,
+                 **solver_kwargs):
+
+        self.solver_name = solver
+        self.name = f'{solver}-decomposed'
+        self.n_workers = n_workers
+        self.max_iterations = max_iterations
+        self.dual_step = dual_step
+        self.tolerance = tolerance
+        self.gap_tolerance = gap_tolerance
+        self.recovery_interval = recovery_interval
+        self.time_limit = time_limit
+        solver_kwargs['time_limit'] = time_limit
+
+        if n_workers > 1:
+            # avoid oversubscribing the cores with the threads of every worker
+            solver_kwargs.setdefault('threads', 1)
+            self.pool = ProcessPoolExecutor(max_workers=n_workers)
+        else:
+            self.pool = None
+
+        self.solver_kwargs = solver_kwargs
+        self._solvers = {}
+        self.duals = None
+        self.iterations = 0  # master iterations of the last solve
+        self.gap = None  # duality gap of the last solve
+
+    def close(self):
+        '''
+        Shuts down the worker processes and releases the subproblem solvers.
+        '''
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+        for solver in self._solvers.values():
+            solver.close()
+        self._solvers = {}
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def build_subproblem(self, problem, g, cols, A_rows, row_lb, row_ub,
+                         c, lb, ub, integrality):
+        '''
+        Builds the subproblem of group g with the columns cols and the constraint rows A_rows
+        (rows of the full problem, restricted to the columns of the group).
+
+        Returns the subproblem and its columns in the order of its variables.
+        '''
+        sub = MILP(f'{problem.name}_{g}')
+
+        blocks = {}
+        for name, var in problem.variables.items():
+            block_cols = cols[(cols >= var.start) & (cols < var.stop)]
+            if len(block_cols) == 0:
+                continue
+            sub.add_variables(name, len(block_cols),
+                              lb=lb[block_cols],
+                              ub=ub[block_cols],
+                              binary=bool(integrality[block_cols].any()))
+            blocks[name] = block_cols
+
+        if A_rows.shape[0] > 0:
+            sub.add_constraints({name: A_rows[:, block_cols]
+                                 for name, block_cols in blocks.items()},
+                                lb=row_lb, ub=row_ub)
+
+        sub.set_objective({name: c[block_cols]
+                           for name, block_cols in blocks.items()})
+
+        return sub, np.concatenate(list(blocks.values()))
+
+    def split(self, problem, c, A, row_lb, row_ub, lb, ub, integrality):
+        '''
+        Splits the problem in one subproblem per group of variables.
+
+        Returns the subproblems, the columns and the local rows of every subproblem and
+        the coupling rows.
+        '''
+        assert problem.groups is not None, "The problem has no variable groups"
+        groups = np.asarray(problem.groups)
+
+        coupling = problem.coupling_rows()
+        local = np.flatnonzero(~coupling)
+        A_local = A[local]
+
+        # group of every local row, taken from its first nonzero
+        nonempty = np.diff(A_local.indptr) > 0
+        row_groups = np.full(len(local), -1)
+        row_groups[nonempty] = groups[A_local.indices[A_local.indptr[:-1][nonempty]]]
+
+        mismatch = groups[A_local.indices] != np.repeat(row_groups,
+                                                         np.diff(A_local.indptr))
+        if mismatch.any():
+            raise ValueError(
+                "A constraint links variables of different groups, add it with coupling=True")
+
+        subproblems = []
+        columns = []
+        group_rows = []
+        for g in np.unique(groups):
+            cols = np.flatnonzero(groups == g)
+            rows = local[row_groups == g]
+
+            sub, sub_cols = self.build_subproblem(problem, g, cols, A[rows],
+                                                  row_lb[rows], row_ub[rows],
+                                                  c, lb, ub, integrality)
+            subproblems.append(sub)
+            columns.append(sub_cols)
+            group_rows.append(rows)
+
+        return subproblems, columns, group_rows, np.flatnonzero(coupling)
+
+    def _solve_all(self, subproblems, key=None):
+        '''
+        Solves all subproblems, concurrently if a process pool is used. Subproblems
+        with the same key and position reuse the same persistent solver.
+        '''
+        if self.pool is None:
+            results = []
+            for g, sub in enumerate(subproblems):
+                # one persistent solver per subproblem
+                if (key, g) not in self._solvers:
+                    self._solvers[(key, g)] = get_solver(self.solver_name,
+                                                         **self.solver_kwargs)
+                result = self._solvers[(key, g)].solve(sub)
+                results.append((result.status, result.x,
+                                result.build_time, result.solve_time))
+            return results
+
+        futures = [self.pool.submit(_solve_subproblem,
+                                    self.solver_name,
+                                    self.solver_kwargs,
+                                    sub)
+                   for sub in subproblems]
+        return [future.result() for future in futures]
+
+    def coupling_violation(self, x, C, C_lb, C_ub):
+        '''
+        Returns the slacks (C_ub - C @ x, C @ x - C_lb) of the coupling constraints, zero
+        for infinite bounds, and their maximum violation.
+        '''
+        coupled = C @ x
+        slack_ub = np.where(np.isfinite(C_ub), C_ub - coupled, 0)
+        slack_lb = np.where(np.isfinite(C_lb), coupled - C_lb, 0)
+        violation = max(-slack_ub.min(initial=0), -slack_lb.min(initial=0))
+
+        return slack_ub, slack_lb, violation
+
+    def combine(self, usages, costs, C_lb, C_ub):
+        '''
+        Solves the restricted master problem over the iterates: one convex combination of
+        the iterates of every group, with minimum cost, that meets the coupling constraints.
+
+        usages[k] (n_coupling, n_groups) and costs[k] (n_groups,) are the use of the coupling
+        rows and the cost of every group at iterate k. Returns the use of the coupling rows by
+        every group in the combination, None if no combination meets the constraints.
+        '''
+        n_iterates = len(usages)
+        n_rows, n_groups = usages[0].shape
+
+        # weight of iterate k of group g at column g * n_iterates + k
+        usage = np.stack(usages, axis=2).reshape(n_rows, -1)
+        master = MILP('master')
+        master.add_variables('weights', n_groups * n_iterates, lb=0, ub=1)
+        master.add_constraints(
+            {'weights': sparse.kron(sparse.identity(n_groups), np.ones((1, n_iterates)))},
+            lb=1, ub=1)
+        master.add_constraints({'weights': sparse.csr_matrix(usage)}, lb=C_lb, ub=C_ub)
+        master.set_objective({'weights': np.stack(costs, axis=1).reshape(-1)})
+
+        result = get_solver(self.solver_name, persistent=False).solve(master)
+        if result.x is None:
+            return None
+
+        return (usage * result.x).reshape(n_rows, n_groups, n_iterates).sum(axis=2)
+
+    def repair(self, problem, usage, members, subproblems, columns, group_rows, coupling,
+               c, A, row_lb, row_ub, lb, ub, integrality):
+        '''
+        Recovers a feasible solution from the use of the coupling rows by every group, e.g.
+        of a combination of the iterates.
+
+        Every coupling row is split in one row per group, whose limits are the use of the
+        group plus an equal part of the remaining slack (or excess), and the subproblems are
+        solved again with the original costs. The solution satisfies the coupling constraints
+        by construction, None is returned if a subproblem is infeasible.
+        '''
+        C = A[coupling]
+        C_lb = row_lb[coupling]
+        C_ub = row_ub[coupling]
+
+        n_members = np.maximum(members.sum(axis=1), 1)[:, np.newaxis]
+        total = usage.sum(axis=1, keepdims=True)
+        with np.errstate(invalid='ignore'):
+            share_ub = np.where(members, usage + (C_ub[:, np.newaxis] - total) / n_members,
+                                np.inf)
+            share_lb = np.where(members, usage - (total - C_lb[:, np.newaxis]) / n_members,
+                                -np.inf)
+        share_ub[~np.isfinite(C_ub)] = np.inf
+        share_lb[~np.isfinite(C_lb)] = -np.inf
+
+        repaired = []
+        for g, (sub, cols, rows) in enumerate(zip(subproblems, columns, group_rows)):
+            shared = np.flatnonzero(members[:, g])
+            A_rows = sparse.vstack((A[rows], C[shared]), format='csr')
+            sub_repair, _ = self.build_subproblem(
+                problem, f'{g}_repair', cols, A_rows,
+                np.concatenate((row_lb[rows], share_lb[shared, g])),
+                np.concatenate((row_ub[rows], share_ub[shared, g])),
+                c, lb, ub, integrality)
+            start = sub.get_start()
+            if start is not None:
+                for name, var in sub_repair.variables.items():
+                    sub_repair.set_start(name, start[var])
+            repaired.append(sub_repair)
+
+        results = self._solve_all(repaired, key='repair')
+
+        x = np.zeros(problem.n_vars)
+        for (status, sub_x, _, _), cols in zip(results, columns):
+            if sub_x is None:
+                return None, results
+            x[cols] = sub_x
+
+        return x, results
+
+    def solve(self, problem):
+        start_time = timer = time.perf_counter()
+        c, A, row_lb, row_ub, lb, ub, integrality = problem.build()
+        subproblems, columns, group_rows, coupling = self.split(
+            problem, c, A, row_lb, row_ub, lb, ub, integrality)
+
+        start = problem.get_start()
+        if start is not None:
+            for sub, cols in zip(subproblems, columns):
+                for name, var in sub.variables.items():
+                    sub.set_start(name, start[cols[var]])
+
+        C = A[coupling]
+        C_lb = row_lb[coupling]
+        C_ub = row_ub[coupling]
+
+        if self.duals is None or len(self.duals[0]) != len(coupling):
+            self.duals = (np.zeros(len(coupling)), np.zeros(len(coupling)))
+        dual_ub, dual_lb = self.duals
+
+        dual_step = self.dual_step
+        if dual_step is None and len(coupling) > 0:
+            # price of one unit of the coupling rows
+            dual_step = max(np.abs(c).max(initial=0), 1e-9) / \
+                max(np.abs(C.data).max(initial=0), 1e-9)
+
+        build_time = time.perf_counter() - timer
+        solve_time = 0
+
+        # coupling rows of every group
+        C_groups = [C[:, cols] for cols in columns]
+        members = np.column_stack([np.diff(C_group.indptr) > 0 for C_group in C_groups]
+                                  + [np.zeros((len(coupling), 0), dtype=bool)])
+
+        x = np.zeros(problem.n_vars)
+        # use of the coupling rows and cost of every group at every iterate
+        usages = []
+        costs = []
+        weights = []
+        # best Lagrangian lower bound and best solution that meets the coupling rows
+        bound = -np.inf
+        best_x = None
+        best_objective = np.inf
+        best_statuses = None
+        # Lagrangian bound at the last primal recovery
+        recovery_bound = -np.inf
+        integer = bool(np.any(integrality))
+
+        iteration = 0
+        for iteration in range(self.max_iterations if len(coupling) else 1):
+            # the master prices of the coupling constraints enter the subproblem objectives
+            prices = C.T @ (dual_ub - dual_lb)
+            for sub, cols in zip(subproblems, columns):
+                sub.set_objective({name: c[cols[var]] + prices[cols[var]]
+                                   for name, var in sub.variables.items()})
+
+            timer = time.perf_counter()
+            results = self._solve_all(subproblems)
+            solve_time += time.perf_counter() - timer
+
+            for (status, sub_x, sub_build, _), cols in zip(results, columns):
+                build_time += sub_build
+                if sub_x is None:
+                    return SolverResult(problem, status, None, None,
+                                        build_time, solve_time)
+                x[cols] = sub_x
+            statuses = [status for status, _, _, _ in results]
+
+            if len(coupling) == 0:
+                best_x, best_objective, best_statuses = x.copy(), c @ x, statuses
+                break
+
+            usages.append(np.column_stack([C_group @ x[cols]
+                                           for C_group, cols in zip(C_groups, columns)]))
+            costs.append(np.array([c[cols] @ x[cols] for cols in columns]))
+
+            objective = c @ x
+            slack_ub, slack_lb, violation = self.coupling_violation(x, C, C_lb, C_ub)
+            # x minimizes the Lagrangian of the current prices, its value is a lower bound
+            bound = max(bound, objective - dual_ub @ slack_ub - dual_lb @ slack_lb)
+
+            if violation <= self.tolerance and objective < best_objective:
+                best_x, best_objective, best_statuses = x.copy(), objective, statuses
+
+            step = dual_step / (iteration + 1)
+            weights.append(step)
+
+            out_of_time = self.time_limit is not None and \
+                time.perf_counter() - start_time >= self.time_limit
+            recovery = (iteration + 1) % self.recovery_interval == 0 or \
+                iteration + 1 == self.max_iterations or out_of_time
+            if recovery:
+                # primal recovery: the coupling limits are split between the groups as in
+                # the best combination of the iterates, or else in their weighted average
+                timer = time.perf_counter()
+                usage = self.combine(usages, costs, C_lb, C_ub)
+                if usage is None:
+                    usage = np.average(usages, axis=0, weights=weights)
+                repaired, results = self.repair(problem, usage, members, subproblems,
+                                                columns, group_rows, coupling,
+                                                c, A, row_lb, row_ub, lb, ub, integrality)
+                solve_time += time.perf_counter() - timer
+
+                if repaired is not None:
+                    objective = c @ repaired
+                    if self.coupling_violation(repaired, C, C_lb, C_ub)[2] <= \
+                            self.tolerance and objective < best_objective:
+                        best_x, best_objective = repaired, objective
+                        best_statuses = [status for status, _, _, _ in results]
+
+            # the best solution is optimal once the duality gap (which includes the
+            # complementary slackness of the prices) is closed
+            if best_x is not None and best_objective - bound <= \
+                    self.gap_tolerance * max(1, abs(best_objective)):
+                break
+
+            if out_of_time:
+                break
+
+            # the bound of a MILP stalled and a feasible solution is known, the gap left is
+            # usually the duality gap of the binaries (an LP has no duality gap)
+            if recovery and integer:
+                if best_x is not None and bound - recovery_bound <= \
+                        self.gap_tolerance * max(1, abs(best_objective)):
+                    break
+                recovery_bound = bound
+
+            # master problem: projected subgradient step on the coupling prices,
+            # normalized so that the prices move by a diminishing amount
+            norm = np.sqrt(np.sum(np.minimum(slack_ub, 0) ** 2 +
+                                  np.minimum(slack_lb, 0) ** 2 +
+                                  (dual_ub > 0) * np.maximum(slack_ub, 0) ** 2 +
+                                  (dual_lb > 0) * np.maximum(slack_lb, 0) ** 2))
+            if norm > 0:
+                dual_ub = np.maximum(0, dual_ub - step * slack_ub / norm)
+                dual_lb = np.maximum(0, dual_lb - step * slack_lb / norm)
+
+        self.duals = (dual_ub, dual_lb)
+        self.iterations = iteration + 1
+
+        if best_x is None:
+            # no solution meets the coupling constraints
+            self.gap = None
+            return SolverResult(problem, "not_converged", None, None, build_time, solve_time)
+
+        self.gap = best_objective - bound if len(coupling) else 0.0
+        if all(status == "optimal" for status in best_statuses) and \
+                self.gap <= self.gap_tolerance * max(1, abs(best_objective)):
+            status = "optimal"
+        else:
+            status = "suboptimal"
+
+        return SolverResult(problem, status, best_x, best_objective, build_time, solve_time)
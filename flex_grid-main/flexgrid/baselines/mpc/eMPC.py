@@ -5,12 +5,10 @@ Authors: Cesar Diaz-Londono, Stavros Orfanoudakis
 '''
 
 
-import gurobipy as gp
-from gurobipy import GRB
-from gurobipy import *
 import numpy as np
 
 from ev2gym.baselines.mpc.mpc import MPC
+from ev2gym.baselines.mpc.solvers import MILP
 
 
 class eMPC_V2G(MPC):
@@ -24,7 +22,7 @@ class eMPC_V2G(MPC):
             horizon: The horizon of the MPC baseline.
             verbose: Whether to print debug information.
         """
-        super().__init__(env, control_horizon, verbose)
+        super().__init__(env, control_horizon, verbose, **kwargs)
 
         self.na = self.n_ports
         self.nb = 2 * self.na
@@ -34,12 +32,14 @@ class eMPC_V2G(MPC):
         This function computes the MPC actions for the economic problem including V2G.
         """
         t = env.current_step
+        self.start_timing(t)
         # update transformer limits
         self.update_tr_power(t)
 
         # reconstruct self.x_next using the environment
         self.reconstruct_state(t)
         self.calculate_XF_V2G(t)
+        self.lap('state')
 
         # Station models: Amono and Bmono
         self.v2g_station_models(t)
@@ -49,97 +49,22 @@ class eMPC_V2G(MPC):
 
         # Set power limits
         self.set_power_limits_V2G(t)
+        self.lap('matrices')
 
         # Print information if verbose
         if self.verbose:
             self.print_info(t)
 
-        # Generate the min cost function
-        f = []
-
-        for i in range(self.control_horizon):
-            for j in range(self.n_ports):
-                f.append(self.T * self.ch_prices[t + i])
-                f.append(-self.T * self.disch_prices[t + i])
-
-        f = np.array(f).reshape(-1)
-
-        nb = self.nb
-        n = self.n_ports
-        h = self.control_horizon
-
-        model = gp.Model("optimization_model")
-        u = model.addMVar(nb*h,
-                          vtype=GRB.CONTINUOUS,
-                          name="u")  # Power
-
-        # Binary for charging or discharging
-        Zbin = model.addMVar(n*h,
-                             vtype=GRB.BINARY,
-                             name="Zbin")
+        result = self.solve_v2g(
+            lambda relaxed: self.build_problem(t, relaxed), t)
 
-        # Constraints
-        model.addConstr((self.AU @ u)  <= self.bU, name="constr1")
-
-        # Constraints for charging P
-        model.addConstrs((0 <= u[j]
-                          for j in range(0, nb*h, 2)), name="constr3a")
-
-        model.addConstrs((u[j] <= self.UB[j] * Zbin[j//2]
-                          for j in range(0, nb*h, 2)), name="constr3b")
-
-        # Constraints for discharging P
-        model.addConstrs((0 <= u[j]
-                          for j in range(1, nb*h, 2)),
-                         name="constr4a")
-
-        model.addConstrs((u[j] <= self.UB[j]*(1-Zbin[j//2])
-                          for j in range(1, nb*h, 2)),
-                         name="constr4b")
-
-        # Add the transformer constraints
-        for tr_index in range(self.number_of_transformers):
-            for i in range(self.control_horizon):
-                model.addConstr((gp.quicksum((u[j] - u[j+1])
-                                             for index, j in enumerate(
-                                                 range(i*self.nb, (i+1)*self.nb, 2))
-                                             if self.cs_transformers[index] == tr_index) +
-                                 self.tr_loads[tr_index, i] +
-                                 self.tr_pv[tr_index, i] <=
-                                 self.tr_power_limit[tr_index, i]),
-                                name=f'constr5_{tr_index}_t{i}')
-                
-        for tr_index in range(self.number_of_transformers):
-            for i in range(self.control_horizon):
-                model.addConstr((gp.quicksum((u[j] - u[j+1])
-                                             for index, j in enumerate(
-                                                 range(i*self.nb, (i+1)*self.nb, 2))
-                                             if self.cs_transformers[index] == tr_index) +
-                                 self.tr_loads[tr_index, i] +
-                                 self.tr_pv[tr_index, i] >=
-                                 -self.tr_power_limit[tr_index, :].max()),
-                                name=f'constr5_{tr_index}_t{i}')
-
-        model.setObjective(f @ u, GRB.MINIMIZE)
-        model.setParam('OutputFlag', self.output_flag)
-        model.params.NonConvex = 2        
-        
-        if self.MIPGap is not None:
-            model.params.MIPGap = self.MIPGap
-        model.params.TimeLimit = self.time_limit        
-        model.optimize()
-        self.total_exec_time += model.Runtime
-            
-        if model.status == GRB.Status.INF_OR_UNBD or \
-                model.status == GRB.Status.INFEASIBLE:                  
-            print(f"INFEASIBLE (applying default actions) - step{t} !!!")                          
+        if result.x is None:
+            print(f"INFEASIBLE (applying default actions) - step{t} !!!")
             actions = np.ones(self.n_ports) * 0 #0.25
+            self.stop_timing()
             return actions
 
-        a = np.zeros((nb*h, 1))
-
-        for i in range(2*self.n_ports):
-            a[i] = u[i].x
+        a = result.get("u")
 
         # build normalized actions
         actions = np.zeros(self.n_ports)
@@ -160,8 +85,52 @@ class eMPC_V2G(MPC):
             print(f'actions: {actions.shape} \n {actions}')
 
         # input("Press Enter to continue...")
+        self.stop_timing()
         return actions
 
+    def build_problem(self, t, relaxed=False):
+        """
+        This function builds the optimization problem of the control horizon starting at step t.
+        If relaxed, the charge/discharge binaries are left out.
+        """
+        # Generate the min cost function
+        f = []
+
+        for i in range(self.control_horizon):
+            for j in range(self.n_ports):
+                f.append(self.T * self.ch_prices[t + i])
+                f.append(-self.T * self.disch_prices[t + i])
+
+        f = np.array(f).reshape(-1)
+
+        nb = self.nb
+        n = self.n_ports
+        h = self.control_horizon
+
+        problem = MILP("optimization_model")
+        problem.add_variables("u", nb*h, lb=self.LB, ub=self.UB)  # Power
+
+        if not relaxed:
+            # Binary for charging or discharging
+            problem.add_variables("Zbin", n*h, binary=True)
+
+        # Constraints
+        problem.add_constraints({"u": self.AU}, ub=self.bU)
+
+        if not relaxed:
+            # Constraints for charging and discharging P
+            self.add_charge_discharge_constraints(problem)
+
+        # Add the shared limits of the multi-port chargers
+        self.add_charger_constraints(problem)
+
+        # Add the transformer constraints
+        self.add_transformer_constraints(problem)
+
+        problem.set_objective({"u": f})
+
+        return problem
+
 
 class eMPC_G2V(MPC):
     '''
@@ -177,7 +146,7 @@ class eMPC_G2V(MPC):
             horizon: The horizon of the MPC baseline.
             verbose: Whether to print debug information.
         """
-        super().__init__(env, control_horizon, verbose)
+        super().__init__(env, control_horizon, verbose, **kwargs)
 
         self.na = self.n_ports
         self.nb = self.na
@@ -187,12 +156,14 @@ class eMPC_G2V(MPC):
         This function computes the MPC actions for the economic problem including G2V.
         """
         t = env.current_step
+        self.start_timing(t)
         # update transformer limits
         self.update_tr_power(t)
 
         # reconstruct self.x_next using the environment
         self.reconstruct_state(t)
         self.calculate_XF_G2V(t)
+        self.lap('state')
 
         # Station models: Amono and Bmono
         self.g2v_station_models(t)
@@ -202,6 +173,7 @@ class eMPC_G2V(MPC):
 
         # Set power limits
         self.set_power_limits_G2V(t)
+        self.lap('matrices')
 
         # Print information if verbose
         if self.verbose:
@@ -219,65 +191,32 @@ class eMPC_G2V(MPC):
         n = self.n_ports
         h = self.control_horizon
 
-        model = gp.Model("optimization_model")
-        u = model.addMVar(nb*h,
-                          vtype=GRB.CONTINUOUS,
-                          name="u")  # Power
+        problem = MILP("optimization_model")
+        # Add the lower and upper bound constraints
+        problem.add_variables("u", nb*h, lb=self.LB, ub=self.UB)  # Power
 
         # Constraints
-        model.addConstr((self.AU @ u)  <= self.bU, name="constr1")
+        problem.add_constraints({"u": self.AU}, ub=self.bU)
 
-        # Add the lower bound constraints
-        model.addConstr((0 <= u), name="constr2a")
-
-        # Add the upper bound constraints
-        model.addConstr((u <= self.UB), name="constr2b")
+        # Add the shared limits of the multi-port chargers
+        self.add_charger_constraints(problem)
 
         # Add the transformer constraints
-        for tr_index in range(self.number_of_transformers):
-            for i in range(self.control_horizon):
-                model.addConstr((gp.quicksum(u[j]
-                                             for index, j in enumerate(
-                                                 range(i*self.nb, (i+1)*self.nb))
-                                             if self.cs_transformers[index] == tr_index) +
-                                 self.tr_loads[tr_index, i] +
-                                 self.tr_pv[tr_index, i] <=
-                                 self.tr_power_limit[tr_index, i]),
-                                name=f'constr5_{tr_index}_t{i}')
-    
-        for tr_index in range(self.number_of_transformers):
-            for i in range(self.control_horizon):
-                model.addConstr((gp.quicksum(u[j]
-                                             for index, j in enumerate(
-                                                 range(i*self.nb, (i+1)*self.nb))
-                                             if self.cs_transformers[index] == tr_index) +
-                                 self.tr_loads[tr_index, i] +
-                                 self.tr_pv[tr_index, i] >=
-                                 -self.tr_power_limit[tr_index, :].max()),
-                                name=f'constr5_{tr_index}_t{i}')
-                        
-        model.setObjective(f @ u, GRB.MINIMIZE)
-        model.setParam('OutputFlag', self.output_flag)
-        model.params.NonConvex = 2
-        
-        if self.MIPGap is not None:
-            model.params.MIPGap = self.MIPGap
-        model.params.TimeLimit = self.time_limit        
-        model.optimize()
-        self.total_exec_time += model.Runtime      
-            
-        if model.status == GRB.Status.INF_OR_UNBD or \
-                model.status == GRB.Status.INFEASIBLE:                  
-            print(f"INFEASIBLE (applying default actions) - step{t} !!!")                          
+        self.add_transformer_constraints(problem)
+
+        problem.set_objective({"u": f})
+
+        result = self.solve(problem)
+
+        if result.x is None:
+            print(f"INFEASIBLE (applying default actions) - step{t} !!!")
             actions = np.ones(self.n_ports) * 0#0.25
+            self.stop_timing()
             return actions
 
-        a = np.zeros((nb*h, 1))
+        a = result.get("u")
         cap = np.zeros((nb*h, 1))
 
-        for i in range(self.n_ports):
-            a[i] = u[i].x
-
         if self.verbose:
             print(f'Actions:\n {a.reshape(-1,self.n_ports)}')
             print(f'CapF1:\n {cap.reshape(-1,self.n_ports)}')
@@ -285,9 +224,10 @@ class eMPC_G2V(MPC):
         # build normalized actions
         actions = np.zeros(self.n_ports)
         for i in range(self.n_ports):
-            actions[i] = a[i]/self.max_ch_power[i//2]
+            actions[i] = a[i]/self.max_ch_power[i]
 
         if self.verbose:
             print(f'actions: {actions.shape} \n {actions}')
         # input("Press Enter to continue...")
+        self.stop_timing()
         return actions
@@ -24,7 +24,7 @@ class eMPC_V2G_v2(MPC):
             horizon: The horizon of the MPC baseline.
             verbose: Whether to print debug information.
         """
-        super().__init__(env, control_horizon, verbose)
+        super().__init__(env, control_horizon, verbose, **kwargs)
 
         self.na = self.n_ports
         self.nb = 2 * self.na
@@ -34,6 +34,9 @@ class eMPC_V2G_v2(MPC):
         This function computes the MPC actions for the economic problem including V2G.
         """
 
+        # the latency of all tries is counted in the same step
+        self.start_timing(env.current_step)
+
         # keep looping until feasible solution is found
         while True:
 
@@ -44,6 +47,7 @@ class eMPC_V2G_v2(MPC):
             # reconstruct self.x_next using the environment
             self.reconstruct_state(t)
             self.calculate_XF_V2G(t)
+            self.lap('state')
 
             # Station models: Amono and Bmono
             self.v2g_station_models(t)
@@ -53,6 +57,7 @@ class eMPC_V2G_v2(MPC):
 
             # Set power limits
             self.set_power_limits_V2G(t)
+            self.lap('matrices')
 
             # Print information if verbose
             if self.verbose:
@@ -93,43 +98,20 @@ class eMPC_V2G_v2(MPC):
             model.addConstr((self.AU @ u) <= self.bU, name="constr1")
 
             # Constraints for charging P
-            model.addConstrs((0 <= u[j]
-                              for j in range(0, nb*h, 2)), name="constr3a")
-
-            model.addConstrs((u[j] <= self.UB[j] * Zbin[j//2]
-                              for j in range(0, nb*h, 2)), name="constr3b")
+            model.addConstr(u[0::2] <= self.UB[0::2] * Zbin, name="constr3b")
 
             # Constraints for discharging P
-            model.addConstrs((0 <= u[j]
-                              for j in range(1, nb*h, 2)),
-                             name="constr4a")
+            model.addConstr(u[1::2] <= self.UB[1::2] * (1 - Zbin), name="constr4b")
 
-            model.addConstrs((u[j] <= self.UB[j]*(1-Zbin[j//2])
-                              for j in range(1, nb*h, 2)),
-                             name="constr4b")
+            # Add the shared limits of the multi-port chargers
+            if self.multiport:
+                A_cs, ub_cs = self.charger_constraints()
+                model.addConstr(A_cs @ u <= ub_cs, name="constr6")
 
             # Add the transformer constraints
-            for tr_index in range(self.number_of_transformers):
-                for i in range(self.control_horizon):
-                    model.addConstr((gp.quicksum((u[j] - u[j+1])
-                                                 for index, j in enumerate(
-                        range(i*self.nb, (i+1)*self.nb, 2))
-                        if self.cs_transformers[index] == tr_index) +
-                        self.tr_loads[tr_index, i] +
-                        self.tr_pv[tr_index, i] <=
-                        self.tr_power_limit[tr_index, i]),
-                        name=f'constr5_{tr_index}_t{i}')
-
-            for tr_index in range(self.number_of_transformers):
-                for i in range(self.control_horizon):
-                    model.addConstr((gp.quicksum((u[j] - u[j+1])
-                                                 for index, j in enumerate(
-                        range(i*self.nb, (i+1)*self.nb, 2))
-                        if self.cs_transformers[index] == tr_index) +
-                        self.tr_loads[tr_index, i] +
-                        self.tr_pv[tr_index, i] >=
-                        -self.tr_power_limit[tr_index, :].max()),
-                        name=f'constr5_{tr_index}_t{i}')
+            A_tr, lb_tr, ub_tr = self.transformer_constraints()
+            model.addConstr(A_tr @ u <= ub_tr, name="constr5a")
+            model.addConstr(A_tr @ u >= lb_tr, name="constr5b")
 
             # # Battery degradation modelling
             # T_event = (self.departure_times - self.arrival_times) * self.T / 24
@@ -186,7 +168,9 @@ class eMPC_V2G_v2(MPC):
 
             model.params.TimeLimit = self.time_limit
 
+            self.lap('build')
             model.optimize()
+            self.lap('solve')
 
             self.total_exec_time += model.Runtime
 
@@ -231,10 +215,7 @@ class eMPC_V2G_v2(MPC):
                 continue
 
             # calculating actions
-            a = np.zeros((nb*h, 1))
-
-            for i in range(2*self.n_ports):
-                a[i] = u[i].x
+            a = u.X
 
             # build normalized actions
             actions = np.zeros(self.n_ports)
@@ -255,6 +236,7 @@ class eMPC_V2G_v2(MPC):
                 print(f'actions: {actions.shape} \n {actions}')
 
             # input("Press Enter to continue...")
+            self.stop_timing()
             return actions
 
 
@@ -272,7 +254,7 @@ class eMPC_G2V_v2(MPC):
             horizon: The horizon of the MPC baseline.
             verbose: Whether to print debug information.
         """
-        super().__init__(env, control_horizon, verbose)
+        super().__init__(env, control_horizon, verbose, **kwargs)
 
         self.na = self.n_ports
         self.nb = self.na
@@ -282,12 +264,14 @@ class eMPC_G2V_v2(MPC):
         This function computes the MPC actions for the economic problem including G2V.
         """
         t = env.current_step
+        self.start_timing(t)
         # update transformer limits
         self.update_tr_power(t)
 
         # reconstruct self.x_next using the environment
         self.reconstruct_state(t)
         self.calculate_XF_G2V(t)
+        self.lap('state')
 
         # Station models: Amono and Bmono
         self.g2v_station_models(t)
@@ -297,6 +281,7 @@ class eMPC_G2V_v2(MPC):
 
         # Set power limits
         self.set_power_limits_G2V(t)
+        self.lap('matrices')
 
         # Print information if verbose
         if self.verbose:
@@ -328,28 +313,15 @@ class eMPC_G2V_v2(MPC):
         # Add the upper bound constraints
         model.addConstr((u <= self.UB), name="constr2b")
 
+        # Add the shared limits of the multi-port chargers
+        if self.multiport:
+            A_cs, ub_cs = self.charger_constraints()
+            model.addConstr(A_cs @ u <= ub_cs, name="constr6")
+
         # Add the transformer constraints
-        for tr_index in range(self.number_of_transformers):
-            for i in range(self.control_horizon):
-                model.addConstr((gp.quicksum(u[j]
-                                             for index, j in enumerate(
-                                                 range(i*self.nb, (i+1)*self.nb))
-                                             if self.cs_transformers[index] == tr_index) +
-                                 self.tr_loads[tr_index, i] +
-                                 self.tr_pv[tr_index, i] <=
-                                 self.tr_power_limit[tr_index, i]),
-                                name=f'constr5_{tr_index}_t{i}')
-
-        for tr_index in range(self.number_of_transformers):
-            for i in range(self.control_horizon):
-                model.addConstr((gp.quicksum(u[j]
-                                             for index, j in enumerate(
-                                                 range(i*self.nb, (i+1)*self.nb))
-                                             if self.cs_transformers[index] == tr_index) +
-                                 self.tr_loads[tr_index, i] +
-                                 self.tr_pv[tr_index, i] >=
-                                 -self.tr_power_limit[tr_index, :].max()),
-                                name=f'constr5_{tr_index}_t{i}')
+        A_tr, lb_tr, ub_tr = self.transformer_constraints()
+        model.addConstr(A_tr @ u <= ub_tr, name="constr5a")
+        model.addConstr(A_tr @ u >= lb_tr, name="constr5b")
 
         model.setObjective(f @ u, GRB.MINIMIZE)
         model.setParam('OutputFlag', self.output_flag)
@@ -358,21 +330,21 @@ class eMPC_G2V_v2(MPC):
         if self.MIPGap is not None:
             model.params.MIPGap = self.MIPGap
         model.params.TimeLimit = self.time_limit
+        self.lap('build')
         model.optimize()
+        self.lap('solve')
         self.total_exec_time += model.Runtime
 
         if model.status == GRB.Status.INF_OR_UNBD or \
                 model.status == GRB.Status.INFEASIBLE:
             print(f"INFEASIBLE (applying default actions) - step{t} !!!")
             actions = np.ones(self.n_ports) * 0  # 0.25
+            self.stop_timing()
             return actions
 
-        a = np.zeros((nb*h, 1))
+        a = u.X
         cap = np.zeros((nb*h, 1))
 
-        for i in range(self.n_ports):
-            a[i] = u[i].x
-
         if self.verbose:
             print(f'Actions:\n {a.reshape(-1,self.n_ports)}')
             print(f'CapF1:\n {cap.reshape(-1,self.n_ports)}')
@@ -380,9 +352,10 @@ class eMPC_G2V_v2(MPC):
         # build normalized actions
         actions = np.zeros(self.n_ports)
         for i in range(self.n_ports):
-            actions[i] = a[i]/self.max_ch_power[i//2]
+            actions[i] = a[i]/self.max_ch_power[i]
 
         if self.verbose:
             print(f'actions: {actions.shape} \n {actions}')
         # input("Press Enter to continue...")
+        self.stop_timing()
         return actions
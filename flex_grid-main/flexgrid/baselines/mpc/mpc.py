@@ -4,11 +4,19 @@ This file contains the implementation of the MPC baseline for the profit and fle
 Authors: Cesar Diaz-Londono, Stavros Orfanoudakis
 """
 
+import time
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy import sparse
 
 from abc import ABC, abstractmethod
 
+from ev2gym.baselines.mpc.solvers import get_solver
+from ev2gym.baselines.mpc.decomposition import DecomposedSolver
+
+# phases of the per step latency measurements of the MPC controllers
+TIMING_PHASES = ('state', 'matrices', 'build', 'solve', 'actions')
+
 
 class MPC(ABC):
 
@@ -19,6 +27,15 @@ class MPC(ABC):
                  time_limit=200,
                  output_flag=0,
                  MIPGap=None,
+                 solver=None,
+                 persistent_model=True,
+                 warm_start=True,
+                 decomposition=None,
+                 n_workers=1,
+                 transformer_clusters=None,
+                 site_power_limit=None,
+                 lp_relaxation='auto',
+                 decomposition_fallback=True,
                  **kwargs):
         """
         Initialize the MPC baseline.
@@ -27,6 +44,23 @@ class MPC(ABC):
             env: The environment to be used for the MPC baseline.
             horizon: The horizon of the MPC baseline.
             verbose: Whether to print debug information.
+            solver: The solver backend ("gurobi" or "highs"), if None the
+                "mpc_solver" entry of the config file is used (default: "gurobi").
+            persistent_model: Whether to keep the solver model between steps and update it in place.
+            warm_start: Whether to warm start every step from the shifted previous solution.
+            decomposition: If "transformer", the problem is split in one subproblem per
+                transformer (or per cluster of transformers) solved in parallel.
+            n_workers: Number of worker processes used by the decomposed solver.
+            decomposition_fallback: Whether a step is solved again without decomposition when the
+                decomposed solver finds no solution that meets the coupling constraints, within
+                the time left of time_limit. Feasible solutions with a duality gap are used as they are.
+            transformer_clusters: Cluster of every transformer for the decomposition
+                (default: one cluster per transformer).
+            site_power_limit: Optional limit (kW) of the total power of all transformers.
+            lp_relaxation: Whether the V2G problems are first solved without the charge/discharge
+                binaries (True, False or "auto" to detect when the binaries are redundant).
+                The MILP is solved instead if the LP solution charges and discharges a port
+                at the same time.
         """
 
         self.env = env
@@ -39,13 +73,41 @@ class MPC(ABC):
         self.simulation_length = env.simulation_length  # Simulation length in steps
         self.t_min = env.timescale  # Time scale in minutes
         self.control_horizon = control_horizon  # prediction horizon in steps
-        self.total_exec_time = 0
+        self.total_exec_time = 0  # total solve time
+        self.total_build_time = 0  # total model build time
+        self.step_timings = []  # latency (s) of every phase at every step
+        self._timing = None
+        self._lap_time = None
 
         self.output_flag = output_flag
         self.time_limit = time_limit
         self.MIPGap = MIPGap
         self.verbose = verbose
 
+        if solver is None:
+            solver = env.config.get('mpc_solver', 'gurobi')
+        if decomposition not in [None, 'transformer']:
+            raise ValueError(f'Unknown decomposition {decomposition}')
+        self.solver_name = solver
+        self.persistent_model = persistent_model
+        self.n_workers = n_workers
+        self.decomposition = decomposition
+        self.solver = self.create_solver()
+        # separate solver for the LP relaxation, so that the persistent models
+        # of the LP and the MILP are not rebuilt when switching between them
+        self.lp_solver = None
+        self.lp_relaxation = lp_relaxation
+        self.lp_solves = 0  # steps solved with the LP relaxation
+        self.lp_fallbacks = 0  # LP solutions with overlap, solved again as MILP
+        # monolithic solvers used when the decomposed solver does not converge
+        self.decomposition_fallback = decomposition_fallback
+        self.fallback_solvers = {}
+        self.decomposition_fallbacks = 0  # steps solved again without decomposition
+        self.transformer_clusters = transformer_clusters
+        self.site_power_limit = site_power_limit
+        self.warm_start = warm_start
+        self.last_solution = None
+
         if self.verbose:
             np.set_printoptions(linewidth=np.inf)
             print(f'Number of EVs: {self.EV_number}')
@@ -53,12 +115,20 @@ class MPC(ABC):
             print(f'Simulation length: {self.simulation_length}')
             print(f'Time scale: {self.T}')
             print(f'Prediction horizon: {self.control_horizon}')
-
-        # Assume all Chargers have the same characteristics and have only one port!!!
-        assert env.charging_stations[0].n_ports == 1, "MPC baseline only works with one port per charger."
-        # Maximum power per EVSE
-        Pmax = env.charging_stations[0].get_max_power()
-        Pmin = env.charging_stations[0].get_min_power()
+            print(f'Solver: {self.solver.name}')
+
+        # Ports are numbered charger by charger, the ports of a charger share its current limits
+        ports_per_cs = np.array([cs.n_ports for cs in env.charging_stations])
+        # index of the first port of every charger
+        self.port_offset = np.concatenate(([0], np.cumsum(ports_per_cs)[:-1]))
+        # charger and transformer of every port
+        self.port_cs = np.repeat(np.arange(len(ports_per_cs)), ports_per_cs)
+        self.port_transformers = np.repeat(np.asarray(env.cs_transformers), ports_per_cs)
+        # Charger to port incidence matrix (n_cs x n_ports), only needed if a charger has more than one port
+        self.multiport = bool((ports_per_cs > 1).any())
+        self.cs_incidence = sparse.csr_matrix(
+            (np.ones(self.n_ports), (self.port_cs, np.arange(self.n_ports))),
+            shape=(len(ports_per_cs), self.n_ports))
 
         # Assume all EVs have the same power intake characteristics, and can receive Pmax !!!
         # Initial SoC conditions [kWh] for EVs
@@ -92,17 +162,22 @@ class MPC(ABC):
         self.p_min_MT = np.zeros(
             (self.n_ports, self.simulation_length + self.control_horizon + 1))
         
-        # the charger each EV is connected to
+        # the port each EV is connected to
         self.ev_locations = np.zeros(self.EV_number, dtype=int)
         # The maximum battery capacity of each EV
         self.ev_max_batt = np.zeros(self.EV_number, dtype=int)
+        # The EV connected to every port at every step (-1 if none)
+        self.ev_index = np.full(
+            (self.n_ports, self.simulation_length + self.control_horizon + 1), -1)
 
-        self.max_ch_power = np.zeros(self.n_ports)
-        self.max_disch_power = np.zeros(self.n_ports)
+        # Maximum charging and discharging power of every port (the power of its charger)
+        self.max_ch_power = np.array([cs.get_max_power()
+                                      for cs in env.charging_stations])[self.port_cs]
+        self.max_disch_power = np.array([cs.get_min_power()
+                                         for cs in env.charging_stations])[self.port_cs]
 
-        for i, cs in enumerate(env.charging_stations):
-            self.max_ch_power[i] = cs.get_max_power()
-            self.max_disch_power[i] = cs.get_min_power()
+        # first step at which every port is free
+        port_free_at = np.zeros(self.n_ports, dtype=int)
 
         # EVs Scheduling and specs based on the ev2gym environment
         for index, EV in enumerate(env.EVs_profiles):
@@ -130,13 +205,24 @@ class MPC(ABC):
             else:
                 self.departure_times[index] = EV.time_of_departure + 1
 
-            ev_location = EV.location
+            # the EV takes the first free port of its charger, as in the environment
+            ports = self.port_offset[EV.location] + \
+                np.arange(env.charging_stations[EV.location].n_ports)
+            free = ports[port_free_at[ports] <= self.arrival_times[index]]
+            ev_location = free[0] if len(free) > 0 else ports[EV.id]
+            port_free_at[ev_location] = self.departure_times[index]
+
+            # Maximum power of the charger of the EV
+            Pmax = self.max_ch_power[ev_location]
+            Pmin = self.max_disch_power[ev_location]
 
             self.ev_locations[index] = ev_location
             self.ev_max_batt[index] = EV.battery_capacity
             
             self.u[ev_location, self.arrival_times[index]:
                    self.departure_times[index]] = 1
+            self.ev_index[ev_location, self.arrival_times[index]:
+                          self.departure_times[index]] = index
             self.x_init[ev_location, self.arrival_times[index]:
                         self.departure_times[index]] = self.Cx0[index]
 
@@ -176,24 +262,19 @@ class MPC(ABC):
         self.tr_power_limit = np.zeros(
             (self.number_of_transformers, self.control_horizon))
 
-        self.tr_cs = np.zeros((self.number_of_transformers,
-                               self.control_horizon,
-                               self.control_horizon*self.n_ports))
-
-        for tr_index in range(self.number_of_transformers):
-            # print(np.array(env.cs_transformers)==tr_index)
-            for i in range(self.control_horizon):
-                self.tr_cs[tr_index, i,
-                           i*self.n_ports:
-                               (i+1)*self.n_ports] = np.array(env.cs_transformers) == tr_index
+        # Transformer to port incidence matrix (n_transformers x n_ports)
+        self.tr_incidence = sparse.csr_matrix(
+            (np.ones(self.n_ports),
+             (self.port_transformers, np.arange(self.n_ports))),
+            shape=(self.number_of_transformers, self.n_ports))
 
         if self.verbose:
             print(f'Transformer loads: {self.tr_loads.shape}')
             print(f'{self.tr_loads}')
             print(f'Transformer Power Limit: {self.tr_power_limit.shape}')
             print(f'{self.tr_power_limit}')
-            print(f'Transformer to CS: {self.tr_cs.shape}')
-            print(f'{self.tr_cs}')
+            print(f'Transformer to CS: {self.tr_incidence.shape}')
+            print(f'{self.tr_incidence.toarray()}')
 
         # Assume every charging station has the same energy prices
         # prices per KWh for the whole simulation
@@ -228,47 +309,137 @@ class MPC(ABC):
     def get_action(self, env):
         pass
 
+    def start_timing(self, t):
+        '''
+        This function starts the latency measurement of step t. Every call of lap adds
+        the time since the previous lap (or start_timing) to a phase.
+        '''
+        self._timing = dict.fromkeys(TIMING_PHASES, 0.0)
+        self._timing['step'] = t
+        self._lap_time = time.perf_counter()
+
+    def lap(self, phase):
+        '''
+        This function adds the time since the previous lap to the given phase.
+        '''
+        now = time.perf_counter()
+        if self._timing is not None:
+            self._timing[phase] += now - self._lap_time
+        self._lap_time = now
+
+    def stop_timing(self):
+        '''
+        This function ends the latency measurement of the step, the time since the last
+        lap is counted as action extraction.
+        '''
+        if self._timing is None:
+            return
+
+        self.lap('actions')
+        self._timing['total'] = sum(self._timing[phase] for phase in TIMING_PHASES)
+        self.step_timings.append(self._timing)
+        self._timing = None
+
+    def get_timings(self):
+        '''
+        This function returns the latency (s) of every step as a dictionary of arrays with the
+        keys step, state (state reconstruction), matrices (prediction model and limits),
+        build (problem and solver model build), solve, actions (action extraction) and total.
+        '''
+        keys = ('step',) + TIMING_PHASES + ('total',)
+        return {key: np.array([timing[key] for timing in self.step_timings])
+                for key in keys}
+
+    def timing_summary(self):
+        '''
+        This function returns the total, mean and max latency (s) of every phase, e.g.
+        {'time_solve': ..., 'time_solve_mean': ..., 'time_solve_max': ...}.
+        '''
+        timings = self.get_timings()
+        summary = {}
+        for phase in TIMING_PHASES + ('total',):
+            values = timings[phase]
+            summary[f'time_{phase}'] = values.sum()
+            summary[f'time_{phase}_mean'] = values.mean() if len(values) else 0.0
+            summary[f'time_{phase}_max'] = values.max(initial=0.0)
+
+        return summary
+
+    def create_solver(self, decomposition=True):
+        '''
+        This function creates a solver backend with the parameters of the MPC. If
+        decomposition is False, a monolithic solver is created even for decomposed MPCs.
+        '''
+        if self.decomposition is None or not decomposition:
+            return get_solver(self.solver_name,
+                              time_limit=self.time_limit,
+                              mip_gap=self.MIPGap,
+                              output_flag=self.output_flag,
+                              persistent=self.persistent_model)
+
+        return DecomposedSolver(self.solver_name,
+                                n_workers=self.n_workers,
+                                time_limit=self.time_limit,
+                                mip_gap=self.MIPGap,
+                                output_flag=self.output_flag,
+                                persistent=self.persistent_model)
+
+    def close(self):
+        '''
+        This function releases the solver backends, and the worker processes of the
+        decomposed solvers.
+        '''
+        solvers = [self.solver, self.lp_solver] + list(self.fallback_solvers.values())
+        for solver in solvers:
+            if solver is not None:
+                solver.close()
+
+        self.lp_solver = None
+        self.fallback_solvers = {}
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
     def update_tr_power(self, t):
         '''
         This function updates the transformer power limits, loads and PV generation for the next control horizon based on forecasts.
+        The load and PV of step t are the actual values.
         '''
 
         for i, tr in enumerate(self.env.transformers):
-            self.tr_power_limit[i, :] = tr.get_power_limits(
+            loads, pv, power_limits = tr.get_forecast_windows(
                 step=t, horizon=self.control_horizon)
 
-            self.tr_pv[i, :] = np.zeros(self.control_horizon)
-            self.tr_pv[i, 0] = tr.solar_power[tr.current_step+1]
-            l = len(tr.pv_generation_forecast[tr.current_step + 2:
-                                              tr.current_step+self.control_horizon+1])
-
-            if l >= self.control_horizon - 1:
-                l = self.control_horizon - 1
-            else:
-                l = l + 1
-            self.tr_pv[i, 1:l] = tr.pv_generation_forecast[tr.current_step + 2:
-                                                           tr.current_step+self.control_horizon]
-            self.tr_loads[i, :] = np.zeros(self.control_horizon)
-            self.tr_loads[i, 0] = tr.inflexible_load[tr.current_step+1]
-            self.tr_loads[i, 1:l] = tr.inflexible_load_forecast[tr.current_step + 2:
-                                                                tr.current_step+self.control_horizon]
+            self.tr_power_limit[i, :] = power_limits
+            self.tr_loads[i, :] = loads
+            self.tr_pv[i, :] = pv
 
     def update_tr_power_oracle(self, t):
         '''
-        This function updates the transformer power limits, loads and PV generation for the next control horizon based on forecasts.
+        This function updates the transformer power limits, loads and PV generation for the next control horizon using the exact values (not forecasts).
+        Steps after the end of the simulation repeat the last value.
         '''
+        steps = np.minimum(np.arange(t, t + self.control_horizon),
+                           self.simulation_length - 1)
 
         for i, tr in enumerate(self.env.transformers):
-            self.tr_power_limit[i, :] = tr.max_power
-            self.tr_pv[i, :] = tr.solar_power
-            self.tr_loads[i, :] = tr.inflexible_load
+            self.tr_power_limit[i, :] = tr.max_power[steps]
+            self.tr_pv[i, :] = tr.solar_power[steps]
+            self.tr_loads[i, :] = tr.inflexible_load[steps]
 
-    def reconstruct_state(self, t):
+    def reconstruct_state(self, t, env=None):
         '''
         This function reconstructs the state of the environment using the historical data.
+        If env is given, the state is read from it instead of the controlled environment.
         '''
+        if env is None:
+            env = self.env
+
         counter = 0
-        for charger in self.env.charging_stations:
+        for charger in env.charging_stations:
             for ev in charger.evs_connected:
                 if ev is None:
                     self.x_next[counter] = 0
@@ -286,7 +457,9 @@ class MPC(ABC):
             for i in range(t, t + self.control_horizon-1):
                 Gx1 = self.x_init[:, i].copy()
                 for j in range(self.n_ports):
-                    if self.x_init[j, t] > 0 and self.x_init[j, t - 1] != 0:
+                    # only while the EV connected at step t is still connected
+                    if self.x_init[j, t] > 0 and self.x_init[j, t - 1] != 0 and \
+                            self.ev_index[j, i] == self.ev_index[j, t]:
                         Gx1[j] = self.x_next[j].copy()
                 self.Gxx0 = np.concatenate((self.Gxx0, Gx1))
 
@@ -323,57 +496,125 @@ class MPC(ABC):
     def v2g_station_models(self, t):
         '''
         This function builds the station models for the V2G problem.
+
+        The A matrices of the station model are diagonal 0/1 masks (EV connected or not),
+        so only their diagonals are stored: Amono has shape (n_ports, control_horizon+1).
+        Bmono has shape (n_ports, 2, control_horizon+1) and holds the charging and
+        discharging coefficient of every port.
         '''
 
         # Station model
-        self.Amono = np.dstack([np.diag(self.u[:, i])
-                                for i in range(t, t + 1 + self.control_horizon)])
+        self.Amono = self.u[:, t:t + 1 + self.control_horizon]
 
-        self.Bmono = np.zeros((self.n_ports, self.nb, self.control_horizon+1))
-        for j in range(t, t + self.control_horizon+1):
-            Bmono2 = []
-            bnew = self.T * np.diag(self.u[:, j]).T
-            for i in range(self.n_ports):
-                Bmono2.append(self.ch_eff * bnew[:, i])
-                Bmono2.append(-self.disch_eff * bnew[:, i])
-            Bmono2 = np.array(Bmono2).T
-            self.Bmono[:, :, j - t] = Bmono2
+        self.Bmono = self.T * np.stack((self.ch_eff * self.Amono,
+                                        -self.disch_eff * self.Amono), axis=1)
 
     def g2v_station_models(self, t):
+        '''
+        This function builds the station models for the G2V problem.
+        Amono has shape (n_ports, control_horizon+1) and Bmono (n_ports, 1, control_horizon+1).
+        '''
+
+        self.Amono = self.u[:, t:t + 1 + self.control_horizon]
+
+        self.Bmono = self.ch_eff * self.T * self.Amono[:, np.newaxis, :]
+
+    def _init_prediction_pattern(self):
+        '''
+        This function computes the (fixed) sparsity pattern of the prediction matrix Gu.
+
+        Gu is block lower triangular with control_horizon x control_horizon blocks of size
+        (na, nb), and every block only couples a port with its own inputs. The non-zero
+        values of Gu are kept in a (n_blocks, n_ports, n_inputs) array where the blocks
+        are ordered as np.tril_indices.
+        '''
+        h = self.control_horizon
+        n = self.n_ports
+        c = self.nb // self.na  # inputs per port (1 for G2V, 2 for V2G)
+
+        self._Gu_I, self._Gu_J = np.tril_indices(h)
+        # index of the Bmono used by every block (diagonal blocks use their own step)
+        self._Gu_K = np.where(self._Gu_I == self._Gu_J,
+                              self._Gu_J,
+                              np.maximum(self._Gu_J - 1, 0))
+
+        rows = (self._Gu_I[:, None, None] * self.na +
+                np.arange(n)[None, :, None] +
+                np.zeros((1, 1, c), dtype=int))
+        cols = (self._Gu_J[:, None, None] * self.nb +
+                np.arange(n)[None, :, None] * c +
+                np.arange(c)[None, None, :])
+
+        pattern = sparse.csr_matrix((np.arange(1, rows.size + 1),
+                                     (rows.ravel(), cols.ravel())),
+                                    shape=(h * self.na, h * self.nb))
+        self._Gu_pattern = pattern
+        # position of every stored value inside the csr data array
+        self._Gu_perm = pattern.data - 1
+
+        # block (i, j) at step t+1 equals block (i+1, j+1) at step t, except for the
+        # first block column (below the diagonal) and the last block row
+        pair_index = self._Gu_I * (self._Gu_I + 1) // 2 + self._Gu_J
+        shiftable = (self._Gu_I <= h - 2) & \
+            ((self._Gu_J >= 1) | (self._Gu_I == self._Gu_J))
+        self._Gu_shift_dst = pair_index[shiftable]
+        src_I = self._Gu_I[shiftable] + 1
+        src_J = self._Gu_J[shiftable] + 1
+        self._Gu_shift_src = src_I * (src_I + 1) // 2 + src_J
+        self._Gu_fresh = pair_index[~shiftable]
+
+        self._Gu_vals = np.zeros((len(self._Gu_I), n, c))
+        self._Gu_step = None
+
+    def _prediction_blocks(self, blocks):
+        '''
+        This function computes the values of the given Gu blocks from the station models.
+        Products of consecutive A matrices are evaluated with cumulative masks.
+        '''
+        I = self._Gu_I[blocks]
+        J = self._Gu_J[blocks]
+        K = self._Gu_K[blocks]
 
-        self.Amono = np.dstack([np.diag(self.u[:, i])
-                                for i in range(t, t + 1 + self.control_horizon)])
+        # number of empty-port steps up to every step of the horizon
+        zeros = np.cumsum(1 - self.Amono, axis=1)
+        # product of Amono[:, :, m] for m in j+1..i
+        mask = zeros[:, I] == zeros[:, J]
 
-        self.Bmono = self.ch_eff * self.T * np.dstack([np.diag(self.u[:, i])
-                                                       for i in range(t, t + 1 + self.control_horizon)])
+        vals = self.Bmono[:, :, K] * mask[:, np.newaxis, :]
+        return vals.transpose(2, 0, 1)
 
     def calculate_InequalityConstraints(self, t):
         '''
         This function calculates the inequality constraints for the optimization problem.
         Au and bu are the inequality constraints.
+
+        Gu and AU are scipy.sparse csr matrices. When the function is called for
+        consecutive steps, Gu is updated by shifting its blocks one step and only
+        the first block column and the last block row are recomputed.
         '''
 
+        if getattr(self, '_Gu_pattern', None) is None:
+            self._init_prediction_pattern()
+
         # Complete model calculation Gu, this is the G in the paper
-        self.Gu = np.zeros((self.control_horizon * self.na,
-                            self.control_horizon * self.nb))
-
-        for i in range(self.control_horizon):
-            Bbar = self.Bmono[:, :, 0]
-            for j in range(i + 1):
-                Abar = np.eye(self.n_ports)
-                if i == j:
-                    self.Gu[i * self.na: (i+1) * self.na, j * self.nb: (j+1)
-                            * self.nb] = self.Bmono[:, :, j]
-                else:
-                    for m in range(j + 1, i + 1):
-                        Abar = np.dot(Abar, self.Amono[:, :, m])
-                    self.Gu[i * self.na: (i+1) * self.na, j *
-                            self.nb: (j+1) * self.nb] = np.dot(Abar, Bbar)
+        if self._Gu_step is not None and t == self._Gu_step + 1:
+            self._Gu_vals[self._Gu_shift_dst] = self._Gu_vals[self._Gu_shift_src]
+            self._Gu_vals[self._Gu_fresh] = self._prediction_blocks(
+                self._Gu_fresh)
+        else:
+            self._Gu_vals[:] = self._prediction_blocks(
+                np.arange(len(self._Gu_I)))
+        self._Gu_step = t
 
-                Bbar = self.Bmono[:, :, j]
+        data = self._Gu_vals.reshape(-1)[self._Gu_perm]
+        self.Gu = sparse.csr_matrix((data,
+                                     self._Gu_pattern.indices.copy(),
+                                     self._Gu_pattern.indptr.copy()),
+                                    shape=self._Gu_pattern.shape)
+        self.Gu.eliminate_zeros()
 
         # Inequality constraint
-        self.AU = np.vstack((self.Gu, -self.Gu))
+        self.AU = sparse.vstack((self.Gu, -self.Gu), format='csr')
         self.bU = np.concatenate(
             (np.abs(self.XMAX - self.Gxx0), -self.XF + self.Gxx0))
 
@@ -408,6 +649,318 @@ class MPC(ABC):
         self.LB = self.LB.flatten().reshape(-1)
         self.UB = self.UB.flatten().reshape(-1)
 
+    def transformer_constraints(self):
+        '''
+        This function builds the transformer power limits of the control horizon in matrix form,
+            lb <= A @ u <= ub
+
+        The net power of every port is u[ch] - u[dis] for V2G and u for G2V, A is
+        kron(I_h, tr_incidence @ port_power) and its rows are ordered step-major
+        (step, transformer), so it has n_ports x control_horizon nonzeros.
+        '''
+        h = self.control_horizon
+
+        if self.nb == 2 * self.na:
+            port_power = sparse.kron(sparse.identity(self.na),
+                                     np.array([[1, -1]]))
+        else:
+            port_power = sparse.identity(self.na)
+
+        A = sparse.kron(sparse.identity(h),
+                        self.tr_incidence @ port_power, format='csr')
+
+        net_load = self.tr_loads + self.tr_pv
+        ub = (self.tr_power_limit - net_load).T.reshape(-1)
+        lb = (-self.tr_power_limit.max(axis=1, keepdims=True) -
+              net_load).T.reshape(-1)
+
+        return A, lb, ub
+
+    def add_transformer_constraints(self, problem, u='u', lower_limit=True):
+        '''
+        This function adds the transformer power limits of the control horizon to the problem.
+        If a site power limit is set, the total power of all transformers is limited too;
+        these are the only constraints coupling different transformers.
+        '''
+        A, lb, ub = self.transformer_constraints()
+
+        if not lower_limit:
+            lb = -np.inf
+
+        problem.add_constraints({u: A}, lb=lb, ub=ub)
+
+        if self.site_power_limit is not None:
+            h = self.control_horizon
+            # sum the (step, transformer) rows of every step
+            A_site = sparse.kron(sparse.identity(h),
+                                 np.ones((1, self.number_of_transformers))) @ A
+
+            net_load = (self.tr_loads + self.tr_pv).sum(axis=0)
+            problem.add_constraints({u: A_site},
+                                    lb=-self.site_power_limit - net_load
+                                    if lower_limit else -np.inf,
+                                    ub=self.site_power_limit - net_load,
+                                    coupling=True)
+
+    def charger_constraints(self):
+        '''
+        This function builds the shared current limits of the multi-port chargers in matrix form,
+            A @ u <= ub
+
+        The charging (and discharging for V2G) powers of the ports of a charger must not exceed
+        the power of the charger. A is kron(I_h, cs_incidence @ selection) and its rows are
+        ordered step-major (step, charger, [ch, dis]), so it has one nonzero per variable.
+        Returns None if every charger has a single port, the limits are then variable bounds.
+        '''
+        if not self.multiport:
+            return None
+
+        h = self.control_horizon
+
+        if self.nb == 2 * self.na:
+            # (charger, ch/dis) x (port, ch/dis)
+            A_step = sparse.kron(self.cs_incidence, sparse.identity(2))
+            cs_max = np.stack((self.max_ch_power[self.port_offset],
+                               np.abs(self.max_disch_power[self.port_offset])), axis=1)
+        else:
+            A_step = self.cs_incidence
+            cs_max = self.max_ch_power[self.port_offset]
+
+        A = sparse.kron(sparse.identity(h), A_step, format='csr')
+        ub = np.tile(cs_max.reshape(-1), h)
+
+        return A, ub
+
+    def add_charger_constraints(self, problem, u='u'):
+        '''
+        This function adds the shared current limits of the multi-port chargers to the problem.
+        '''
+        constraints = self.charger_constraints()
+        if constraints is None:
+            return
+
+        A, ub = constraints
+        problem.add_constraints({u: A}, ub=ub)
+
+    def column_groups(self, problem):
+        '''
+        This function returns the transformer (or transformer cluster) of every variable of
+        the problem. All variable blocks are ordered step-major and have the same number of
+        variables per port.
+        '''
+        port_groups = self.port_transformers
+        if self.transformer_clusters is not None:
+            port_groups = np.asarray(self.transformer_clusters)[port_groups]
+
+        groups = np.zeros(problem.n_vars, dtype=int)
+        for var in problem.variables.values():
+            size = var.stop - var.start
+            per_port = size // (self.control_horizon * self.n_ports)
+            ports = (np.arange(size) // per_port) % self.n_ports
+            groups[var] = port_groups[ports]
+
+        return groups
+
+    def add_charge_discharge_constraints(self, problem, u='u', Zbin='Zbin'):
+        '''
+        This function adds the binary constraints that forbid charging and discharging
+        a port at the same time:
+            u[ch] <= UB[ch] * Zbin,  u[dis] <= UB[dis] * (1 - Zbin)
+        '''
+        nb_h = self.nb * self.control_horizon
+        identity = sparse.identity(nb_h, format='csr')
+        UB_ch = self.UB[0::2]
+        UB_dis = self.UB[1::2]
+
+        problem.add_constraints({u: identity[0::2],
+                                 Zbin: -sparse.diags(UB_ch)},
+                                ub=0)
+        problem.add_constraints({u: identity[1::2],
+                                 Zbin: sparse.diags(UB_dis)},
+                                ub=UB_dis)
+
+    def binaries_redundant(self, t):
+        '''
+        This function checks if the charge/discharge binaries of the V2G problem starting at
+        step t can be dropped.
+
+        In the station model, charging c and discharging d change the energy by
+        T * (ch_eff * c - disch_eff * d). If ch_eff <= disch_eff and the discharge prices are
+        not above the charge prices, lowering c and d by the same amount keeps the grid power,
+        does not decrease the energy and does not increase the cost. Charging and discharging
+        at the same time is then never better, so the LP relaxation is exact (up to ties and
+        the rare case where energy has to be dissipated, both handled by the MILP fallback).
+        '''
+        if self.lp_relaxation == 'auto':
+            h = self.control_horizon
+            return self.ch_eff <= self.disch_eff and \
+                np.all(self.disch_prices[t:t + h] <= self.ch_prices[t:t + h])
+
+        return bool(self.lp_relaxation)
+
+    def has_overlap(self, u, e=0.001):
+        '''
+        This function checks if a V2G solution charges and discharges a port at the same time.
+        '''
+        u = u.reshape(-1, 2)
+        return bool(np.any((u[:, 0] > e) & (u[:, 1] > e)))
+
+    def remove_overlap(self, result, tolerance=1e-6):
+        '''
+        This function removes the simultaneous charging and discharging from an LP solution
+        by lowering both powers of every port by their minimum, which keeps the grid power.
+        The new solution is only accepted if it satisfies all the constraints of the problem
+        and does not increase the objective. Returns True if the overlap was removed.
+        '''
+        problem = result.problem
+        c, A, row_lb, row_ub, lb, ub, _ = problem.build()
+
+        x = result.x.copy()
+        u = x[problem.variables["u"]].reshape(-1, 2)
+        u = u - np.minimum(u[:, 0], u[:, 1])[:, np.newaxis]
+        x[problem.variables["u"]] = u.reshape(-1)
+
+        Ax = A @ x
+        feasible = np.all(x >= lb - tolerance) and np.all(x <= ub + tolerance) and \
+            np.all(Ax >= row_lb - tolerance * (1 + np.abs(row_lb))) and \
+            np.all(Ax <= row_ub + tolerance * (1 + np.abs(row_ub)))
+        objective = c @ x
+
+        if not feasible or objective > result.objective + tolerance * (1 + abs(result.objective)):
+            return False
+
+        result.x = x
+        result.objective = objective
+        return True
+
+    def solve_v2g(self, build_problem, t=None):
+        '''
+        This function solves a V2G problem, build_problem(relaxed) returns the problem
+        with (relaxed=False) or without (relaxed=True) the charge/discharge binaries.
+
+        If the binaries are redundant the LP is solved first. Ties between charging and
+        discharging in the LP solution are removed with remove_overlap, and the MILP is
+        only solved when the LP is infeasible or the overlap cannot be removed.
+        '''
+        if t is None:
+            t = self.env.current_step
+
+        if self.binaries_redundant(t):
+            if self.lp_solver is None:
+                self.lp_solver = self.create_solver()
+
+            result = self.solve(build_problem(relaxed=True), t, solver=self.lp_solver)
+            # only optimal LP solutions are used, otherwise the MILP is solved
+            optimal = result.status == "optimal"
+            exact = optimal and not self.has_overlap(result.get("u"))
+            if optimal and not exact and self.remove_overlap(result):
+                # warm start the next step from the solution without overlap
+                self.last_solution = (t, {name: result.get(name)
+                                          for name in result.problem.variables})
+                exact = True
+
+            if exact:
+                self.lp_solves += 1
+                return result
+
+            self.lp_fallbacks += 1
+            if self.verbose:
+                print(f'LP relaxation not exact at step {t}, solving the MILP')
+
+        return self.solve(build_problem(relaxed=False), t)
+
+    def set_warm_start(self, problem, t):
+        '''
+        This function sets the previous solution, shifted to the current step, as the
+        initial solution of the problem. All variable blocks are ordered step-major,
+        the values of the new steps at the end of the horizon are left undefined.
+        '''
+        if self.last_solution is None:
+            return
+
+        prev_t, solution = self.last_solution
+        shift = t - prev_t
+        if shift < 0 or shift >= self.control_horizon:
+            return
+
+        for name, values in solution.items():
+            if name not in problem.variables:
+                continue
+            var = problem.variables[name]
+            if var.stop - var.start != len(values):
+                continue
+
+            per_step = len(values) // self.control_horizon
+            start = np.full(len(values), np.nan)
+            start[:len(values) - shift * per_step] = values[shift * per_step:]
+            problem.set_start(name, start)
+
+    def solve(self, problem, t=None, solver=None):
+        '''
+        This function solves the problem with the selected solver backend and keeps
+        track of the total build and solve times. t is the first step of the control
+        horizon (default: the current step of the environment).
+        '''
+        if solver is None:
+            solver = self.solver
+        if t is None:
+            t = self.env.current_step
+        if self.warm_start:
+            self.set_warm_start(problem, t)
+
+        if self.decomposition is not None:
+            problem.groups = self.column_groups(problem)
+
+        self.lap('build')
+        timer = time.perf_counter()
+        result = solver.solve(problem)
+        build_time = result.build_time
+        solve_time = result.solve_time
+
+        # the time left for solving the problem without decomposition
+        time_left = None if self.time_limit is None else \
+            self.time_limit - (time.perf_counter() - timer)
+
+        if isinstance(solver, DecomposedSolver) and result.status == "not_converged" and \
+                self.decomposition_fallback and (time_left is None or time_left > 0):
+            # no solution meets the coupling constraints, the problem is solved as a whole
+            self.decomposition_fallbacks += 1
+            if self.verbose:
+                print(f'{solver.name}: not converged, '
+                      f'solving the problem without decomposition')
+
+            key = 'lp' if solver is self.lp_solver else 'milp'
+            if key not in self.fallback_solvers:
+                self.fallback_solvers[key] = self.create_solver(decomposition=False)
+            solver = self.fallback_solvers[key]
+            solver.time_limit = time_left
+
+            result = solver.solve(problem)
+            build_time += result.build_time
+            solve_time += result.solve_time
+
+        # the solver backend reports its own model build time
+        if self._timing is not None:
+            elapsed = time.perf_counter() - self._lap_time
+            self._timing['build'] += build_time
+            self._timing['solve'] += elapsed - build_time
+        self._lap_time = time.perf_counter()
+
+        if result.x is not None:
+            self.last_solution = (t, {name: result.get(name)
+                                      for name in problem.variables})
+        else:
+            self.last_solution = None
+
+        self.total_build_time += build_time
+        self.total_exec_time += solve_time
+
+        if self.verbose:
+            print(f'{solver.name}: {result.status} - build time: '
+                  f'{result.build_time:.4f}s, solve time: {result.solve_time:.4f}s')
+
+        return result
+
     def print_info(self, t):
         '''
         This function prints the information of the optimization problem.
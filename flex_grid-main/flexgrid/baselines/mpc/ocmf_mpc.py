@@ -4,13 +4,11 @@ This file contains the implementation of the OCMF_V2G and OCMF_G2V MPC
 Authors: Cesar Diaz-Londono, Stavros Orfanoudakis
 '''
 
-import gurobipy as gp
-from gurobipy import GRB
-from gurobipy import *
 import numpy as np
-import time
+from scipy import sparse
 
 from ev2gym.baselines.mpc.mpc import MPC
+from ev2gym.baselines.mpc.solvers import MILP
 
 
 class OCMF_V2G(MPC):
@@ -24,7 +22,7 @@ class OCMF_V2G(MPC):
             horizon: The horizon of the MPC baseline.
             verbose: Whether to print debug information.
         """
-        super().__init__(env, control_horizon, verbose)
+        super().__init__(env, control_horizon, verbose, **kwargs)
 
         self.na = self.n_ports
         self.nb = 2 * self.na
@@ -34,12 +32,14 @@ class OCMF_V2G(MPC):
         This function computes the MPC actions for the economic problem including V2G.
         """
         t = env.current_step
+        self.start_timing(t)
         # update transformer limits
         self.update_tr_power(t)
 
         # reconstruct self.x_next using the environment
         self.reconstruct_state(t)
         self.calculate_XF_V2G(t)
+        self.lap('state')
 
         # Station models: Amono and Bmono
         self.v2g_station_models(t)
@@ -49,11 +49,58 @@ class OCMF_V2G(MPC):
 
         # Set power limits
         self.set_power_limits_V2G(t)
+        self.lap('matrices')
 
         # Print information if verbose
         if self.verbose:
             self.print_info(t)
 
+        result = self.solve_v2g(
+            lambda relaxed: self.build_problem(t, relaxed), t)
+
+        if result.x is None:
+            print(f"INFEASIBLE (applying default actions) - step{t} !!!")
+            actions = np.ones(self.n_ports) * 0 # 0.25
+            self.stop_timing()
+            return actions
+
+        a = result.get("u")
+
+        # build normalized actions
+        actions = np.zeros(self.n_ports)
+        e = 0.001
+        for i in range(0, 2*self.n_ports, 2):
+            if a[i] > e and a[i + 1] > e:
+                raise ValueError(f'Charging and discharging at the same time\
+                                    {i} {a[i]} {a[i+1]}')
+            elif a[i] > e:
+                actions[i//2] = a[i]/self.max_ch_power[i//2]
+            elif a[i + 1] > e:
+                actions[i//2] = -a[i+1]/abs(self.max_disch_power[i//2])
+
+        if self.verbose:
+            print(f'actions: {actions.shape} \n {actions}')
+
+        # input("Press Enter to continue...")
+        self.stop_timing()
+        return actions
+
+    def binaries_redundant(self, t):
+        '''
+        This function checks if the charge/discharge binaries can be dropped. The CapF1
+        flexibility reward makes charging and discharging at the same time profitable,
+        so in "auto" mode the MILP is always solved.
+        '''
+        if self.lp_relaxation == 'auto':
+            return False
+
+        return bool(self.lp_relaxation)
+
+    def build_problem(self, t, relaxed=False):
+        """
+        This function builds the optimization problem of the control horizon starting at step t.
+        If relaxed, the charge/discharge binaries are left out.
+        """
         # Generate the min cost function
         f = []
         f2 = []
@@ -72,115 +119,39 @@ class OCMF_V2G(MPC):
         n = self.n_ports
         h = self.control_horizon
 
-        model = gp.Model("optimization_model")
-        u = model.addMVar(nb*h,
-                          vtype=GRB.CONTINUOUS,
-                          name="u")  # Power
+        identity = sparse.identity(nb*h, format='csr')
 
-        CapF1 = model.addMVar(nb*h,
-                              vtype=GRB.CONTINUOUS,
-                              name="CapF1")
+        problem = MILP("optimization_model")
+        problem.add_variables("u", nb*h, lb=self.LB, ub=self.UB)  # Power
 
-        # Binary for charging or discharging
-        Zbin = model.addMVar(n*h,
-                             vtype=GRB.BINARY,
-                             name="Zbin")
+        # Add the lower and upper bound constraints
+        problem.add_variables("CapF1", nb*h, lb=0, ub=self.UB)
 
-        # Constraints
-        model.addConstr((self.AU @ u)  <= self.bU, name="constr1")
+        if not relaxed:
+            # Binary for charging or discharging
+            problem.add_variables("Zbin", n*h, binary=True)
 
-        # Add the lower bound constraints
-        model.addConstr((0 <= CapF1), name="constr2a")
-
-        # Add the upper bound constraints
-        model.addConstr((CapF1 <= self.UB), name="constr2b")
-
-        # Constraints for charging P
-        model.addConstrs((CapF1[j] <= u[j]
-                          for j in range(0, nb*h, 2)), name="constr3a")
+        # Constraints
+        problem.add_constraints({"u": self.AU}, ub=self.bU)
 
-        model.addConstrs((u[j] <= (self.UB[j]-CapF1[j]) * Zbin[j//2]
-                          for j in range(0, nb*h, 2)), name="constr3b")
+        # Constraints for charging and discharging P
+        problem.add_constraints({"CapF1": identity, "u": -identity}, ub=0)
 
-        # Constraints for discharging P
-        model.addConstrs((CapF1[j] <= u[j]
-                          for j in range(1, nb*h, 2)),
-                         name="constr4a")
+        # u <= (UB - CapF1) * Zbin is linearized exactly as u <= UB * Zbin and
+        # u + CapF1 <= UB, since CapF1 <= u forces CapF1 = 0 when u = 0
+        if not relaxed:
+            self.add_charge_discharge_constraints(problem)
+        problem.add_constraints({"u": identity, "CapF1": identity}, ub=self.UB)
 
-        model.addConstrs((u[j] <= (self.UB[j]-CapF1[j])*(1-Zbin[j//2])
-                          for j in range(1, nb*h, 2)),
-                         name="constr4b")
+        # Add the shared limits of the multi-port chargers
+        self.add_charger_constraints(problem)
 
         # Add the transformer constraints
-        for tr_index in range(self.number_of_transformers):
-            for i in range(self.control_horizon):
-                model.addConstr((gp.quicksum((u[j] - u[j+1])
-                                             for index, j in enumerate(
-                                                 range(i*self.nb, (i+1)*self.nb, 2))
-                                             if self.cs_transformers[index] == tr_index) +
-                                 self.tr_loads[tr_index, i] +
-                                 self.tr_pv[tr_index, i] <=
-                                 self.tr_power_limit[tr_index, i]),
-                                name=f'constr5_{tr_index}_t{i}')
-                
-        for tr_index in range(self.number_of_transformers):
-            for i in range(self.control_horizon):
-                model.addConstr((gp.quicksum((u[j] - u[j+1])
-                                             for index, j in enumerate(
-                                                 range(i*self.nb, (i+1)*self.nb, 2))
-                                             if self.cs_transformers[index] == tr_index) +
-                                 self.tr_loads[tr_index, i] +
-                                 self.tr_pv[tr_index, i] >=
-                                 -self.tr_power_limit[tr_index, :].max()),
-                                name=f'constr5_{tr_index}_t{i}')        
-
-        model.setObjective(f @ u - f2 @ CapF1, GRB.MINIMIZE)
-        model.setParam('OutputFlag', self.output_flag)
-        model.params.NonConvex = 2
-        
-        if self.MIPGap is not None:
-            model.params.MIPGap = self.MIPGap
-        model.params.TimeLimit = self.time_limit        
-        model.optimize()
-        self.total_exec_time += model.Runtime
-
-        if self.MIPGap is not None:
-            model.params.MIPGap = self.MIPGap
-        model.params.TimeLimit = self.time_limit        
-        model.optimize()
-   
-            
-        if model.status == GRB.Status.INF_OR_UNBD or \
-                model.status == GRB.Status.INFEASIBLE:                  
-            print(f"INFEASIBLE (applying default actions) - step{t} !!!")                          
-            actions = np.ones(self.n_ports) * 0 # 0.25
-            return actions
-
-        a = np.zeros((nb*h, 1))
-        cap = np.zeros((nb*h, 1))
-        z_bin = np.zeros((n*h, 1))
-
-        for i in range(nb*h):
-            a[i] = u[i].x
-            # cap[i] = CapF1[i].x
-
-        # build normalized actions
-        actions = np.zeros(self.n_ports)
-        e = 0.001
-        for i in range(0, 2*self.n_ports, 2):
-            if a[i] > e and a[i + 1] > e:
-                raise ValueError(f'Charging and discharging at the same time\
-                                    {i} {a[i]} {a[i+1]}')
-            elif a[i] > e:
-                actions[i//2] = a[i]/self.max_ch_power[i//2]
-            elif a[i + 1] > e:
-                actions[i//2] = -a[i+1]/abs(self.max_disch_power[i//2])
+        self.add_transformer_constraints(problem)
 
-        if self.verbose:
-            print(f'actions: {actions.shape} \n {actions}')
+        problem.set_objective({"u": f, "CapF1": -f2})
 
-        # input("Press Enter to continue...")
-        return actions
+        return problem
 
 
 class OCMF_G2V(MPC):
@@ -197,7 +168,7 @@ class OCMF_G2V(MPC):
             horizon: The horizon of the MPC baseline.
             verbose: Whether to print debug information.
         """
-        super().__init__(env, control_horizon, verbose)
+        super().__init__(env, control_horizon, verbose, **kwargs)
 
         self.na = self.n_ports
         self.nb = self.na
@@ -207,12 +178,14 @@ class OCMF_G2V(MPC):
         This function computes the MPC actions for the economic problem including G2V.
         """        
         t = env.current_step
+        self.start_timing(t)
         # update transformer limits
         self.update_tr_power(t)
 
         # reconstruct self.x_next using the environment
         self.reconstruct_state(t)
         self.calculate_XF_G2V(t)
+        self.lap('state')
 
         # Station models: Amono and Bmono
         self.g2v_station_models(t)
@@ -222,6 +195,7 @@ class OCMF_G2V(MPC):
 
         # Set power limits
         self.set_power_limits_G2V(t)
+        self.lap('matrices')
 
         # Print information if verbose
         if self.verbose:
@@ -240,75 +214,41 @@ class OCMF_G2V(MPC):
         nb = self.nb
         h = self.control_horizon
 
-        model = gp.Model("optimization_model")
-        u = model.addMVar(nb*h,                         
-                          vtype=GRB.CONTINUOUS,
-                          name="u")  # Power
+        identity = sparse.identity(nb*h, format='csr')
 
-        CapF1 = model.addMVar(nb*h,
-                              vtype=GRB.CONTINUOUS,
-                              name="CapF1")
-
-        # Constraints
-        model.addConstr((self.AU @ u)  <= self.bU, name="constr1")
+        problem = MILP("optimization_model")
+        problem.add_variables("u", nb*h, lb=0)  # Power
 
-        # Add the lower bound constraints
-        model.addConstr((0 <= CapF1), name="constr2a")
+        # Add the lower and upper bound constraints
+        problem.add_variables("CapF1", nb*h, lb=0, ub=self.UB)
 
-        # Add the upper bound constraints
-        model.addConstr((CapF1 <= self.UB), name="constr2b")
+        # Constraints
+        problem.add_constraints({"u": self.AU}, ub=self.bU)
 
         # Constraints for charging P
-        model.addConstr((CapF1 <= u), name="constr3a")
+        problem.add_constraints({"CapF1": identity, "u": -identity}, ub=0)
 
         # Constraints for charging P
-        model.addConstr((u <= (self.UB-CapF1)), name="constr3b")
+        problem.add_constraints({"u": identity, "CapF1": identity}, ub=self.UB)
+
+        # Add the shared limits of the multi-port chargers
+        self.add_charger_constraints(problem)
 
         # Add the transformer constraints
-        for tr_index in range(self.number_of_transformers):
-            for i in range(self.control_horizon):
-                model.addConstr((gp.quicksum(u[j]
-                                             for index, j in enumerate(
-                                                 range(i*self.nb, (i+1)*self.nb))
-                                             if self.cs_transformers[index] == tr_index) +
-                                 self.tr_loads[tr_index, i] +
-                                 self.tr_pv[tr_index, i] <=
-                                 self.tr_power_limit[tr_index, i]),
-                                name=f'constr5_{tr_index}_t{i}')
-                
-        for tr_index in range(self.number_of_transformers):
-            for i in range(self.control_horizon):
-                model.addConstr((gp.quicksum(u[j]
-                                             for index, j in enumerate(
-                                                 range(i*self.nb, (i+1)*self.nb))
-                                             if self.cs_transformers[index] == tr_index) +
-                                 self.tr_loads[tr_index, i] +
-                                 self.tr_pv[tr_index, i] >=
-                                 -self.tr_power_limit[tr_index, :].max()),
-                                name=f'constr5_{tr_index}_t{i}')
-
-        model.setObjective(f @ u - f @ CapF1, GRB.MINIMIZE)
-        model.setParam('OutputFlag', self.output_flag)
-        model.params.NonConvex = 2
-        
-        if self.MIPGap is not None:
-            model.params.MIPGap = self.MIPGap
-        model.params.TimeLimit = self.time_limit        
-        model.optimize()
-        self.total_exec_time += model.Runtime        
-            
-        if model.status == GRB.Status.INF_OR_UNBD or \
-                model.status == GRB.Status.INFEASIBLE:                  
-            print(f"INFEASIBLE (applying default actions) - step{t} !!!")                          
+        self.add_transformer_constraints(problem)
+
+        problem.set_objective({"u": f, "CapF1": -f})
+
+        result = self.solve(problem)
+
+        if result.x is None:
+            print(f"INFEASIBLE (applying default actions) - step{t} !!!")
             actions = np.ones(self.n_ports) * 0 #0.25
+            self.stop_timing()
             return actions
 
-        a = np.zeros((nb*h, 1))
-        # cap = np.zeros((nb*h, 1))
-
-        for i in range(self.n_ports):
-            a[i] = u[i].x
-            # cap[i] = CapF1[i].x
+        a = result.get("u")
+        # cap = result.get("CapF1")
 
         if self.verbose:
             print(f'Actions:\n {a.reshape(-1,self.n_ports)}')
@@ -317,9 +257,10 @@ class OCMF_G2V(MPC):
         # build normalized actions
         actions = np.zeros(self.n_ports)
         for i in range(self.n_ports):
-            actions[i] = a[i] / self.max_ch_power[i//2]
+            actions[i] = a[i] / self.max_ch_power[i]
         if self.verbose:
             print(f'actions: {actions.shape} \n {actions}')
 
         # input("Press Enter to continue...")
+        self.stop_timing()
         return actions
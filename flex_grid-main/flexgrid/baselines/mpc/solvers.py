@@ -0,0 +1,391 @@
+'''
+This file contains the solver backends used by the MPC baselines.
+
+The MPC models are built once as a mixed-integer linear problem in matrix form
+
+    min  c @ x
+    s.t. row_lb <= A @ x <= row_ub
+         lb <= x <= ub
+         x[integrality == 1] is integer
+
+and the selected backend translates it to Gurobi or to SciPy/HiGHS.
+
+Authors: Cesar Diaz-Londono, Stavros Orfanoudakis
+'''
+
+import time
+import numpy as np
+from scipy import sparse
+from scipy.optimize import milp, LinearConstraint, Bounds
+
+try:
+    import gurobipy as gp
+    from gurobipy import GRB
+except ImportError:
+    gp = None
+
+
+class MILP():
+    '''
+    Mixed-integer linear problem in matrix form.
+
+    Variables are added in named blocks and constraints are given as a dictionary
+    {variable block name: sparse matrix} with lower and upper row bounds.
+
+    For decomposed solving, groups holds the group (e.g. transformer) of every variable
+    and constraints added with coupling=True are the only ones linking the groups.
+    '''
+
+    def __init__(self, name="optimization_model"):
+        self.name = name
+        self.variables = {}
+        self.n_vars = 0
+
+        self._lb = []
+        self._ub = []
+        self._integrality = []
+        self._objective = {}
+        self._constraints = []
+        self._start = {}
+        self.groups = None
+
+    def add_variables(self, name, size, lb=0, ub=np.inf, binary=False):
+        '''
+        Adds a block of variables and returns its slice in the variable vector.
+        '''
+        assert name not in self.variables, f"Variables {name} already exist"
+
+        self.variables[name] = slice(self.n_vars, self.n_vars + size)
+        self.n_vars += size
+
+        if binary:
+            lb, ub = 0, 1
+        self._lb.append(np.broadcast_to(np.asarray(lb, dtype=float), size))
+        self._ub.append(np.broadcast_to(np.asarray(ub, dtype=float), size))
+        self._integrality.append(np.full(size, int(binary)))
+
+        return self.variables[name]
+
+    def add_constraints(self, terms, lb=-np.inf, ub=np.inf, coupling=False):
+        '''
+        Adds the constraints lb <= sum(terms[name] @ x[name]) <= ub.
+        '''
+        n_rows = next(iter(terms.values())).shape[0]
+        lb = np.broadcast_to(np.asarray(lb, dtype=float), n_rows)
+        ub = np.broadcast_to(np.asarray(ub, dtype=float), n_rows)
+
+        self._constraints.append((terms, lb, ub, coupling))
+
+    def coupling_rows(self):
+        '''
+        Returns a boolean mask of the rows of A (see build) that couple groups.
+        '''
+        return np.concatenate(
+            [np.full(len(lb), coupling) for _, lb, _, coupling in self._constraints]
+            + [np.zeros(0, dtype=bool)])
+
+    def set_objective(self, terms):
+        '''
+        Sets the (minimization) objective from a dictionary {variable block name: coefficients}.
+        '''
+        self._objective = terms
+
+    def set_start(self, name, values):
+        '''
+        Sets the initial (warm start) values of a block of variables.
+        '''
+        self._start[name] = values
+
+    def get_start(self):
+        '''
+        Returns the warm start vector, np.nan for variables without initial value.
+        '''
+        if not self._start:
+            return None
+
+        start = np.full(self.n_vars, np.nan)
+        for name, values in self._start.items():
+            start[self.variables[name]] = values
+        return start
+
+    def build(self):
+        '''
+        Returns the problem matrices (c, A, row_lb, row_ub, lb, ub, integrality).
+        '''
+        c = np.zeros(self.n_vars)
+        for name, coefficients in self._objective.items():
+            c[self.variables[name]] = coefficients
+
+        blocks = []
+        for terms, _, _, _ in self._constraints:
+            row = []
+            for name, var in self.variables.items():
+                size = var.stop - var.start
+                if name in terms:
+                    row.append(sparse.csr_matrix(terms[name]))
+                else:
+                    row.append(sparse.csr_matrix(
+                        (terms[next(iter(terms))].shape[0], size)))
+            blocks.append(row)
+
+        if blocks:
+            A = sparse.bmat(blocks, format='csr')
+            row_lb = np.concatenate([lb for _, lb, _, _ in self._constraints])
+            row_ub = np.concatenate([ub for _, _, ub, _ in self._constraints])
+        else:
+            A = sparse.csr_matrix((0, self.n_vars))
+            row_lb = row_ub = np.zeros(0)
+
+        return c, A, row_lb, row_ub, \
+            np.concatenate(self._lb), np.concatenate(self._ub), \
+            np.concatenate(self._integrality)
+
+
+class SolverResult():
+    '''
+    Solution of a MILP returned by the solver backends.
+
+    Attributes:
+        - status: one of "optimal", "suboptimal", "time_limit", "infeasible",
+          "unbounded", "not_converged" (decomposed solver) or "error"
+        - x: the solution vector, None if no feasible solution was found
+        - objective: the objective value of the solution
+        - build_time: time (s) spent building the model of the backend
+        - solve_time: time (s) spent by the backend solving the model
+    '''
+
+    def __init__(self, problem, status, x, objective, build_time, solve_time):
+        self.problem = problem
+        self.status = status
+        self.x = x
+        self.objective = objective
+        self.build_time = build_time
+        self.solve_time = solve_time
+
+    def get(self, name):
+        '''
+        Returns the values of a block of variables.
+        '''
+        return self.x[self.problem.variables[name]]
+
+
+class GurobiSolver():
+    '''
+    Solves the MILP with Gurobi using the matrix API.
+
+    If persistent is True, the Gurobi model is kept between calls and, as long as the
+    problem keeps the same structure (dimensions, variable types and constraint senses),
+    only the bounds, right-hand sides, objective and changed coefficients are updated
+    in place. Warm start values of the problem are passed as (MIP) start.
+    '''
+    name = "gurobi"
+
+    def __init__(self, time_limit=None, mip_gap=None, output_flag=0, threads=None,
+                 persistent=True, **kwargs):
+        if gp is None:
+            raise ImportError(
+                "gurobipy is not installed, use the 'highs' solver instead.")
+
+        self.time_limit = time_limit
+        self.mip_gap = mip_gap
+        self.output_flag = output_flag
+        self.threads = threads
+        self.persistent = persistent
+
+        self.model = None
+        self._structure = None
+
+    def _build_model(self, problem, c, A, row_lb, row_ub, lb, ub, integrality,
+                     upper, lower):
+        model = gp.Model(problem.name)
+        model.setParam('OutputFlag', self.output_flag)
+        if self.mip_gap is not None:
+            model.params.MIPGap = self.mip_gap
+        if self.time_limit is not None:
+            model.params.TimeLimit = self.time_limit
+        if self.threads is not None:
+            model.params.Threads = self.threads
+
+        vtype = np.where(integrality == 1, GRB.BINARY, GRB.CONTINUOUS)
+        self.x = model.addMVar(problem.n_vars, lb=lb, ub=ub, vtype=vtype, name="x")
+
+        self.constr_ub = None
+        self.constr_lb = None
+        if upper.any():
+            self.constr_ub = model.addConstr(A[upper] @ self.x <= row_ub[upper],
+                                             name="ub")
+        if lower.any():
+            self.constr_lb = model.addConstr(A[lower] @ self.x >= row_lb[lower],
+                                             name="lb")
+
+        model.setObjective(c @ self.x, GRB.MINIMIZE)
+        model.update()
+
+        self.model = model
+        self._A = A
+        self._vars = self.x.tolist()
+        # position of every row of A in the <= and >= constraints
+        self._rows_ub = np.cumsum(upper) - 1
+        self._rows_lb = np.cumsum(lower) - 1
+        self._constrs_ub = self.constr_ub.tolist() if self.constr_ub is not None else []
+        self._constrs_lb = self.constr_lb.tolist() if self.constr_lb is not None else []
+        self._upper = upper
+        self._lower = lower
+
+    def _update_model(self, c, A, row_lb, row_ub, lb, ub):
+        self.x.LB = lb
+        self.x.UB = ub
+        self.x.Obj = c
+
+        if self.constr_ub is not None:
+            self.constr_ub.RHS = row_ub[self._upper]
+        if self.constr_lb is not None:
+            self.constr_lb.RHS = row_lb[self._lower]
+
+        # only the coefficients that differ from the previous problem are changed
+        rows, cols = (A - self._A).nonzero()
+        values = np.asarray(A[rows, cols]).reshape(-1)
+        for r, j, value in zip(rows, cols, values):
+            if self._upper[r]:
+                self.model.chgCoeff(self._constrs_ub[self._rows_ub[r]],
+                                    self._vars[j], value)
+            if self._lower[r]:
+                self.model.chgCoeff(self._constrs_lb[self._rows_lb[r]],
+                                    self._vars[j], value)
+        self._A = A
+
+    def solve(self, problem):
+        timer = time.perf_counter()
+        c, A, row_lb, row_ub, lb, ub, integrality = problem.build()
+
+        upper = np.isfinite(row_ub)
+        lower = np.isfinite(row_lb)
+        structure = (A.shape, integrality.tobytes(),
+                     upper.tobytes(), lower.tobytes())
+
+        if self.persistent and self.model is not None and \
+                structure == self._structure:
+            self._update_model(c, A, row_lb, row_ub, lb, ub)
+        else:
+            if self.model is not None:
+                self.model.dispose()
+            self._build_model(problem, c, A, row_lb, row_ub, lb, ub, integrality,
+                              upper, lower)
+            self._structure = structure
+
+        start = problem.get_start()
+        if start is not None:
+            self.x.Start = np.where(np.isnan(start), GRB.UNDEFINED, start)
+        elif self.persistent:
+            self.x.Start = GRB.UNDEFINED
+
+        build_time = time.perf_counter() - timer
+
+        model = self.model
+        # the time limit can change between the solves of a persistent model
+        if self.time_limit is not None:
+            model.params.TimeLimit = self.time_limit
+        model.optimize()
+
+        if model.SolCount > 0:
+            solution = self.x.X
+            objective = model.ObjVal
+        else:
+            solution = None
+            objective = None
+
+        if model.status == GRB.Status.OPTIMAL:
+            status = "optimal"
+        elif model.status == GRB.Status.TIME_LIMIT:
+            status = "time_limit"
+        elif model.status in [GRB.Status.INFEASIBLE, GRB.Status.INF_OR_UNBD]:
+            status = "infeasible"
+        elif model.status == GRB.Status.UNBOUNDED:
+            status = "unbounded"
+        else:
+            status = "error"
+
+        result = SolverResult(problem, status, solution, objective,
+                              build_time, model.Runtime)
+
+        if not self.persistent:
+            self.model.dispose()
+            self.model = None
+
+        return result
+
+    def close(self):
+        '''
+        Releases the Gurobi model.
+        '''
+        if self.model is not None:
+            self.model.dispose()
+            self.model = None
+
+
+class HighsSolver():
+    '''
+    Solves the MILP with HiGHS through scipy.optimize.milp (no license required).
+
+    scipy.optimize.milp does not keep the model between calls and does not accept
+    initial solutions, so the problem is rebuilt and warm start values are ignored.
+    '''
+    name = "highs"
+
+    def __init__(self, time_limit=None, mip_gap=None, output_flag=0, **kwargs):
+        self.time_limit = time_limit
+        self.mip_gap = mip_gap
+        self.output_flag = output_flag
+
+    def solve(self, problem):
+        timer = time.perf_counter()
+        c, A, row_lb, row_ub, lb, ub, integrality = problem.build()
+
+        constraints = []
+        if A.shape[0] > 0:
+            constraints.append(LinearConstraint(A, row_lb, row_ub))
+
+        options = {'disp': bool(self.output_flag)}
+        if self.time_limit is not None:
+            options['time_limit'] = self.time_limit
+        if self.mip_gap is not None:
+            options['mip_rel_gap'] = self.mip_gap
+        build_time = time.perf_counter() - timer
+
+        timer = time.perf_counter()
+        res = milp(c,
+                   integrality=integrality,
+                   bounds=Bounds(lb, ub),
+                   constraints=constraints,
+                   options=options)
+        solve_time = time.perf_counter() - timer
+
+        status = {0: "optimal",
+                  1: "time_limit",
+                  2: "infeasible",
+                  3: "unbounded"}.get(res.status, "error")
+
+        objective = res.fun if res.x is not None else None
+
+        return SolverResult(problem, status, res.x, objective,
+                            build_time, solve_time)
+
+    def close(self):
+        pass
+
+
+SOLVERS = {
+    GurobiSolver.name: GurobiSolver,
+    HighsSolver.name: HighsSolver,
+}
+
+
+def get_solver(name="gurobi", **kwargs):
+    '''
+    Returns the solver backend with the given name ("gurobi" or "highs").
+    '''
+    if name not in SOLVERS:
+        raise ValueError(
+            f'Unknown solver {name}, available solvers: {list(SOLVERS)}')
+
+    return SOLVERS[name](**kwargs)
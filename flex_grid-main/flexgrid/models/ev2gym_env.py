@@ -14,6 +14,7 @@ import random
 from copy import deepcopy
 import yaml
 import json
+import inspect
 
 # from .grid import Grid
 from ev2gym.models.replay import EvCityReplay
@@ -23,7 +24,7 @@ from ev2gym.utilities.loaders import load_ev_spawn_scenarios, load_power_setpoin
 from ev2gym.visuals.render import Renderer
 
 from ev2gym.rl_agent.reward import SquaredTrackingErrorReward
-from ev2gym.rl_agent.state import PublicPST
+from ev2gym.rl_agent.state import PublicPST, GraphState
 
 
 class EV2Gym(gym.Env):
@@ -46,6 +47,9 @@ class EV2Gym(gym.Env):
                  extra_sim_name=None,
                  verbose=False,
                  render_mode=None,
+                 # whether to return a new observation array at every step, if False the state functions
+                 # that support it return their preallocated observation, which is updated in place
+                 copy_observations=True,
                  ):
 
         super(EV2Gym, self).__init__()
@@ -76,6 +80,8 @@ class EV2Gym(gym.Env):
 
         self.reward_function = reward_function
         self.state_function = state_function
+        self.copy_observations = copy_observations
+        self._observation_function = None
         self.cost_function = cost_function
 
         if seed is None:
@@ -244,6 +250,15 @@ class EV2Gym(gym.Env):
             print(f"Creating directory: ./results/{self.sim_name}")
             os.makedirs(f"./results/{self.sim_name}", exist_ok=True)
 
+        # Action mask: True if an EV is connected to the port, updated only on arrival and departure
+        self.port_offset = np.cumsum(
+            [0] + [cs.n_ports for cs in self.charging_stations])[:-1]
+        self.port_mask = np.zeros(self.number_of_ports, dtype=bool)
+        # MaskablePPO mask of the three-step discrete actions of every port (see mask_fn),
+        # the actions 1 and 2 are masked when the port is empty
+        self.discrete_action_mask = np.ones((self.number_of_ports, 3), dtype=bool)
+        self.discrete_action_mask[:, 1:] = False
+
         # Action space: is a vector of size "Sum of all ports of all charging stations"
         high = np.ones([self.number_of_ports])
         if self.config['v2g_enabled']:
@@ -253,11 +268,17 @@ class EV2Gym(gym.Env):
         self.action_space = spaces.Box(low=lows, high=high, dtype=np.float64)
 
         # Observation space: is a matrix of size ("Sum of all ports of all charging stations",n_features)
-        obs_dim = len(self._get_observation())
+        observation = self._get_observation()
+
+        if isinstance(observation, GraphState):
+            # the graph state functions have a dictionary of fixed size arrays
+            self.observation_space = self.graph_observation.observation_space
+        else:
+            obs_dim = len(observation)
 
-        high = np.inf*np.ones([obs_dim])
-        self.observation_space = spaces.Box(
-            low=-high, high=high, dtype=np.float64)
+            high = np.inf*np.ones([obs_dim])
+            self.observation_space = spaces.Box(
+                low=-high, high=high, dtype=np.float64)
 
         # Observation mask: is a vector of size ("Sum of all ports of all charging stations") showing in which ports an EV is connected
         self.observation_mask = np.zeros(self.number_of_ports)
@@ -284,6 +305,9 @@ class EV2Gym(gym.Env):
         for cs in self.charging_stations:
             cs.reset()
 
+        self.port_mask[:] = False
+        self.discrete_action_mask[:, 1:] = False
+
         for tr in self.transformers:
             tr.reset(step=self.current_step)
 
@@ -429,6 +453,8 @@ class EV2Gym(gym.Env):
                 self.discharge_prices[cs.id, self.current_step])
 
             self.departing_evs += ev
+            for EV in ev:
+                self._set_port_mask(self.port_offset[i] + EV.id, False)
 
             for u in user_satisfaction:
                 user_satisfaction_list.append(u)
@@ -453,6 +479,7 @@ class EV2Gym(gym.Env):
                 ev.reset()
                 ev.simulation_length = self.simulation_length
                 index = self.charging_stations[ev.location].spawn_ev(ev)
+                self._set_port_mask(self.port_offset[ev.location] + index, True)
 
                 if not self.lightweight_plots:
                     self.port_arrival[f'{ev.location}.{index}'].append(
@@ -505,12 +532,8 @@ class EV2Gym(gym.Env):
     def _check_termination(self, reward, cost):
         '''Checks if the episode is done or any constraint is violated'''
         truncated = False
-        action_mask = np.zeros(self.number_of_ports)
         # action mask is 1 if an EV is connected to the port
-        for i, cs in enumerate(self.charging_stations):
-            for j in range(cs.n_ports):
-                if cs.evs_connected[j] is not None:
-                    action_mask[i*cs.n_ports + j] = 1
+        action_mask = self.port_mask.astype(np.float64)
 
         # Check if the episode is done or any constraint is violated
         if self.current_step >= self.simulation_length or \
@@ -632,8 +655,34 @@ class EV2Gym(gym.Env):
         self.sim_date = self.sim_date + \
             datetime.timedelta(minutes=self.timescale)
 
+    def _set_port_mask(self, port, connected) -> None:
+        '''Updates the action masks of a port when an EV arrives or departs'''
+        self.port_mask[port] = connected
+        self.discrete_action_mask[port, 1:] = connected
+
+    def action_masks(self) -> np.ndarray:
+        '''
+        Returns the (n_ports, 3) MaskablePPO mask of the three-step discrete actions,
+        it is a read-only view that is updated in place at every step.
+        '''
+        mask = self.discrete_action_mask.view()
+        mask.setflags(write=False)
+        return mask
+
     def _get_observation(self):
+        '''
+        If copy_observations is False, the state functions of rl_agent.state that accept copy=False
+        return their preallocated observation, which is updated in place at the next step (a new one
+        is used for every episode). This is only safe for callers that copy the observation before the
+        next step, e.g. SharedMemoryVecEnv and scripts/generate_trajectories.py.
+        '''
+        if self.state_function is not self._observation_function:
+            self._observation_function = self.state_function
+            self._observation_in_place = 'copy' in inspect.signature(
+                self.state_function).parameters
 
+        if self._observation_in_place and not self.copy_observations:
+            return self.state_function(self, copy=False)
         return self.state_function(self)
 
     def set_cost_function(self, cost_function):
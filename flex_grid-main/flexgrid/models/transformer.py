@@ -75,6 +75,9 @@ class Transformer():
         else:
             self.dr_events = []
 
+        # padded forecast matrices of every horizon, see get_forecast_windows
+        self.forecast_windows = {}
+
     def generate_demand_response_events(self, env) -> None:
         '''
         This function is used to generate demand response events using the configuration file
@@ -145,8 +148,8 @@ class Transformer():
         The control algorithm is aware of the event x steps before it happens
 
         '''
-        known_max_power = max(self.max_power) * np.ones(horizon)
-        power_limit = max(self.max_power)
+        power_limit = self.max_power.max()
+        known_max_power = power_limit * np.ones(horizon)
 
         for event in self.dr_events:
             if step + self.steps_ahead >= event['event_start_step'] and \
@@ -168,20 +171,65 @@ class Transformer():
 
         return known_max_power
 
-    def get_load_pv_forecast(self, step, horizon) -> np.array:
+    def build_forecast_windows(self, horizon) -> dict:
+        '''
+        Build the padded (3, simulation_length + horizon) matrix with the inflexible load forecast,
+        the PV generation forecast and the power limits known by the control algorithm (see get_power_limits).
+        Steps after the end of the simulation are padded with zero loads and PV and the nominal power limit.
 
-        load_forecast = self.inflexible_load_forecast[step:step+horizon]
-        pv_forecast = self.pv_generation_forecast[step:step+horizon]
-        
-        if step < len(self.inflexible_load_forecast):                        
-            load_forecast[0] = self.inflexible_load[step]
-            pv_forecast[0] = self.solar_power[step]
+        The power limits of a window are the same as get_power_limits unless a demand response event
+        inside the window is not announced yet at its first step, these steps are marked as not exact.
+        '''
+        length = len(self.inflexible_load_forecast)
+        matrix = np.zeros((3, length + horizon))
+        matrix[0, :length] = self.inflexible_load_forecast
+        matrix[1, :length] = self.pv_generation_forecast
+
+        power_limit = self.max_power.max()
+        matrix[2, :] = power_limit
 
-        if len(load_forecast) < horizon:
-            load_forecast = np.append(load_forecast, np.zeros(horizon-len(load_forecast))
-                                      * self.inflexible_load_forecast[-1])
-            pv_forecast = np.append(pv_forecast, np.zeros(horizon-len(pv_forecast))
-                                    * self.pv_generation_forecast[-1])
+        exact = np.ones(length + horizon, dtype=bool)
+        for event in self.dr_events:
+            start = event['event_start_step']
+            end = event['event_end_step']
+            matrix[2, max(start, 0):max(end, 0)] = power_limit - \
+                power_limit * event['capacity_percentage'] / 100
+
+            # windows that include the event before it is announced
+            exact[max(start - horizon + 1, 0):max(min(start - self.steps_ahead, end), 0)] = False
+
+        return {'matrix': matrix, 'exact': exact}
+
+    def get_forecast_windows(self, step, horizon):
+        '''
+        Get the inflexible load forecast, PV generation forecast and known power limits of the next horizon steps.
+
+        The windows are read-only views of a padded matrix that is built once per horizon after every reset.
+        The load and PV of the first step are the actual values, as the current step is known.
+        '''
+        windows = self.forecast_windows.get(horizon)
+        if windows is None:
+            windows = self.build_forecast_windows(horizon)
+            self.forecast_windows[horizon] = windows
+
+        matrix = windows['matrix']
+        if step < len(self.inflexible_load_forecast):
+            matrix[0, step] = self.inflexible_load[step]
+            matrix[1, step] = self.solar_power[step]
+
+        window = matrix[:, step:step + horizon]
+        window.flags.writeable = False
+
+        if windows['exact'][step]:
+            power_limits = window[2]
+        else:
+            power_limits = self.get_power_limits(step, horizon)
+
+        return window[0], window[1], power_limits
+
+    def get_load_pv_forecast(self, step, horizon) -> np.array:
+
+        load_forecast, pv_forecast, _ = self.get_forecast_windows(step, horizon)
 
         return load_forecast, pv_forecast
 
@@ -259,6 +307,9 @@ class Transformer():
         '''
         self.current_step = step
 
+        if step == 0:
+            self.forecast_windows = {}
+
         self.current_power = self.inflexible_load[step] + \
             self.solar_power[step]
 
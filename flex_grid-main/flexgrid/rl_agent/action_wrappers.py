@@ -4,6 +4,8 @@ from gymnasium.spaces import MultiDiscrete, Discrete
 
 import numpy as np
 
+from ev2gym.baselines.heuristics import get_active_ports
+
 
 class BinaryAction(gym.ActionWrapper, gym.utils.RecordConstructorArgs):
     """
@@ -138,22 +140,206 @@ class ThreeStep_Action_DiscreteActionSpace(gym.ActionWrapper, gym.utils.RecordCo
         return np.where(action == 0, 0, np.where(action == 1, self.min_action, 1))
 
 
+def water_filling(values: np.ndarray, groups: np.ndarray, budgets: np.ndarray) -> np.ndarray:
+    """
+    Reduce the nonnegative values so that the sum of every group is at most its budget.
+
+    The values of a group over its budget become max(value - level, 0), with the lowest level that
+    meets the budget, which is the Euclidean projection onto the group constraint. The levels of all
+    groups are computed in closed form by sorting the values of every group.
+
+    Args:
+        values: The nonnegative values
+        groups: The group of every value, in range(len(budgets))
+        budgets: The maximum sum of every group
+
+    Returns:
+        The reduced values
+    """
+    n_groups = len(budgets)
+    budgets = np.maximum(budgets, 0)
+
+    over = np.bincount(groups, values, minlength=n_groups) > budgets
+    if not over.any():
+        return values
+
+    # the values of the groups over their budget, sorted by group and decreasing value
+    index = np.flatnonzero(over[groups] & (values > 0))
+    order = np.lexsort((-values[index], groups[index]))
+    index = index[order]
+    group = groups[index]
+    value = values[index]
+
+    counts = np.bincount(group, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+    cumulative = np.cumsum(value)
+    cumulative -= (cumulative - value)[starts[group]]
+    k = np.arange(len(value)) - starts[group] + 1
+
+    # the values that stay positive are the first n_positive of every group
+    n_positive = np.bincount(group, value * k > cumulative - budgets[group],
+                             minlength=n_groups).astype(int)
+
+    level = np.full(n_groups, np.inf)
+    filled = over & (n_positive > 0)
+    last = starts[filled] + n_positive[filled] - 1
+    level[filled] = (cumulative[last] - budgets[filled]) / n_positive[filled]
+
+    values = values.copy()
+    values[index] = np.maximum(value - level[group], 0)
+    return values
+
+
+class FeasibilityProjection(gym.ActionWrapper, gym.utils.RecordConstructorArgs):
+    '''
+    This class projects the actions onto the feasible set of the charging stations and transformers:
+        - the charge and discharge power limits of the EV of every port, ports without an EV get 0,
+        - the current limit of every charger, shared by its ports,
+        - the power limit of every transformer (Transformer.get_forecast_windows) minus its inflexible loads and PV,
+        - optionally, the power setpoint of the step as a limit of the total power.
+
+    At every level, the charging (or discharging) powers are reduced by water-filling (see water_filling),
+    so feasible actions are not changed. If the inflexible loads alone exceed the limit of a transformer,
+    its EVs stop charging but they are not discharged to compensate.
+    '''
+
+    def __init__(self, env: gym.Env, power_setpoint: bool = False):
+        """
+        Args:
+            env: The environment to apply the wrapper
+            power_setpoint: Whether the total power is limited by the power setpoint
+        """
+        assert isinstance(env.action_space, Box)
+
+        gym.utils.RecordConstructorArgs.__init__(self, power_setpoint=power_setpoint)
+        gym.ActionWrapper.__init__(self, env)
+
+        env = env.unwrapped
+        self.power_setpoint = power_setpoint
+        self.v2g = env.config['v2g_enabled']
+
+        # charger and transformer of every port
+        self.port_offset = []
+        port_cs = []
+        for cs in env.charging_stations:
+            self.port_offset.append(len(port_cs))
+            port_cs += [cs.id] * cs.n_ports
+        self.port_cs = np.array(port_cs)
+        self.port_transformer = np.array(
+            [cs.connected_transformer for cs in env.charging_stations])[self.port_cs]
+        self.n_cs = len(env.charging_stations)
+        self.n_transformers = len(env.transformers)
+
+        # charge and discharge power of every port with action 1 and -1 in kW
+        self.charge_power = np.array(
+            [cs.get_max_power() for cs in env.charging_stations])[self.port_cs]
+        self.discharge_power = np.abs(np.array(
+            [cs.get_min_power() for cs in env.charging_stations]))[self.port_cs]
+
+        self.reset_ports(env)
+
+    def reset_ports(self, env) -> None:
+        '''
+        This function clears the action limits of the ports, it is called again if the environment is reset.
+        '''
+        self.evs = [None] * env.number_of_ports
+        self.max_action = np.zeros(env.number_of_ports)
+        self.min_action = np.zeros(env.number_of_ports)
+        # number of env.EVs already seen
+        self.n_seen = 0
+        self.current_step = env.current_step
+
+    def update_ports(self, env) -> None:
+        '''
+        This function updates the action limits of the ports where EVs arrived or departed in the last step.
+        '''
+        if env.current_step < self.current_step or len(env.EVs) < self.n_seen:
+            self.reset_ports(env)
+        self.current_step = env.current_step
+
+        for EV in getattr(env, 'departing_evs', []):
+            port = self.port_offset[EV.location] + EV.id
+            if self.evs[port] is EV:
+                self.evs[port] = None
+                self.max_action[port] = 0
+                self.min_action[port] = 0
+
+        for EV in env.EVs[self.n_seen:]:
+            if env.charging_stations[EV.location].evs_connected[EV.id] is not EV:
+                continue
+            port = self.port_offset[EV.location] + EV.id
+            self.evs[port] = EV
+            self.max_action[port] = min(1, EV.max_ac_charge_power / self.charge_power[port])
+            if self.v2g and self.discharge_power[port] > 0:
+                self.min_action[port] = -min(1, abs(EV.max_discharge_power) /
+                                             self.discharge_power[port])
+        self.n_seen = len(env.EVs)
+
+    def action(self, action: np.ndarray) -> np.ndarray:
+        """
+        Project the action onto the feasible set.
+
+        Args:
+            action: The action of the agent
+
+        Returns:
+            The feasible action
+        """
+        env = self.env.unwrapped
+        t = env.current_step
+        self.update_ports(env)
+
+        action = np.clip(action, self.min_action, self.max_action)
+
+        # the ports of a charger share its current limit
+        cs_limit = np.ones(self.n_cs)
+        charge = water_filling(np.maximum(action, 0), self.port_cs, cs_limit)
+        discharge = water_filling(np.maximum(-action, 0), self.port_cs, cs_limit)
+
+        # in kW
+        charge = charge * self.charge_power
+        discharge = discharge * self.discharge_power
+
+        # power limit and inflexible loads with PV of every transformer
+        power_limit = np.zeros(self.n_transformers)
+        base_load = np.zeros(self.n_transformers)
+        for i, tr in enumerate(env.transformers):
+            loads, pv, power_limits = tr.get_forecast_windows(step=t, horizon=1)
+            power_limit[i] = power_limits[0]
+            base_load[i] = loads[0] + pv[0]
+
+        # the charging and discharging powers are limited separately, an EV may charge or discharge
+        # less than its action (e.g. full or empty battery), which must not cause an overload
+        charge = water_filling(charge, self.port_transformer, power_limit - base_load)
+        discharge = water_filling(discharge, self.port_transformer, power_limit + base_load)
+
+        if self.power_setpoint:
+            charge = water_filling(charge, np.zeros(len(charge), dtype=int),
+                                   np.array([env.power_setpoints[t]]))
+
+        feasible = charge / self.charge_power
+        feasible -= np.divide(discharge, self.discharge_power,
+                              out=np.zeros_like(discharge),
+                              where=self.discharge_power > 0)
+        return feasible
+
+
 def mask_fn(env: gym.Env) -> np.ndarray:
     """
     Create a mask for the action space to mask the actions that are not available.
     For example, if an EV is not connected to a charging station, then the action to charge the EV is not available.
-    """
 
-    mask = np.ones((env.action_space.nvec.shape[0], 3))
+    The mask is kept up to date by the environment on arrival and departure, this returns a read-only view of it.
+    """
+    return env.unwrapped.action_masks()
 
-    counter = 0
-    for cs in env.charging_stations:
-        for EV in cs.evs_connected:
-            if EV is None:
-                mask[counter, 1:] = [0] * (env.action_space.nvec[counter] - 1)
-            counter += 1
 
-    return mask
+def stack_action_masks(envs, out=None) -> np.ndarray:
+    """
+    Stack the action masks (see mask_fn) of N environments with the same number of ports
+    in a (N, n_ports, 3) array, out can be a preallocated array reused at every step.
+    """
+    return np.stack([env.unwrapped.action_masks() for env in envs], out=out)
 
 
 class Rescale_RepairLayer(gym.ActionWrapper, gym.utils.RecordConstructorArgs):
@@ -195,63 +381,58 @@ class Rescale_RepairLayer(gym.ActionWrapper, gym.utils.RecordConstructorArgs):
             print(f'Min action: {self.min_action}')
 
         self.number_of_ports_per_cs = env.number_of_ports_per_cs
-        # list with the ids of EVs that were already served in this round
-        self.ev_buffer = []
-        self.min_power = []
-        self.max_power = []
 
-        self.occupied_ports = [0] * env.number_of_ports
+        # per port arrays, a port is in the buffer if its EV is connected and not fully charged
+        self.occupied_ports = np.zeros(env.number_of_ports, dtype=bool)
+        # min and max power of the EV of every port, set when it joins the buffer
+        self.min_power = np.zeros(env.number_of_ports)
+        self.max_power = np.zeros(env.number_of_ports)
+        # order in which the ports joined the buffer, the newest EVs are first in the buffer
+        self.buffer_rank = np.zeros(env.number_of_ports, dtype=np.int64)
+        self.n_added = 0
+
+        self.ports = [(cs, port) for cs in env.charging_stations
+                      for port in range(cs.n_ports)]
+
+    @property
+    def ev_buffer(self) -> np.ndarray:
+        '''
+        The ports in the buffer, the newest EVs first.
+        '''
+        ports = np.flatnonzero(self.occupied_ports)
+        return ports[np.argsort(self.buffer_rank[ports], kind='stable')]
 
     def update_ev_buffer(self, env) -> None:
         '''
-        This function updates the EV buffer list with the EVs that are currently parked by adding or removing them.
+        This function updates the EV buffer with the EVs that are currently parked by adding or removing them.
         '''
-        counter = 0
-        # iterate over all ports
-        for cs in env.charging_stations:
-            for port in range(cs.n_ports):
-                if cs.evs_connected[port] is not None:
-                    if cs.evs_connected[port].get_soc() < 1:
-
-                        if counter not in self.ev_buffer:
-                            self.ev_buffer.insert(0, counter)
-                            min_power = max(cs.get_min_charge_power(
-                            ), cs.evs_connected[port].min_ac_charge_power)
-                            self.min_power.insert(0, min_power)
-                            max_power = min(
-                                cs.get_max_power(), cs.evs_connected[port].max_ac_charge_power)
-                            self.max_power.insert(0, max_power)
-
-                            self.occupied_ports[counter] = 1
-                    else:
-                        if counter in self.ev_buffer:
-                            # find index of the EV in the buffer
-                            index = self.ev_buffer.index(counter)
-                            self.ev_buffer.remove(counter)
-                            self.min_power.pop(index)
-                            self.max_power.pop(index)
-                            self.occupied_ports[counter] = 0
-
-                else:
-                    if counter in self.ev_buffer:
-                        index = self.ev_buffer.index(counter)
-                        self.ev_buffer.remove(counter)
-                        self.min_power.pop(index)
-                        self.max_power.pop(index)
-                        self.occupied_ports[counter] = 0
+        active = get_active_ports(env)
+        added = np.flatnonzero(active & ~self.occupied_ports)
 
-                counter += 1
+        for counter in added.tolist():
+            cs, port = self.ports[counter]
+            self.min_power[counter] = max(cs.get_min_charge_power(),
+                                          cs.evs_connected[port].min_ac_charge_power)
+            self.max_power[counter] = min(cs.get_max_power(),
+                                          cs.evs_connected[port].max_ac_charge_power)
+
+        # ports added in the same step are inserted in order, so the last one is the first in the buffer
+        self.buffer_rank[added] = -(self.n_added + np.arange(1, len(added) + 1))
+        self.n_added += len(added)
+
+        self.occupied_ports = active
 
     def calculate_total_power(self, action: np.ndarray) -> float:
         '''
-        This function calculates the total power that is requested by the EVs in the buffer list.
+        This function calculates the total power that is requested by the EVs in the buffer.
         '''
-        total_power = 0
-        for i in self.ev_buffer:
-            total_power += np.clip(action[i] * self.max_cs_power[i], self.min_power[self.ev_buffer.index(
-                i)], self.max_power[self.ev_buffer.index(i)])
+        return self.clip_power(action)[self.occupied_ports].sum()
 
-        return total_power
+    def clip_power(self, action: np.ndarray) -> np.ndarray:
+        '''
+        This function returns the power of every port for the action, clipped to the min and max power of its EV.
+        '''
+        return np.clip(action * self.max_cs_power, self.min_power, self.max_power)
 
     def rescale_actions(self, actions, min_action):
         """
@@ -276,8 +457,6 @@ class Rescale_RepairLayer(gym.ActionWrapper, gym.utils.RecordConstructorArgs):
 
     def action(self, action: np.ndarray) -> np.ndarray:
 
-        # this function returns the action list based on the round robin algorithm
-
         # in W
         power_setpoint = self.env.power_setpoints[self.env.current_step]
 
@@ -299,39 +478,26 @@ class Rescale_RepairLayer(gym.ActionWrapper, gym.utils.RecordConstructorArgs):
 
         # get currently parked EVs
         self.update_ev_buffer(self.env)
+        buffer = self.occupied_ports
 
-        current_action_power = self.calculate_total_power(action)
-        total_power_potential = sum(self.min_power)
+        # clamp proposed power to the minimum and maximum power for each EV
+        proposed_power = self.clip_power(action)
+        current_action_power = proposed_power[buffer].sum()
 
         if self.verbose:
             print(f'Current action power: {current_action_power:.2f} kW')
             print(f'EV buffer: {self.ev_buffer}')
-            print(f'Min power: {[round(a, 2) for a in self.min_power]}')
-            print(f'Max power: {[round(a, 2) for a in self.max_power]}')
+            print(f'Min power: {self.min_power[self.ev_buffer].round(2)}')
+            print(f'Max power: {self.max_power[self.ev_buffer].round(2)}')
 
         if current_action_power < power_setpoint:
 
-            total_power_potential = current_action_power
-
             # Calculate the deficit in power that needs to be increased
-            power_deficit = power_setpoint - total_power_potential + self.threshold
-
-            # Calculate the proposed power for each EV based on current action
-            proposed_power = np.zeros(len(self.ev_buffer))
-
-            for index, i in enumerate(self.ev_buffer):
-                # print(f'EV: {i} | Action: {action[i]} | Max power: {self.max_power[index]}')
-                # clamp proposed power to the minimum and maximum power for each EV
-                proposed_power[index] = np.clip(
-                    action[i] * self.max_cs_power[i], self.min_power[index], self.max_power[index])
-
-            if self.verbose:
-                print(f"Proposed power before increase: {proposed_power}")
+            power_deficit = power_setpoint - current_action_power + self.threshold
 
             # Calculate the available power range (up to the maximum power)
-            ev_power_range = [self.max_power[i] - proposed_power[i]
-                              for i in range(len(self.ev_buffer))]
-            total_power_range = sum(ev_power_range)
+            ev_power_range = self.max_power - proposed_power
+            total_power_range = ev_power_range[buffer].sum()
 
             # If the total power range is zero (all EVs already at max power), no adjustment is needed
             if total_power_range > 0:
@@ -339,116 +505,56 @@ class Rescale_RepairLayer(gym.ActionWrapper, gym.utils.RecordConstructorArgs):
                 increase_factor = min(1, power_deficit / total_power_range)
 
                 # Increase the power of each EV proportionally up to their max_power
-                for i in range(len(self.ev_buffer)):
-                    power_to_increase = ev_power_range[i] * increase_factor
-                    new_power = proposed_power[i] + power_to_increase
-
-                    # Ensure the new power does not exceed the max power for each EV
-                    proposed_power[i] = min(new_power, self.max_power[i])
-
-            # After adjustment, calculate the new total power
-            total_power_potential = sum(proposed_power)
-
-            # Reflect the changes to the actions by scaling them between (min_power, 1)
-            new_actions = []
-            for i in range(len(self.ev_buffer)):
-                # Scale the proposed power between (min_power[i], max_power[i])
-                new_actions.append(proposed_power[i] / self.max_cs_power[i])
-
-            if self.verbose:
-                print(f"New proposed power for each EV: {proposed_power}")
-                print(f'Final power used: {total_power_potential:.2f} kW')
-                print(f"New actions: {[round(a, 2) for a in new_actions]}")
-
-            # Update the actions for each EV in the action dictionary
-            for i in range(len(self.ev_buffer)):
-                action[self.ev_buffer[i]] = new_actions[i]
-
-            if self.verbose:
-                print(
-                    f"Final actions vector: {[round(a, 2) for a in action * self.occupied_ports]}")
-
-            return action * self.occupied_ports
+                proposed_power = np.minimum(proposed_power + ev_power_range * increase_factor,
+                                            self.max_power)
 
         elif current_action_power + self.threshold > power_setpoint:
 
-            total_power_potential = current_action_power
-
             # Calculate the excess power that needs to be reduced
-            excess_power = total_power_potential - power_setpoint + self.threshold
-
-            proposed_power = np.zeros(len(self.ev_buffer))
-
-            # Calculate the proposed power for each EV
-            for index, i in enumerate(self.ev_buffer):
-                # print(f'EV: {i} | Action: {action[i]} | Max power: {self.max_power[index]}')
-                proposed_power[index] = np.clip(
-                    action[i] * self.max_cs_power[i], self.min_power[index], self.max_power[index])
-
-            if self.verbose:
-                print(
-                    f"Proposed power before adjustment: {[round(p, 2) for p in proposed_power]}")
+            excess_power = current_action_power - power_setpoint + self.threshold
 
             # Proportionally reduce the charging power of all selected EVs
-            ev_power_range = [p - min_p for p,
-                              min_p in zip(proposed_power, self.min_power)]
-            total_power_range = sum(ev_power_range)
+            ev_power_range = proposed_power - self.min_power
+            total_power_range = ev_power_range[buffer].sum()
 
             if total_power_range > 0:
                 # Proportional reduction factor based on available power range
                 reduction_factor = min(1, excess_power / total_power_range)
 
                 # Reduce the power of each EV proportionally up to their min_power
-                for i in range(len(self.ev_buffer)):
-                    power_to_reduce = ev_power_range[i] * reduction_factor
-                    new_power = proposed_power[i] - power_to_reduce
-
-                    # Ensure the new power does not go below the minimum power for each EV
-                    proposed_power[i] = max(new_power, self.min_power[i])
+                proposed_power = np.maximum(proposed_power - ev_power_range * reduction_factor,
+                                            self.min_power)
 
             # After initial adjustment, check if the new total power is still lower than the power setpoint
-            total_power_potential = sum(proposed_power)
-            remaining_deficit = power_setpoint - total_power_potential + self.threshold
-
-            if remaining_deficit > 0:  # If there is still a deficit in power, try to increase
-                for i in range(len(self.ev_buffer)):
-                    if remaining_deficit <= 0:
-                        break  # If we've increased the power to meet the setpoint, stop
-                    # Try increasing power, but not above max_power
-                    increaseable_amount = self.max_power[i] - proposed_power[i]
-                    increase = min(remaining_deficit, increaseable_amount)
-                    proposed_power[i] += increase
-                    remaining_deficit -= increase
-
-            # Final recalculation of total power after all adjustments
-            total_power_potential = sum(proposed_power)
-
-            # Reflect the changes to the actions by scaling them between (min_power, 1)
-            new_actions = []
-            for i in range(len(self.ev_buffer)):
-                new_actions.append(proposed_power[i] / self.max_cs_power[i])
-
-            if self.verbose:
-                print(
-                    f"-- Final proposed power: {[round(p, 2) for p in proposed_power]}")
-                print(f'Final power used: {total_power_potential:.2f} kW')
-                print(f"New actions: {[round(a, 2) for a in new_actions]}")
-
-            for i in range(len(self.ev_buffer)):
-                action[self.ev_buffer[i]] = new_actions[i]
+            remaining_deficit = power_setpoint - \
+                proposed_power[buffer].sum() + self.threshold
+
+            if remaining_deficit > 0:
+                # increase the power of the EVs in buffer order until the deficit is covered,
+                # but not above max_power
+                ev_buffer = self.ev_buffer
+                increaseable_amount = self.max_power[ev_buffer] - proposed_power[ev_buffer]
+                previous = np.cumsum(increaseable_amount) - increaseable_amount
+                proposed_power[ev_buffer] += np.clip(remaining_deficit - previous,
+                                                     0, increaseable_amount)
 
-            if self.verbose:
-                print(
-                    f"Final actions vector: {[round(a, 2) for a in action * self.occupied_ports]}")
-
-            return action * self.occupied_ports
         else:
             # no change needed
 
             if self.verbose:
                 print(f'Final power used: {current_action_power:.2f} kW')
 
-            return action * self.occupied_ports
+            return action * buffer
+
+        # Reflect the changes to the actions by scaling them between (min_power, 1)
+        action[buffer] = proposed_power[buffer] / self.max_cs_power[buffer]
+
+        if self.verbose:
+            print(f"New proposed power for each EV: {proposed_power[self.ev_buffer]}")
+            print(f'Final power used: {proposed_power[buffer].sum():.2f} kW')
+            print(f"Final actions vector: {[round(a, 2) for a in action * buffer]}")
+
+        return action * buffer
 
 
 class MinMax_RepairLayer(gym.ActionWrapper, gym.utils.RecordConstructorArgs):
@@ -459,27 +565,47 @@ class MinMax_RepairLayer(gym.ActionWrapper, gym.utils.RecordConstructorArgs):
     In case of draw, the EV with the highest SOC will be given the maximum power.
     '''
 
-    def __init__(self, env, verbose=False,  **kwargs):
-        raise NotImplementedError("MinMax_RepairLayer is not implemented yet!!!!")
+    def __init__(self, env: gym.Env, verbose=False, **kwargs):
+        """
+        Args:
+            env: The environment to apply the wrapper
+            verbose: Whether to print debug information
+        """
+        assert isinstance(env.action_space, Box)
+
+        gym.utils.RecordConstructorArgs.__init__(self, verbose=verbose)
+        gym.ActionWrapper.__init__(self, env)
+
         self.verbose = verbose
         self.env = env
         # find average charging power of the simulation
         epsilon = 1e-4
+
+        # initialize the min_action list
+        self.min_action = np.zeros(env.action_space.shape)
         self.max_cs_power = np.zeros(env.action_space.shape)
 
+        assert (env.number_of_ports_per_cs ==
+                1), "This class is only implemented for one port per charging station"
+
         for i, cs in enumerate(env.charging_stations):
-            self.min_action = cs.min_charge_current / cs.max_charge_current + epsilon
+            self.min_action[i] = cs.min_charge_current / \
+                cs.max_charge_current + epsilon
             self.max_cs_power[i] = cs.get_max_power()
 
         self.number_of_ports_per_cs = env.number_of_ports_per_cs
-        # list with the ids of EVs that were already served in this round
-        self.ev_buffer = []
-        self.min_power = []
-        self.max_power = []
+
+        # per port arrays, a port is in the buffer if its EV is connected and not fully charged
+        self.occupied_ports = np.zeros(env.number_of_ports, dtype=bool)
+        # min and max power of the EV of every port, set when it joins the buffer
+        self.min_power = np.zeros(env.number_of_ports)
+        self.max_power = np.zeros(env.number_of_ports)
+        self.ports = [(cs, port) for cs in env.charging_stations
+                      for port in range(cs.n_ports)]
 
     def get_env(self):
         return self.env
-    
+
     def rescale_actions(self, actions, min_action):
         """
         Rescale actions from interval (0, 1) to (min_action, 1) for each corresponding action.
@@ -503,42 +629,33 @@ class MinMax_RepairLayer(gym.ActionWrapper, gym.utils.RecordConstructorArgs):
 
     def update_ev_buffer(self, env) -> None:
         '''
-        This function updates the EV buffer list with the EVs that are currently parked by adding or removing them.
+        This function updates the EV buffer with the EVs that are currently parked by adding or removing them.
         '''
-        counter = 0
-        # iterate over all ports
-        for cs in env.charging_stations:
-            for port in range(cs.n_ports):
-                if cs.evs_connected[port] is not None:
-                    if cs.evs_connected[port].get_soc() < 1:
-
-                        if counter not in self.ev_buffer:
-                            self.ev_buffer.insert(0, counter)
-                            min_power = max(cs.get_min_charge_power(
-                            ), cs.evs_connected[port].min_ac_charge_power)
-                            self.min_power.insert(0, min_power)
-                            max_power = min(
-                                cs.get_max_power(), cs.evs_connected[port].max_ac_charge_power)
-                            self.max_power.insert(0, max_power)
-                    else:
-                        if counter in self.ev_buffer:
-                            # find index of the EV in the buffer
-                            index = self.ev_buffer.index(counter)
-                            self.ev_buffer.remove(counter)
-                            self.min_power.pop(index)
-                            self.max_power.pop(index)
-
-                else:
-                    if counter in self.ev_buffer:
-                        index = self.ev_buffer.index(counter)
-                        self.ev_buffer.remove(counter)
-                        self.min_power.pop(index)
-                        self.max_power.pop(index)
-                counter += 1
+        active = get_active_ports(env)
+        added = np.flatnonzero(active & ~self.occupied_ports)
+
+        for counter in added.tolist():
+            cs, port = self.ports[counter]
+            self.min_power[counter] = max(cs.get_min_charge_power(),
+                                          cs.evs_connected[port].min_ac_charge_power)
+            self.max_power[counter] = min(cs.get_max_power(),
+                                          cs.evs_connected[port].max_ac_charge_power)
+
+        self.occupied_ports = active
+
+    def priority_order(self, action: np.ndarray) -> np.ndarray:
+        '''
+        This function returns the ports in the buffer sorted by decreasing action, draws are
+        sorted by decreasing SOC of the EV.
+        '''
+        ports = np.flatnonzero(self.occupied_ports)
+        soc = np.array([self.ports[port][0].evs_connected[self.ports[port][1]].get_soc()
+                        for port in ports.tolist()])
+        return ports[np.lexsort((-soc, -action[ports]))]
 
     def action(self, action: np.ndarray) -> np.ndarray:
 
-        # this function returns the action list based on the round robin algorithm
+        # this function returns the action list based on the min max algorithm
 
         power_setpoint = self.env.power_setpoints[self.env.current_step]  # in W
 
@@ -546,60 +663,49 @@ class MinMax_RepairLayer(gym.ActionWrapper, gym.utils.RecordConstructorArgs):
             print("-------------------MinMax RepairLayer -------------------")
             print(f'Power setpoint: {power_setpoint:.2f} kW')
 
+        # rescaled actions
+        action = self.rescale_actions(action, self.min_action)
+
         # get currently parked EVs
         self.update_ev_buffer(self.env)
+        ev_buffer = self.priority_order(action)
 
         if self.verbose:
-            print(f'EV buffer: {self.ev_buffer}')
-            print(f'Min power: {self.min_power}')
-            print(f'Max power: {self.max_power}')
-
-        total_power_potential = sum(self.min_power)
-
-        evs_to_charge = []
-        temp_ev_buffer = self.ev_buffer.copy()
-        counter = 0
-        for EV in temp_ev_buffer:
-            next_power = self.max_power[temp_ev_buffer.index(EV)] - \
-                self.min_power[temp_ev_buffer.index(EV)]
-
-            if total_power_potential > power_setpoint:
-                break
-            total_power_potential += next_power
-            counter += 1
-
-        # get the EVs to charge in this round
-        evs_to_charge = self.ev_buffer[:counter]
-        min_power = self.min_power[:counter]
-        max_power = self.max_power[:counter]
-
-        self.ev_buffer = self.ev_buffer[counter:]
-        self.min_power = self.min_power[counter:]
-        self.max_power = self.max_power[counter:]
-
-        self.ev_buffer.extend(evs_to_charge)
-        self.min_power.extend(min_power)
-        self.max_power.extend(max_power)
-
-        # create action list
+            print(f'EV buffer: {ev_buffer}')
+            print(f'Min power: {self.min_power[ev_buffer]}')
+            print(f'Max power: {self.max_power[ev_buffer]}')
+
+        # every EV gets its minimum power, then the EVs with the highest actions get their
+        # maximum power until the power setpoint is reached
+        min_power_total = self.min_power[ev_buffer].sum()
+        increaseable_amount = self.max_power[ev_buffer] - self.min_power[ev_buffer]
+        total_power_potential = min_power_total + np.cumsum(increaseable_amount)
+        previous = total_power_potential - increaseable_amount
+        counter = np.count_nonzero(previous <= power_setpoint)
+
+        evs_to_charge = ev_buffer[:counter]
+        if counter > 0:
+            total_power_potential = total_power_potential[counter - 1]
+        else:
+            total_power_potential = min_power_total
 
         if self.verbose:
             print(f'Final power used: {total_power_potential}')
 
-        action_list = np.ones(self.env.number_of_ports) * self.min_action
+        # create action list
+        action_list = np.zeros(self.env.number_of_ports)
+        action_list[ev_buffer] = self.min_power[ev_buffer] / self.max_cs_power[ev_buffer]
 
         # set the action for the EVs to charge
-        for i, ev in enumerate(evs_to_charge):
-
-            if i == len(evs_to_charge) - 1 and total_power_potential >= power_setpoint:
-                if total_power_potential - power_setpoint < 0:
-                    break
-                action_list[ev] = 1 - (total_power_potential -
-                                       power_setpoint) / self.max_cs_power[ev]
-            else:
-                action_list[ev] = 1
+        action_list[evs_to_charge] = self.max_power[evs_to_charge] / \
+            self.max_cs_power[evs_to_charge]
+        if counter > 0 and total_power_potential > power_setpoint:
+            # the last EV charges only the power missing to reach the setpoint
+            ev = evs_to_charge[-1]
+            action_list[ev] -= (total_power_potential -
+                                power_setpoint) / self.max_cs_power[ev]
 
         if self.verbose:
             print(f'Evs to charge: {evs_to_charge}')
             print(f'Action list: {action_list}')
-        return action_list
\ No newline at end of file
+        return action_list
@@ -3,7 +3,7 @@ from gymnasium.spaces import Box
 from gymnasium.spaces import MultiDiscrete, Discrete
 from gymnasium.core import WrapperObsType, ActType, ObsType
 
-from ev2gym.rl_agent.state import PublicPST
+from ev2gym.rl_agent.state import PublicPST, PublicPST_GNN
 
 from copy import deepcopy
 import numpy as np
@@ -74,10 +74,11 @@ class DelayedObservation(
         gym.ObservationWrapper.__init__(self, env)
 
         assert p_delay >= 0 and p_delay <= 1, "p_fail must be between 0 and 1"
-        assert env.unwrapped.observation_space.shape is not None                
+        assert env.unwrapped.state_function is PublicPST_GNN or \
+            env.unwrapped.observation_space.shape is not None
         
-        assert env.unwrapped.state_function is PublicPST, \
-            f"The state function must be PublicPST for this wrapper to work. It was found to be: {env.unwrapped.state_function}"        
+        assert env.unwrapped.state_function in [PublicPST, PublicPST_GNN], \
+            f"The state function must be PublicPST or PublicPST_GNN for this wrapper to work. It was found to be: {env.unwrapped.state_function}"        
         
         if env.unwrapped.state_function is PublicPST:
             self.GNN_state = False
@@ -114,6 +115,8 @@ class DelayedObservation(
         """Normalises the observation using the running mean and variance of the observations."""
 
         step = self.env.unwrapped.current_step
+        # the environment updates its observation in place, so the delayed one is a copy
+        observation = observation.copy()
         
         not_communicated_energy_usage = 0                  
         
@@ -139,6 +142,9 @@ class DelayedObservation(
                 
             
             for i, ev_features in enumerate(observation.ev_features):
+                # the rows of the empty ports are padding
+                if not observation.ev_mask[i]:
+                    continue
                 action_index = observation.action_mapper[i]
                 if self.random[action_index, step] < self.p_delay:
                     if action_index in self.previous_obs_list.action_mapper:
@@ -1,213 +1,466 @@
 '''  This file contains various example state functions for the RL agent '''
 import math
 import numpy as np
+from gymnasium import spaces
 
 
-def PublicPST(env, *args):
+class ObservationLayout():
+    '''
+    This class contains the compiled layout of a state function, computed once per environment.
+
+    The observation is: the header features, and then for every transformer its features followed by
+    the features of every port of the charging stations connected to it. The layout stores the offset
+    of every block and a preallocated buffer that the state function fills in place.
+
+    The connected EVs are tracked incrementally: only the ports where EVs arrived or departed in the
+    last step are updated, and the features of an empty port are zeroed only once, when its EV departs.
+    The state functions must call update_ports before writing in the buffer, a new buffer is used
+    for every episode.
+    '''
+
+    def __init__(self, env, state_function, n_header, n_tr_features, n_ev_features):
+
+        self.state_function = state_function
+        self.n_header = n_header
+        self.n_tr_features = n_tr_features
+        self.n_ev_features = n_ev_features
+
+        # offset of the features of every transformer
+        self.tr_offsets = []
+        # (charging station index, offset of its first port) grouped by transformer
+        self.cs_offsets = []
+
+        offset = n_header
+        for tr in env.transformers:
+            self.tr_offsets.append(offset)
+            offset += n_tr_features
+
+            for i, cs in enumerate(env.charging_stations):
+                if cs.connected_transformer == tr.id:
+                    self.cs_offsets.append((i, offset))
+                    offset += cs.n_ports * n_ev_features
+
+        self.buffer = np.zeros(offset)
+
+        # indices of the features of every port, in the order of the actions
+        self.port_offset = np.cumsum([0] + [cs.n_ports for cs in env.charging_stations])[:-1]
+        self.port_indices = np.zeros((env.number_of_ports, n_ev_features), dtype=np.int64)
+        for i, offset in self.cs_offsets:
+            for j in range(env.charging_stations[i].n_ports):
+                self.port_indices[self.port_offset[i] + j] = offset + j * n_ev_features + \
+                    np.arange(n_ev_features)
+
+        self.current_step = None
+
+    def reset_ports(self, env) -> None:
+        '''
+        This function reads the connected EVs of every port, it is called again if the environment is
+        reset or if the state function was not called at every step.
+        '''
+        self.evs = [None] * env.number_of_ports
+        self.connected = np.zeros(env.number_of_ports, dtype=bool)
+        self.arrival = np.zeros(env.number_of_ports)
+        self.departure = np.zeros(env.number_of_ports)
+
+        if env.current_step == 0:
+            # a new episode gets a new buffer, so the last observation of the previous
+            # episode (e.g. a terminal observation kept by a vectorized environment) is not overwritten
+            self.buffer = np.zeros_like(self.buffer)
+        else:
+            self.buffer[self.port_indices] = 0
+
+        for i, cs in enumerate(env.charging_stations):
+            for j, EV in enumerate(cs.evs_connected):
+                if EV is not None:
+                    self.connect(self.port_offset[i] + j, EV)
+
+        self.arrived = np.flatnonzero(self.connected)
+        # all the ports were read again, e.g. in a new episode
+        self.full_update = True
+        self.n_seen = len(getattr(env, 'EVs', []))
+        self.current_step = env.current_step
+
+    def connect(self, port, EV) -> None:
+        self.evs[port] = EV
+        self.connected[port] = True
+        self.arrival[port] = EV.time_of_arrival
+        self.departure[port] = EV.time_of_departure
+
+    def update_ports(self, env) -> np.ndarray:
+        '''
+        This function updates the ports where EVs arrived or departed in the last step, the features of
+        the ports that became empty are zeroed. The ports of the new EVs are kept in arrived.
+
+        Returns the ports with a connected EV.
+        '''
+        step = env.current_step
+        if self.current_step is None or step == 0 or \
+                step not in (self.current_step, self.current_step + 1) or \
+                len(getattr(env, 'EVs', [])) < self.n_seen:
+            self.reset_ports(env)
+
+        elif step == self.current_step + 1:
+            self.current_step = step
+            self.full_update = False
+
+            for EV in getattr(env, 'departing_evs', []):
+                port = self.port_offset[EV.location] + EV.id
+                if self.evs[port] is EV:
+                    self.evs[port] = None
+                    self.connected[port] = False
+                    self.buffer[self.port_indices[port]] = 0
+
+            arrived = []
+            for EV in env.EVs[self.n_seen:]:
+                if env.charging_stations[EV.location].evs_connected[EV.id] is EV:
+                    port = self.port_offset[EV.location] + EV.id
+                    self.connect(port, EV)
+                    arrived.append(port)
+            self.arrived = np.array(arrived, dtype=np.int64)
+            self.n_seen = len(env.EVs)
+
+        return np.flatnonzero(self.connected)
+
+    def write_ports(self, ports, feature, values) -> None:
+        '''
+        This function writes the values of a feature of the EVs of the ports.
+        '''
+        self.buffer[self.port_indices[ports, feature]] = values
+
+
+def get_layout(env, state_function, n_header, n_tr_features, n_ev_features) -> ObservationLayout:
+    '''
+    This function returns the observation layout of the state function, it is compiled at the first call.
+    '''
+    layout = getattr(env, 'observation_layout', None)
+    if layout is None or layout.state_function is not state_function:
+        layout = ObservationLayout(env, state_function,
+                                   n_header, n_tr_features, n_ev_features)
+        env.observation_layout = layout
+    return layout
+
+
+def write_charge_prices(buffer, env, start, horizon=20) -> None:
+    '''
+    This function writes the absolute charge prices of the next horizon steps, padded with zeros.
+    '''
+    charge_prices = env.charge_prices[0, env.current_step:env.current_step + horizon]
+    n = len(charge_prices)
+    np.abs(charge_prices, out=buffer[start:start + n])
+    buffer[start + n:start + horizon] = 0
+
+
+def PublicPST(env, *args, copy=True):
     '''This state function is the public power setpoints
     The state is the public power setpoints
-    The state is a vector '''
+    The state is a vector
+
+    The observation is written in place in the buffer of the observation layout,
+    if copy is False the buffer itself is returned and it is overwritten at the next step.'''
 
-    state = [
-        (env.current_step/env.simulation_length),
-        # env.sim_date.weekday() / 7,
-        # turn hour and minutes in sin and cos
-        # math.sin(env.sim_date.hour/24*2*math.pi),
-        # math.cos(env.sim_date.hour/24*2*math.pi),
-    ]
+    layout = get_layout(env, PublicPST, n_header=3, n_tr_features=0, n_ev_features=3)
+    ports = layout.update_ports(env)
+    state = layout.buffer
+
+    state[0] = env.current_step/env.simulation_length
 
     # the final state of each simulation
-    # if env.current_step < env.simulation_length:        
-    #     setpoint = min(env.power_setpoints[env.current_step], env.charge_power_potential[env.current_step])        
-    # else:
-    #     setpoint = 0       
-    if env.current_step < env.simulation_length:  
-        # setpoint = env.power_setpoints[env.current_step:env.current_step+10]
-        setpoint = env.power_setpoints[env.current_step]
+    if env.current_step < env.simulation_length:
+        state[1] = env.power_setpoints[env.current_step]
     else:
-        setpoint = np.zeros((1))
-        
-    # if len(setpoint) < 10:
-    #     setpoint = np.append(setpoint, np.zeros(10-len(setpoint)))
-    
-    state.append(setpoint)
-    state.append(env.current_power_usage[env.current_step-1])
+        state[1] = 0
 
-    # For every transformer
-    for tr in env.transformers:
-        # For every charging station connected to the transformer
-        for cs in env.charging_stations:
-            if cs.connected_transformer == tr.id:
-                # For every EV connected to the charging station
-                for EV in cs.evs_connected:
-                    # If there is an EV connected
-                    if EV is not None:
-                        state.append([
-                            1 if EV.get_soc() == 1 else 0.5,  # we know if the EV is full
-                            EV.total_energy_exchanged,
-                            # EV.max_ac_charge_power*1000 /
-                            # (cs.voltage*math.sqrt(cs.phases))/100,
-                            # EV.min_ac_charge_power*1000 /
-                            # (cs.voltage*math.sqrt(cs.phases))/100,
-                            (env.current_step-EV.time_of_arrival)
-                            ])
-
-                    # else if there is no EV connected put zeros
-                    else:
-                        state.append(np.zeros(3))
-
-    state = np.array(np.hstack(state))
+    state[2] = env.current_power_usage[env.current_step-1]
+
+    # For every EV connected to the charging stations of every transformer
+    evs = [layout.evs[port] for port in ports]
+    # we know if the EV is full
+    layout.write_ports(ports, 0, [1 if EV.get_soc() == 1 else 0.5 for EV in evs])
+    layout.write_ports(ports, 1, [EV.total_energy_exchanged for EV in evs])
+    layout.write_ports(ports, 2, env.current_step - layout.arrival[ports])
 
     np.set_printoptions(suppress=True)
 
-    return state
+    return state.copy() if copy else state
 
-def V2G_profit_max(env, *args):
+def V2G_profit_max(env, *args, copy=True):
     '''
     This is the state function for the V2GProfitMax scenario.
     '''
-    
-    state = [
-        (env.current_step),        
-    ]
-
-    state.append(env.current_power_usage[env.current_step-1])
-
-    charge_prices = abs(env.charge_prices[0, env.current_step:
-        env.current_step+20])
-    
-    if len(charge_prices) < 20:
-        charge_prices = np.append(charge_prices, np.zeros(20-len(charge_prices)))
-    
-    state.append(charge_prices)
-    
-    # For every transformer
-    for tr in env.transformers:
 
-        # For every charging station connected to the transformer
-        for cs in env.charging_stations:
-            if cs.connected_transformer == tr.id:
+    layout = get_layout(env, V2G_profit_max, n_header=22, n_tr_features=0, n_ev_features=2)
+    ports = layout.update_ports(env)
+    state = layout.buffer
 
-                # For every EV connected to the charging station
-                for EV in cs.evs_connected:
-                    # If there is an EV connected
-                    if EV is not None:
-                        state.append([
-                            EV.get_soc(),
-                            EV.time_of_departure - env.current_step,
-                            ])
+    state[0] = env.current_step
+    state[1] = env.current_power_usage[env.current_step-1]
+    write_charge_prices(state, env, start=2)
 
-                    # else if there is no EV connected put zeros
-                    else:
-                        state.append(np.zeros(2))
+    # For every EV connected to the charging stations of every transformer
+    layout.write_ports(ports, 0, [layout.evs[port].get_soc() for port in ports])
+    layout.write_ports(ports, 1, layout.departure[ports] - env.current_step)
 
-    state = np.array(np.hstack(state))
+    return state.copy() if copy else state
 
-    return state
-
-def V2G_profit_max_loads(env, *args):
+def V2G_profit_max_loads(env, *args, copy=True):
     '''
     This is the state function for the V2GProfitMax scenario with loads
     '''
-    
-    state = [
-        (env.current_step),        
-    ]
-
-    state.append(env.current_power_usage[env.current_step-1])
-
-    charge_prices = abs(env.charge_prices[0, env.current_step:
-        env.current_step+20])
-    
-    if len(charge_prices) < 20:
-        charge_prices = np.append(charge_prices, np.zeros(20-len(charge_prices)))
-    
-    state.append(charge_prices)
-    
-    # For every transformer
-    for tr in env.transformers:
-        loads, pv = tr.get_load_pv_forecast(step = env.current_step,
-                                            horizon = 20)
-        power_limits = tr.get_power_limits(step = env.current_step,
-                                           horizon = 20)
-        state.append(loads-pv)
-        state.append(power_limits)
-        
-        # For every charging station connected to the transformer
-        for cs in env.charging_stations:
-            if cs.connected_transformer == tr.id:
 
-                # For every EV connected to the charging station
-                for EV in cs.evs_connected:
-                    # If there is an EV connected
-                    if EV is not None:
-                        state.append([
-                            EV.get_soc(),
-                            EV.time_of_departure - env.current_step,
-                            ])
+    layout = get_layout(env, V2G_profit_max_loads, n_header=22, n_tr_features=40, n_ev_features=2)
+    ports = layout.update_ports(env)
+    state = layout.buffer
+
+    state[0] = env.current_step
+    state[1] = env.current_power_usage[env.current_step-1]
+    write_charge_prices(state, env, start=2)
+
+    # For every transformer
+    for tr, offset in zip(env.transformers, layout.tr_offsets):
+        loads, pv, power_limits = tr.get_forecast_windows(step=env.current_step,
+                                                          horizon=20)
+        np.subtract(loads, pv, out=state[offset:offset + 20])
+        state[offset + 20:offset + 40] = power_limits
 
-                    # else if there is no EV connected put zeros
-                    else:
-                        state.append(np.zeros(2))
+    # For every EV connected to the charging stations of every transformer
+    layout.write_ports(ports, 0, [layout.evs[port].get_soc() for port in ports])
+    layout.write_ports(ports, 1, layout.departure[ports] - env.current_step)
 
-    state = np.array(np.hstack(state))
+    return state.copy() if copy else state
 
-    return state
-    
 
 
-def BusinessPSTwithMoreKnowledge(env, *args):
+def BusinessPSTwithMoreKnowledge(env, *args, copy=True):
     '''
     This state function is used for the business case scenario that requires more knowledge such as SoC and time of departure for each EV present.
     '''
 
-    state = [
-        (env.current_step) / env.simulation_length,
-        #env.sim_date.weekday() / 5,
-        # turn hour and minutes in sin and cos
-        #math.sin(env.sim_date.hour/12*2*math.pi),
-        #math.cos(env.sim_date.hour/12*2*math.pi),
-    ]
+    layout = get_layout(env, BusinessPSTwithMoreKnowledge, n_header=3,
+                        n_tr_features=env.simulation_length, n_ev_features=3)
+    ports = layout.update_ports(env)
+    state = layout.buffer
+
+    state[0] = (env.current_step) / env.simulation_length
 
     # the final state of each simulation
     if env.current_step < env.simulation_length:
-        state.append(env.power_setpoints[env.current_step]) #/100
-        state.append(env.charge_power_potential[env.current_step]) #/100
+        state[1] = env.power_setpoints[env.current_step] #/100
+        state[2] = env.charge_power_potential[env.current_step] #/100
     else:
-        state.append(env.power_setpoints[env.current_step-1]) #/100
-        state.append(env.charge_power_potential[env.current_step-1]) #/100   
+        state[1] = env.power_setpoints[env.current_step-1] #/100
+        state[2] = env.charge_power_potential[env.current_step-1] #/100
 
-    for tr in env.transformers:
-        state.append(tr.max_current/100)
-        for cs in env.charging_stations:
-            if cs.connected_transformer == tr.id:
-                for EV in cs.evs_connected:
-                    if EV is not None:
-                        state.append([#EV.total_energy_exchanged / EV.battery_capacity, #how much soc we charge
-                                      #EV.max_ac_charge_power*1000 /            same EVs, no need right now
-                                      #(cs.voltage*math.sqrt(cs.phases)),
-                                      #EV.min_ac_charge_power*1000 /
-                                      #(cs.voltage*math.sqrt(cs.phases)),
-                                      EV.time_of_arrival / env.simulation_length,  # time of arrival
-                                      EV.etime_of_departure / env.simulation_length,  # time of departure
-                                      EV.get_soc(),  # soc
-                                      #(EV.etime_of_departure - env.current_step) \
-                                      #  / env.simulation_length, #remaining time
-                                      #(env.current_step-EV.time_of_arrival) \
-                                      #  / env.simulation_length,  # time stayed
-                                      #(EV.etime_of_departure - \
-                                      # EV.time_of_arrival) / env.simulation_length, # total staying time
-                                      #(((EV.battery_capacity - EV.battery_capacity_at_arrival) /
-                                      #  (EV.etime_of_departure - EV.time_of_arrival)) / EV.max_ac_charge_power),  # average charging speed
-                                      #(((EV.battery_capacity - EV.battery_capacity_at_arrival) / EV.battery_capacity)) \
-                                      #  / ((EV.etime_of_departure - env.current_step + 1) / env.simulation_length),   #charging priority
-                                      #EV.required_power / EV.battery_capacity,  # required energy
-                                      ])
-                    else:
-                        state.append(np.zeros(3))
-
-    state = np.array(np.hstack(state))
+    # the transformer limits and the arrival and departure times only change with the episode and the EV
+    if layout.full_update:
+        for tr, offset in zip(env.transformers, layout.tr_offsets):
+            np.divide(tr.max_current, 100, out=state[offset:offset + env.simulation_length])
+
+    arrived = layout.arrived
+    layout.write_ports(arrived, 0, layout.arrival[arrived] / env.simulation_length)  # time of arrival
+    layout.write_ports(arrived, 1, layout.departure[arrived] / env.simulation_length)  # time of departure
+    layout.write_ports(ports, 2, [layout.evs[port].get_soc() for port in ports])  # soc
 
     np.set_printoptions(suppress=True)
 
-    return state
\ No newline at end of file
+    return state.copy() if copy else state
+
+
+class GraphState(dict):
+    '''
+    This class is the observation of the graph state functions, a dictionary of fixed size arrays:
+        - env_features: (1, 5) step / simulation length, power setpoint, charge power potential,
+          charge price and power usage of the last step
+        - tr_features: (n_transformers, 3) power limit, inflexible loads + PV and current power
+        - cs_features: (n_cs, 4) max charge power, max discharge power, connected EVs and current power
+        - ev_features: (n_ports, 4) SoC, energy exchanged, steps since arrival and steps to departure
+          of the EV of every port, zero if the port is empty
+        - ev_mask: (n_ports,) 1 if an EV is connected to the port
+    The keys are also attributes, and the static graph of the environment is shared by all the
+    observations: action_mapper (the action of every row of ev_features), node_offsets,
+    edge_index and its CSR form indptr, indices.
+    '''
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def copy(self):
+        state = GraphState({key: value.copy() for key, value in self.items()})
+        state.__dict__.update(self.__dict__)
+        return state
+
+
+class GraphObservation():
+    '''
+    This class contains the graph of an environment, computed once, and the preallocated graph state.
+
+    The nodes are the environment, the transformers, the chargers and one EV node per port, in this order.
+    The edges (in both directions) connect every port to its charger, every charger to its transformer
+    and every transformer to the environment node, so they never change: an EV node is empty when
+    ev_mask is 0. The EV nodes are updated only on arrival and departure, the features of the
+    connected EVs are updated every step.
+    '''
+
+    def __init__(self, env, state_function):
+
+        self.state_function = state_function
+        n_ports = env.number_of_ports
+        n_cs = len(env.charging_stations)
+        n_tr = len(env.transformers)
+
+        # charger of every port
+        self.port_offset = []
+        port_cs = []
+        for cs in env.charging_stations:
+            self.port_offset.append(len(port_cs))
+            port_cs += [cs.id] * cs.n_ports
+        self.port_cs = np.array(port_cs, dtype=np.int64)
+        cs_transformer = np.array([cs.connected_transformer for cs in env.charging_stations],
+                                  dtype=np.int64)
+
+        self.node_offsets = {'env': 0, 'transformer': 1, 'cs': 1 + n_tr, 'ev': 1 + n_tr + n_cs}
+        self.n_nodes = 1 + n_tr + n_cs + n_ports
+
+        source = np.concatenate([self.node_offsets['ev'] + np.arange(n_ports),
+                                 self.node_offsets['cs'] + np.arange(n_cs),
+                                 self.node_offsets['transformer'] + np.arange(n_tr)])
+        target = np.concatenate([self.node_offsets['cs'] + self.port_cs,
+                                 self.node_offsets['transformer'] + cs_transformer,
+                                 np.zeros(n_tr, dtype=np.int64)])
+        edge_index = np.stack([np.concatenate([source, target]),
+                               np.concatenate([target, source])])
+        edge_index = edge_index[:, np.lexsort(edge_index[::-1])]
+        edge_index.setflags(write=False)
+
+        indptr = np.zeros(self.n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(edge_index[0], minlength=self.n_nodes), out=indptr[1:])
+        indptr.setflags(write=False)
+
+        self.state = GraphState(env_features=np.zeros((1, 5)),
+                                tr_features=np.zeros((n_tr, 3)),
+                                cs_features=np.zeros((n_cs, 4)),
+                                ev_features=np.zeros((n_ports, 4)),
+                                ev_mask=np.zeros(n_ports, dtype=np.int8))
+        self.state.action_mapper = list(range(n_ports))
+        self.state.node_offsets = self.node_offsets
+        self.state.edge_index = edge_index
+        self.state.indptr = indptr
+        self.state.indices = edge_index[1]
+
+        self.observation_space = spaces.Dict(
+            {key: spaces.MultiBinary(value.shape[0]) if key == 'ev_mask' else
+             spaces.Box(low=-np.inf, high=np.inf, shape=value.shape, dtype=np.float64)
+             for key, value in self.state.items()})
+
+        # static charger features
+        self.state.cs_features[:, 0] = [cs.get_max_power() for cs in env.charging_stations]
+        self.state.cs_features[:, 1] = [abs(cs.get_min_power()) for cs in env.charging_stations]
+
+        self.reset_ports(env)
+
+    def reset_ports(self, env) -> None:
+        '''
+        This function reads the connected EVs of every port, it is called again if the environment is reset.
+        '''
+        self.evs = [None] * env.number_of_ports
+        self.arrival = np.zeros(env.number_of_ports)
+        self.departure = np.zeros(env.number_of_ports)
+        if env.current_step == 0:
+            # a new episode gets new arrays, so the last observation of the previous one is kept
+            self.state = self.state.copy()
+        self.state.ev_features[:] = 0
+        self.state.ev_mask[:] = 0
+
+        for cs in env.charging_stations:
+            for j, EV in enumerate(cs.evs_connected):
+                if EV is not None:
+                    self.connect(self.port_offset[cs.id] + j, EV)
+
+        self.n_seen = len(getattr(env, 'EVs', []))
+        self.current_step = env.current_step
+
+    def connect(self, port, EV) -> None:
+        self.evs[port] = EV
+        self.arrival[port] = EV.time_of_arrival
+        self.departure[port] = EV.time_of_departure
+        self.state.ev_mask[port] = 1
+
+    def update_ports(self, env) -> None:
+        '''
+        This function updates the EV nodes of the ports where EVs arrived or departed in the last step.
+        '''
+        if env.current_step == 0 or env.current_step < self.current_step or \
+                len(env.EVs) < self.n_seen:
+            self.reset_ports(env)
+            return
+        if env.current_step == self.current_step:
+            return
+        self.current_step = env.current_step
+
+        for EV in getattr(env, 'departing_evs', []):
+            port = self.port_offset[EV.location] + EV.id
+            if self.evs[port] is EV:
+                self.evs[port] = None
+                self.state.ev_features[port] = 0
+                self.state.ev_mask[port] = 0
+
+        for EV in env.EVs[self.n_seen:]:
+            if env.charging_stations[EV.location].evs_connected[EV.id] is EV:
+                self.connect(self.port_offset[EV.location] + EV.id, EV)
+        self.n_seen = len(env.EVs)
+
+
+def get_graph(env, state_function) -> GraphObservation:
+    '''
+    This function returns the graph observation of the state function, it is compiled at the first call.
+    '''
+    graph = getattr(env, 'graph_observation', None)
+    if graph is None or graph.state_function is not state_function:
+        graph = GraphObservation(env, state_function)
+        env.graph_observation = graph
+    return graph
+
+
+def PublicPST_GNN(env, *args, copy=True):
+    '''
+    This state function is the graph version of PublicPST for GNN policies, see GraphState.
+
+    The features are written in place in the graph state, if copy is False the graph state itself is
+    returned and it is overwritten at the next step.
+    '''
+    graph = get_graph(env, PublicPST_GNN)
+    graph.update_ports(env)
+    state = graph.state
+
+    t = env.current_step
+    step = min(t, env.simulation_length - 1)
+
+    env_features = state.env_features[0]
+    env_features[0] = t / env.simulation_length
+    env_features[1] = env.power_setpoints[t] if t < env.simulation_length else 0
+    env_features[2] = env.charge_power_potential[step]
+    env_features[3] = abs(env.charge_prices[0, step])
+    env_features[4] = env.current_power_usage[t-1]
+
+    for i, tr in enumerate(env.transformers):
+        state.tr_features[i] = (tr.max_power[step],
+                                tr.inflexible_load[step] + tr.solar_power[step],
+                                tr.current_power)
+
+    n_cs = len(env.charging_stations)
+    state.cs_features[:, 2] = np.fromiter((cs.n_evs_connected for cs in env.charging_stations),
+                                          dtype=float, count=n_cs)
+    state.cs_features[:, 3] = np.fromiter((cs.current_power_output for cs in env.charging_stations),
+                                          dtype=float, count=n_cs)
+
+    # only the features of the connected EVs are updated
+    ports = np.flatnonzero(state.ev_mask)
+    ev_features = state.ev_features
+    ev_features[ports, 0] = [graph.evs[port].get_soc() for port in ports]
+    ev_features[ports, 1] = [graph.evs[port].total_energy_exchanged for port in ports]
+    ev_features[ports, 2] = t - graph.arrival[ports]
+    ev_features[ports, 3] = graph.departure[ports] - t
+
+    return state.copy() if copy else state
@@ -0,0 +1,570 @@
+'''
+This file contains a multiprocess vectorized environment for EV2Gym, the observations, rewards,
+dones and action masks of all the environments are written in shared memory by the workers.
+It also contains the vectorized versions of the noise wrappers of noise_wrappers.py.
+'''
+
+import multiprocessing as mp
+import os
+from functools import partial
+
+import gymnasium as gym
+import numpy as np
+
+from stable_baselines3.common.vec_env.base_vec_env import VecEnv, VecEnvWrapper, CloudpickleWrapper
+
+from ev2gym.models.ev2gym_env import EV2Gym
+
+# (EV features kept from the previous step when the observation is delayed,
+#  index of the power usage corrected for the energy that was not communicated or None)
+DELAYED_FEATURES = {'PublicPST': ([1], 2),
+                    'PublicPST_GNN': ([1], 4),
+                    'V2G_profit_max': ([0], None),
+                    'V2G_profit_max_loads': ([0], None),
+                    'BusinessPSTwithMoreKnowledge': ([2], None)}
+
+
+def get_action_mask(env) -> np.ndarray:
+    '''
+    This function returns the action mask of the environment, True if an EV is connected to the port.
+    '''
+    return env.unwrapped.port_mask.copy()
+
+
+class SharedBuffers():
+    '''
+    This class contains the shared memory buffers of the vectorized environment,
+    one row per environment. Every process builds its own numpy views of the same memory.
+    '''
+
+    def __init__(self, n_envs, observation_space, action_space, ctx):
+
+        self.n_envs = n_envs
+        self.obs_shape = observation_space.shape
+        self.obs_dtype = np.dtype(observation_space.dtype)
+        self.action_shape = action_space.shape
+        self.action_dtype = np.dtype(action_space.dtype)
+        n_ports = int(np.prod(action_space.shape))
+
+        self.raw_obs = ctx.RawArray(np.ctypeslib.as_ctypes_type(self.obs_dtype),
+                                    n_envs * int(np.prod(self.obs_shape)))
+        self.raw_actions = ctx.RawArray(np.ctypeslib.as_ctypes_type(self.action_dtype),
+                                        n_envs * n_ports)
+        self.raw_rewards = ctx.RawArray('d', n_envs)
+        self.raw_dones = ctx.RawArray('b', n_envs)
+        self.raw_masks = ctx.RawArray('b', n_envs * n_ports)
+
+        self.views()
+
+    def views(self) -> None:
+        '''
+        This function builds the numpy views of the shared memory.
+        '''
+        n = self.n_envs
+        self.obs = np.frombuffer(self.raw_obs, dtype=self.obs_dtype).reshape(
+            (n,) + self.obs_shape)
+        self.actions = np.frombuffer(self.raw_actions, dtype=self.action_dtype).reshape(
+            (n,) + self.action_shape)
+        self.rewards = np.frombuffer(self.raw_rewards, dtype=np.float64)
+        self.dones = np.frombuffer(self.raw_dones, dtype=bool)
+        self.masks = np.frombuffer(self.raw_masks, dtype=bool).reshape(n, -1)
+
+    def __getstate__(self):
+        # the numpy views are rebuilt in the worker
+        state = self.__dict__.copy()
+        for key in ['obs', 'actions', 'rewards', 'dones', 'masks']:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.views()
+
+
+class WorkerEnv():
+    '''
+    This class contains one environment of a worker.
+
+    The seed of episode k of environment i is seed_i + k * n_envs, so every episode of the
+    vectorized environment gets its own scenario whatever the number of workers.
+    If prefetch is True, a second environment is reset with the next scenario while the
+    worker waits for the next action, and it is swapped in when the episode ends. The attributes
+    and methods called through the vectorized environment are applied to both environments.
+    '''
+
+    def __init__(self, env_fn, seed, n_envs, prefetch):
+
+        self.env = env_fn()
+        self.spare = env_fn() if prefetch else None
+        self.n_envs = n_envs
+
+        self.set_seed(seed)
+
+    def set_seed(self, seed) -> None:
+        self.seed = seed
+        self.episode = 0
+        # (observation, info) of the reset spare environment
+        self.prefetched = None
+
+    def next_seed(self):
+        seed = self.seed + self.episode * self.n_envs
+        self.episode += 1
+        return seed
+
+    def reset(self):
+        '''
+        This function starts the next episode, using the prefetched scenario if there is one.
+        '''
+        if self.prefetched is not None:
+            self.env, self.spare = self.spare, self.env
+            obs, info = self.prefetched
+            self.prefetched = None
+        else:
+            obs, info = self.env.reset(seed=self.next_seed())
+        return obs, info
+
+    def apply(self, function):
+        '''
+        This function calls function on the environment and on the spare one, and returns the result of
+        the environment. The prefetched scenario was reset with the previous settings, so it is dropped
+        and its seed is used again by the next prefetch.
+        '''
+        result = function(self.env)
+        if self.spare is not None:
+            function(self.spare)
+            if self.prefetched is not None:
+                self.prefetched = None
+                self.episode -= 1
+        return result
+
+    def needs_prefetch(self) -> bool:
+        return self.spare is not None and self.prefetched is None
+
+    def prefetch(self) -> None:
+        self.prefetched = self.spare.reset(seed=self.next_seed())
+
+
+def _worker(remote, parent_remote, env_fns_wrapper, buffers, start, seeds, n_envs, prefetch):
+    '''
+    This function runs the environments start:start + len(seeds) of the vectorized environment.
+    Only the commands and the infos go through the pipe.
+    '''
+    parent_remote.close()
+    buffers.views()
+
+    envs = [WorkerEnv(env_fn, seed, n_envs, prefetch)
+            for env_fn, seed in zip(env_fns_wrapper.var, seeds)]
+    rows = range(start, start + len(envs))
+
+    def write_reset(row, env, obs):
+        buffers.obs[row] = obs
+        buffers.masks[row] = get_action_mask(env.env)
+
+    try:
+        while True:
+            # the next scenarios are prepared while the agent computes its actions
+            for env in envs:
+                if remote.poll():
+                    break
+                if env.needs_prefetch():
+                    env.prefetch()
+
+            cmd, data = remote.recv()
+
+            if cmd == 'step':
+                infos = []
+                for row, env in zip(rows, envs):
+                    obs, reward, terminated, truncated, info = env.env.step(buffers.actions[row])
+                    done = terminated or truncated
+
+                    mask = info.pop('action_mask', None)
+                    info['TimeLimit.truncated'] = truncated and not terminated
+                    buffers.rewards[row] = reward
+                    buffers.dones[row] = done
+
+                    if done:
+                        info['terminal_observation'] = obs
+                        obs, reset_info = env.reset()
+                        write_reset(row, env, obs)
+                        info['reset_info'] = reset_info
+                    else:
+                        buffers.obs[row] = obs
+                        buffers.masks[row] = mask if mask is not None \
+                            else get_action_mask(env.env)
+                    infos.append(info)
+                remote.send(infos)
+
+            elif cmd == 'reset':
+                infos = []
+                for row, env, seed in zip(rows, envs, data[start:start + len(envs)]):
+                    if seed is not None:
+                        env.set_seed(seed)
+                    obs, info = env.reset()
+                    write_reset(row, env, obs)
+                    infos.append(info)
+                remote.send(infos)
+
+            elif cmd == 'get_attr':
+                indices, name = data
+                remote.send([getattr(envs[i - start].env, name) for i in indices])
+
+            elif cmd == 'set_attr':
+                indices, name, value = data
+                for i in indices:
+                    envs[i - start].apply(lambda env: setattr(env, name, value))
+                remote.send(None)
+
+            elif cmd == 'env_method':
+                indices, name, args, kwargs = data
+                remote.send([envs[i - start].apply(lambda env: getattr(env, name)(*args, **kwargs))
+                             for i in indices])
+
+            elif cmd == 'is_wrapped':
+                indices, wrapper_class = data
+                results = []
+                for i in indices:
+                    env = envs[i - start].env
+                    wrapped = False
+                    while isinstance(env, gym.Wrapper) and not wrapped:
+                        wrapped = isinstance(env, wrapper_class)
+                        env = env.env
+                    results.append(wrapped)
+                remote.send(results)
+
+            elif cmd == 'close':
+                for env in envs:
+                    env.env.close()
+                    if env.spare is not None:
+                        env.spare.close()
+                remote.close()
+                break
+
+            else:
+                raise NotImplementedError(f"`{cmd}` is not implemented in the worker")
+
+    except KeyboardInterrupt:
+        print("SharedMemoryVecEnv worker: got KeyboardInterrupt")
+
+
+class SharedMemoryVecEnv(VecEnv):
+    '''
+    This class is a multiprocess vectorized environment, the environments are split in
+    contiguous blocks between n_workers processes.
+
+    The actions, observations, rewards, dones and action masks are kept in shared memory,
+    so a step only sends a short command to every worker and receives the infos back.
+    The episodes reset automatically, the last observation is in info['terminal_observation'].
+
+    Args:
+        env_fns: functions that create the environments.
+        n_workers: number of processes (default: one per environment, at most the number of CPUs).
+        seed: seed of the first environment, environment i uses seed + i (default: random).
+        prefetch: whether every environment keeps a second environment with the next scenario.
+        start_method: start method of the processes (default: forkserver if available else spawn).
+    '''
+
+    def __init__(self, env_fns, n_workers=None, seed=None, prefetch=True, start_method=None):
+
+        n_envs = len(env_fns)
+        if n_workers is None:
+            n_workers = min(n_envs, os.cpu_count() or 1)
+        assert 1 <= n_workers <= n_envs, "n_workers must be between 1 and the number of environments."
+
+        if start_method is None:
+            forkserver_available = "forkserver" in mp.get_all_start_methods()
+            start_method = "forkserver" if forkserver_available else "spawn"
+        ctx = mp.get_context(start_method)
+
+        if seed is None:
+            seed = np.random.randint(0, 1000000)
+
+        # the spaces are read from a local environment, it is only used to build the buffers
+        env = env_fns[0]()
+        observation_space, action_space = env.observation_space, env.action_space
+        env.close()
+
+        self.buffers = SharedBuffers(n_envs, observation_space, action_space, ctx)
+        self.prefetch = prefetch
+        self.closed = False
+        self.waiting = False
+
+        # contiguous blocks of environments, the first blocks get one more if needed
+        sizes = [n_envs // n_workers + (1 if i < n_envs % n_workers else 0)
+                 for i in range(n_workers)]
+        self.starts = np.cumsum([0] + sizes[:-1]).tolist()
+        self.sizes = sizes
+
+        self.remotes, self.work_remotes = zip(*[ctx.Pipe() for _ in range(n_workers)])
+        self.processes = []
+        for work_remote, remote, start, size in zip(self.work_remotes, self.remotes,
+                                                    self.starts, self.sizes):
+            args = (work_remote, remote,
+                    CloudpickleWrapper(env_fns[start:start + size]),
+                    self.buffers, start,
+                    [seed + i for i in range(start, start + size)],
+                    n_envs, prefetch)
+            # daemon=True: if the main process crashes, we should not cause things to hang
+            process = ctx.Process(target=_worker, args=args, daemon=True)
+            process.start()
+            self.processes.append(process)
+            work_remote.close()
+
+        super().__init__(n_envs, observation_space, action_space)
+        self._seeds = [None] * n_envs
+
+    def worker_of(self, index) -> int:
+        '''
+        This function returns the worker that runs the environment index.
+        '''
+        return int(np.searchsorted(self.starts, index, side='right')) - 1
+
+    def seed(self, seed=None):
+        '''
+        This function sets the seeds used at the next reset, environment i uses seed + i.
+        '''
+        if seed is None:
+            seed = np.random.randint(0, 1000000)
+        self._seeds = [seed + i for i in range(self.num_envs)]
+        return list(self._seeds)
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', self._seeds))
+        self.reset_infos = [info for remote in self.remotes for info in remote.recv()]
+        self._seeds = [None] * self.num_envs
+        return self.buffers.obs.copy()
+
+    def step_async(self, actions) -> None:
+        np.copyto(self.buffers.actions,
+                  np.asarray(actions).reshape(self.buffers.actions.shape))
+        for remote in self.remotes:
+            remote.send(('step', None))
+        self.waiting = True
+
+    def step_wait(self):
+        infos = [info for remote in self.remotes for info in remote.recv()]
+        self.waiting = False
+
+        return (self.buffers.obs.copy(),
+                self.buffers.rewards.astype(np.float32),
+                self.buffers.dones.copy(),
+                infos)
+
+    def action_masks(self) -> np.ndarray:
+        '''
+        This function returns the (n_envs, n_ports, 3) MaskablePPO masks of all the environments
+        (see EV2Gym.action_masks), built from the shared port masks.
+        '''
+        masks = np.ones((self.num_envs,) + self.buffers.masks.shape[1:] + (3,), dtype=bool)
+        masks[:, :, 1:] = self.buffers.masks[:, :, np.newaxis]
+        return masks
+
+    def port_masks(self) -> np.ndarray:
+        '''
+        This function returns the port masks of all the environments, True if an EV is connected.
+        '''
+        return self.buffers.masks.copy()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
+        self.closed = True
+
+    def _get_target_remotes(self, indices):
+        '''
+        This function groups the indices of the environments by worker.
+        '''
+        indices = self._get_indices(indices)
+        groups = {}
+        for i in indices:
+            groups.setdefault(self.worker_of(i), []).append(i)
+        return [(self.remotes[worker], group) for worker, group in groups.items()]
+
+    def _call(self, cmd, indices, *data):
+        targets = self._get_target_remotes(indices)
+        for remote, group in targets:
+            remote.send((cmd, (group,) + data))
+        return [result for remote, _ in targets for result in remote.recv()]
+
+    def get_attr(self, attr_name, indices=None):
+        return self._call('get_attr', indices, attr_name)
+
+    def set_attr(self, attr_name, value, indices=None) -> None:
+        targets = self._get_target_remotes(indices)
+        for remote, group in targets:
+            remote.send(('set_attr', (group, attr_name, value)))
+        for remote, _ in targets:
+            remote.recv()
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        if method_name == 'action_masks':
+            # served from the shared memory, see sb3_contrib get_action_masks
+            return list(self.action_masks()[self._get_indices(indices)])
+        return self._call('env_method', indices, method_name, method_args, method_kwargs)
+
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        return self._call('is_wrapped', indices, wrapper_class)
+
+
+def make_ev2gym_vec_env(config_file, n_envs, n_workers=None, seed=None, prefetch=True,
+                        wrapper_class=None, start_method=None, **env_kwargs) -> SharedMemoryVecEnv:
+    '''
+    This function creates a SharedMemoryVecEnv of n_envs EV2Gym environments.
+    env_kwargs are passed to EV2Gym, wrapper_class (e.g. an action wrapper) wraps every environment.
+    Environment i is also created with seed + i, as some data (e.g. the charge prices) is loaded
+    when the environment is created.
+    The observations are copied to the shared buffers at every step, so by default the environments
+    return their observation buffers without copying them (copy_observations=False).
+    '''
+    env_kwargs.setdefault('generate_rnd_game', True)
+    env_kwargs.setdefault('copy_observations', False)
+
+    if seed is None:
+        seed = np.random.randint(0, 1000000)
+
+    def make_env(env_seed):
+        env = EV2Gym(config_file=config_file, seed=env_seed, **env_kwargs)
+        if wrapper_class is not None:
+            env = wrapper_class(env)
+        return env
+
+    return SharedMemoryVecEnv([partial(make_env, seed + i) for i in range(n_envs)],
+                              n_workers=n_workers,
+                              seed=seed,
+                              prefetch=prefetch,
+                              start_method=start_method)
+
+
+def make_rngs(n_envs, seed=None):
+    '''
+    This function returns one independent random generator per environment.
+    '''
+    return [np.random.default_rng(child)
+            for child in np.random.SeedSequence(seed).spawn(n_envs)]
+
+
+class VecFailedActionCommunication(VecEnvWrapper):
+    '''
+    This wrapper is the vectorized version of FailedActionCommunication, the action of every port of
+    every environment fails with probability p_fail and the port keeps its previous action.
+    The failures are drawn at every step from one random generator per environment.
+    '''
+
+    def __init__(self, venv, p_fail=0.1, seed=None):
+        assert p_fail >= 0 and p_fail <= 1, "p_fail must be between 0 and 1"
+        super().__init__(venv)
+
+        self.p_fail = p_fail
+        self.rngs = make_rngs(self.num_envs, seed)
+        self.previous_actions = np.zeros((self.num_envs,) + self.action_space.shape)
+
+    def reset(self):
+        self.previous_actions[:] = 0
+        return self.venv.reset()
+
+    def step_async(self, actions) -> None:
+        actions = np.asarray(actions).reshape(self.previous_actions.shape)
+        failed = np.stack([rng.random(actions.shape[1:]) for rng in self.rngs]) < self.p_fail
+
+        new_actions = np.where(failed, self.previous_actions, actions)
+        self.previous_actions = new_actions.copy()
+        self.venv.step_async(new_actions)
+
+    def step_wait(self):
+        obs, rewards, dones, infos = self.venv.step_wait()
+        # the environments that ended start the next episode without previous actions
+        self.previous_actions[dones] = 0
+        return obs, rewards, dones, infos
+
+
+class VecDelayedObservation(VecEnvWrapper):
+    '''
+    This wrapper is the vectorized version of DelayedObservation, the observation of every connected EV
+    of every environment is delayed with probability p_delay: its features in DELAYED_FEATURES keep
+    their previous values. For PublicPST and PublicPST_GNN the delayed feature is the energy exchanged,
+    and the power usage is corrected for the energy that was not communicated.
+    The delays are drawn at every step from one random generator per environment.
+    '''
+
+    def __init__(self, venv, p_delay=0.1, seed=None):
+        assert p_delay >= 0 and p_delay <= 1, "p_delay must be between 0 and 1"
+        super().__init__(venv)
+
+        name = venv.get_attr('state_function', indices=[0])[0].__name__
+        assert name in DELAYED_FEATURES, \
+            f"The state function must be one of {list(DELAYED_FEATURES.keys())}. It was found to be: {name}"
+
+        self.features, self.power_usage = DELAYED_FEATURES[name]
+        self.graph = name == 'PublicPST_GNN'
+        if not self.graph:
+            layout = venv.get_attr('observation_layout', indices=[0])[0]
+            self.port_indices = layout.port_indices
+            self.columns = layout.port_indices[:, self.features]
+
+        self.timescale = venv.get_attr('timescale', indices=[0])[0]
+        self.p_delay = p_delay
+        self.rngs = make_rngs(self.num_envs, seed)
+
+        # the features sent to the agent and the actual features of the last step
+        self.previous = None
+        self.actual_previous = None
+        self.previous_connected = None
+
+    def ev_features(self, obs):
+        '''
+        This function returns the delayed EV features (N, n_ports, n_features) and the connected ports.
+        '''
+        if self.graph:
+            return obs['ev_features'][:, :, self.features], obs['ev_mask'].astype(bool)
+        # the features of an empty port are zero
+        return obs[:, self.columns], np.any(obs[:, self.port_indices] != 0, axis=-1)
+
+    def write(self, obs, features, not_communicated) -> None:
+        if self.graph:
+            obs['ev_features'][:, :, self.features] = features
+            power_usage = obs['env_features'][:, 0, self.power_usage]
+        else:
+            obs[:, self.columns] = features
+            power_usage = obs[:, self.power_usage] if self.power_usage is not None else None
+
+        if self.power_usage is not None:
+            power_usage = np.maximum(power_usage - not_communicated * 60 / self.timescale, 0)
+            if self.graph:
+                obs['env_features'][:, 0, self.power_usage] = power_usage
+            else:
+                obs[:, self.power_usage] = power_usage
+
+    def reset(self):
+        obs = self.venv.reset()
+        self.previous, self.previous_connected = self.ev_features(obs)
+        self.actual_previous = self.previous.copy()
+        return obs
+
+    def step_wait(self):
+        obs, rewards, dones, infos = self.venv.step_wait()
+
+        actual, connected = self.ev_features(obs)
+        if self.previous is None:
+            self.previous, self.previous_connected = actual.copy(), connected
+            self.actual_previous = actual.copy()
+
+        delayed = np.stack([rng.random(connected.shape[1]) for rng in self.rngs]) < self.p_delay
+        # only EVs that were already connected are delayed, the observations after a reset are not
+        delayed &= connected & self.previous_connected
+        delayed[dones] = False
+
+        features = np.where(delayed[:, :, np.newaxis], self.previous, actual)
+        not_communicated = np.sum((actual[:, :, 0] - self.actual_previous[:, :, 0]) * delayed, axis=1)
+        self.write(obs, features, not_communicated)
+
+        self.previous = features
+        self.actual_previous = actual
+        self.previous_connected = connected
+        return obs, rewards, dones, infos
@@ -0,0 +1,131 @@
+'''
+This script benchmarks the latency of the MPC controllers for different control horizons,
+numbers of ports and ports per charger, to pick the largest horizon that meets a real-time budget.
+
+Example:
+    python -m ev2gym.scripts.benchmark_mpc --algorithm eMPC_V2G --horizons 10 20 30 --ports 10 25 50 --budget 1.0
+    python -m ev2gym.scripts.benchmark_mpc --algorithm OCMF_V2G --ports 40 --ports_per_cs 1 2 4
+'''
+
+import os
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from ev2gym.models.ev2gym_env import EV2Gym
+from ev2gym.baselines.mpc.eMPC import eMPC_V2G, eMPC_G2V
+from ev2gym.baselines.mpc.ocmf_mpc import OCMF_V2G, OCMF_G2V
+
+ALGORITHMS = {'eMPC_V2G': eMPC_V2G,
+              'eMPC_G2V': eMPC_G2V,
+              'OCMF_V2G': OCMF_V2G,
+              'OCMF_G2V': OCMF_G2V}
+
+
+def benchmark(config_file, algorithm, control_horizon, n_ports, ports_per_cs=1, n_steps=None,
+              seed=0, **mpc_kwargs):
+    '''
+    This function runs the MPC controller on one simulation with n_ports ports, spread over
+    chargers with ports_per_cs ports each, and returns its timing summary (see MPC.timing_summary).
+    '''
+    assert n_ports % ports_per_cs == 0, "n_ports must be a multiple of ports_per_cs."
+
+    config = yaml.load(open(config_file, 'r'), Loader=yaml.FullLoader)
+    config['number_of_charging_stations'] = n_ports // ports_per_cs
+    config['number_of_ports_per_cs'] = ports_per_cs
+    # without a topology file, the chargers are spread over number_of_transformers
+    config['charging_network_topology'] = 'None'
+
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as f:
+        yaml.dump(config, f)
+        tmp_config = f.name
+
+    try:
+        env = EV2Gym(config_file=tmp_config, seed=seed)
+        env.reset(seed=seed)
+    finally:
+        os.remove(tmp_config)
+
+    model = ALGORITHMS[algorithm](env, control_horizon=control_horizon, **mpc_kwargs)
+
+    if n_steps is None:
+        n_steps = env.simulation_length
+
+    timer = time.perf_counter()
+    for _ in range(n_steps):
+        actions = model.get_action(env)
+        _, _, done, _, _ = env.step(actions)
+        if done:
+            break
+    wall_time = time.perf_counter() - timer
+    model.close()
+
+    summary = model.timing_summary()
+    summary.update({'algorithm': algorithm,
+                    'control_horizon': control_horizon,
+                    'n_ports': n_ports,
+                    'ports_per_cs': ports_per_cs,
+                    'steps': len(model.step_timings),
+                    'wall_time': wall_time,
+                    'time_total_p95': np.percentile(model.get_timings()['total'], 95)})
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_file', type=str,
+                        default="ev2gym/example_config_files/V2GProfitPlusLoads.yaml")
+    parser.add_argument('--algorithm', type=str, default="eMPC_V2G",
+                        choices=list(ALGORITHMS.keys()))
+    parser.add_argument('--horizons', type=int, nargs='+', default=[5, 10, 20, 30])
+    parser.add_argument('--ports', type=int, nargs='+', default=[10, 25, 50])
+    parser.add_argument('--ports_per_cs', type=int, nargs='+', default=[1],
+                        help="Ports per charger, the total number of ports is kept the same")
+    parser.add_argument('--steps', type=int, default=None,
+                        help="Num. of simulated steps (default: the whole simulation)")
+    parser.add_argument('--solver', type=str, default=None,
+                        help="MPC solver backend (default: mpc_solver of the config file)")
+    parser.add_argument('--budget', type=float, default=None,
+                        help="Real-time budget (s) of one control step")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save_path', type=str, default="./results/mpc_benchmark.csv")
+    args = parser.parse_args()
+
+    results = []
+    for n_ports in args.ports:
+        for ports_per_cs in args.ports_per_cs:
+            for control_horizon in args.horizons:
+                summary = benchmark(args.config_file,
+                                    args.algorithm,
+                                    control_horizon,
+                                    n_ports,
+                                    ports_per_cs=ports_per_cs,
+                                    n_steps=args.steps,
+                                    seed=args.seed,
+                                    solver=args.solver)
+                results.append(summary)
+                print(f'{args.algorithm} | ports: {n_ports} ({ports_per_cs} per charger) | '
+                      f'horizon: {control_horizon} | '
+                      f'step mean: {summary["time_total_mean"]:.4f}s, '
+                      f'p95: {summary["time_total_p95"]:.4f}s, '
+                      f'max: {summary["time_total_max"]:.4f}s')
+
+    results = pd.DataFrame(results)
+    columns = ['algorithm', 'n_ports', 'ports_per_cs', 'control_horizon', 'steps', 'wall_time'] + \
+        [c for c in results.columns if c.startswith('time_')]
+    results = results[columns]
+
+    os.makedirs(os.path.dirname(args.save_path) or '.', exist_ok=True)
+    results.to_csv(args.save_path, index=False)
+    print(f'Results saved to {args.save_path}')
+
+    if args.budget is not None:
+        print(f'Largest control horizon with p95 step latency <= {args.budget}s:')
+        for (n_ports, ports_per_cs), group in results.groupby(['n_ports', 'ports_per_cs']):
+            fits = group[group['time_total_p95'] <= args.budget]
+            best = fits["control_horizon"].max() if len(fits) > 0 else 'none'
+            print(f' - {n_ports} ports ({ports_per_cs} per charger): {best}')
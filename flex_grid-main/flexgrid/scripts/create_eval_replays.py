@@ -3,7 +3,11 @@ from ev2gym.baselines.gurobi_models.tracking_error import PowerTrackingErrorrMin
 
 import numpy as np
 import os
+import sys
 import pickle
+import hashlib
+import inspect
+from concurrent.futures import ProcessPoolExecutor
 from ev2gym.utilities.arg_parser import arg_parser
 import yaml
 
@@ -12,11 +16,25 @@ This file is used to create replay files with optimal profits for evaluation pur
 The replay files are saved in the replay folder and can be used to evaluate the performance of the RL agent."""
 
 
-def evalreplay(config_file,
-               save_opt_trajectories,
-               save_replay):
+# replay attributes read by PowerTrackingErrorrMin, the cache key is computed from them
+MODEL_INPUTS = ["sim_length", "n_cs", "max_n_ports", "n_transformers", "timescale",
+                "tra_max_amps", "tra_min_amps", "cs_transformer",
+                "port_max_charge_current", "port_min_charge_current",
+                "port_max_discharge_current", "port_min_discharge_current",
+                "voltages", "power_setpoints", "cs_ch_efficiency", "cs_dis_efficiency",
+                "ev_max_energy", "ev_max_ch_power", "ev_max_dis_power",
+                "u", "energy_at_arrival", "ev_arrival", "t_dep"]
+
+# version of the cached solutions, increase it when they change without a change in the source of the
+# model module (e.g. the format of the cached actions or a change in a module the model uses)
+CACHE_VERSION = 1
 
-    verbose = False
+
+def create_replay(config_file, verbose=False):
+    '''
+    This function simulates a random game with all ports charging instantly and
+    saves its replay file. Returns the path of the replay file.
+    '''
 
     env = ev2gym_env.EV2Gym(config_file=config_file,
                                load_from_replay_path=None,
@@ -26,7 +44,7 @@ def evalreplay(config_file,
                                save_replay=True)
 
     new_replay_path = f"replay/replay_{env.sim_name}.pkl"
-    # new_replay_path = replay_path
+    steps = env.simulation_length
 
     _ = env.reset()
     rewards = []
@@ -48,17 +66,131 @@ def evalreplay(config_file,
             # print(f'End of simulation at step {i}')
             exit()
 
-    # Solve optimally
-    math_model = PowerTrackingErrorrMin(replay_path=new_replay_path)
+    return new_replay_path
+
+
+def replay_hash(replay_path, **model_kwargs):
+    '''
+    This function returns the cache key of the optimal solution of a replay.
+
+    The key is a hash of the replay data used by the model and of the model parameters,
+    so replays of different simulations with the same data share their solution. It also includes
+    CACHE_VERSION and the source of the model module, so a change of the formulation is never
+    served from the cache.
+    '''
+    replay = pickle.load(open(replay_path, 'rb'))
+
+    h = hashlib.sha256(PowerTrackingErrorrMin.__name__.encode())
+    h.update(str(CACHE_VERSION).encode())
+    h.update(inspect.getsource(sys.modules[PowerTrackingErrorrMin.__module__]).encode())
+    for name in MODEL_INPUTS:
+        value = np.ascontiguousarray(getattr(replay, name), dtype=float)
+        h.update(name.encode())
+        h.update(str(value.shape).encode())
+        h.update(value.tobytes())
+
+    # the thread count only changes the solving speed
+    params = {k: v for k, v in model_kwargs.items() if k != 'threads'}
+    h.update(repr(sorted(params.items())).encode())
+
+    return h.hexdigest()
+
+
+def solve_replay(replay_path, cache_path=None, **model_kwargs):
+    '''
+    This function solves a replay optimally and stores the actions in cache_path.
+    '''
+    math_model = PowerTrackingErrorrMin(replay_path=replay_path, **model_kwargs)
     opt_actions = math_model.get_actions()
 
+    if cache_path is not None:
+        # write to a temporary file first so that a crash never leaves a partial result
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp.npy'
+        np.save(tmp_path, opt_actions)
+        os.replace(tmp_path, cache_path)
+
+    return opt_actions
+
+
+def solve_replays(replay_paths,
+                  n_workers=1,
+                  threads=None,
+                  cache_dir="./replay/opt_cache/",
+                  **model_kwargs):
+    '''
+    This function solves many replays optimally, in a process pool if n_workers > 1.
+
+    Args:
+        replay_paths: The replay files to solve.
+        n_workers: Number of worker processes.
+        threads: Solver threads of every worker, by default the cores are shared
+            between the workers so the machine is not oversubscribed.
+        cache_dir: Folder of the cached solutions, None disables the cache.
+        model_kwargs: Parameters of the PowerTrackingErrorrMin model.
+
+    Returns the optimal actions of every replay, in the order of replay_paths.
+    '''
+    if threads is None and n_workers > 1:
+        threads = max(1, (os.cpu_count() or 1) // n_workers)
+    if threads is not None:
+        model_kwargs['threads'] = threads
+
+    if cache_dir is not None and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    keys = [replay_hash(path, **model_kwargs) for path in replay_paths]
+
+    # replays with the same data are solved once
+    solutions = {}
+    to_solve = {}
+    for path, key in zip(replay_paths, keys):
+        if key in solutions or key in to_solve:
+            continue
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, f'{key}.npy')
+            if os.path.exists(cache_path):
+                solutions[key] = np.load(cache_path)
+                continue
+        to_solve[key] = (path, cache_path)
+
+    print(f'Solving {len(to_solve)} of {len(replay_paths)} replays, '
+          f'{len(solutions)} found in the cache.')
+
+    if n_workers > 1 and len(to_solve) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = {key: pool.submit(solve_replay, path, cache_path, **model_kwargs)
+                       for key, (path, cache_path) in to_solve.items()}
+            for key, future in futures.items():
+                solutions[key] = future.result()
+    else:
+        for key, (path, cache_path) in to_solve.items():
+            solutions[key] = solve_replay(path, cache_path, **model_kwargs)
+
+    return [solutions[key] for key in keys]
+
+
+def simulate_optimal(config_file,
+                     replay_path,
+                     opt_actions,
+                     save_opt_trajectories,
+                     save_replay,
+                     verbose=False):
+    '''
+    This function simulates the optimal actions of a replay and saves the evaluation replay.
+    '''
+    config = yaml.load(open(config_file, 'r'), Loader=yaml.FullLoader)
+    number_of_charging_stations = config["number_of_charging_stations"]
+    n_transformers = config["number_of_transformers"]
+    steps = config["simulation_length"]
+
     scenario = config_file.split("/")[-1].split(".")[0]
     group_name = f'{number_of_charging_stations}cs_{n_transformers}tr_{scenario}'
 
     # Simulate in the gym environment and get the rewards
     # save replay in the replay folder for evaluating pther algorithms
     env = ev2gym_env.EV2Gym(config_file=config_file,
-                               load_from_replay_path=new_replay_path,
+                               load_from_replay_path=replay_path,
                                replay_save_path="./replay/"+group_name+"/",
                                generate_rnd_game=False,
                                save_plots=False,
@@ -101,11 +233,27 @@ def evalreplay(config_file,
         trajectory_i["dones"] = np.array(trajectory_i["dones"])
 
     # delete the replay file
-    os.remove(new_replay_path)
+    os.remove(replay_path)
 
     return trajectory_i
 
 
+def evalreplay(config_file,
+               save_opt_trajectories,
+               save_replay):
+
+    new_replay_path = create_replay(config_file)
+
+    # Solve optimally
+    opt_actions = solve_replays([new_replay_path])[0]
+
+    return simulate_optimal(config_file,
+                            new_replay_path,
+                            opt_actions,
+                            save_opt_trajectories,
+                            save_replay)
+
+
 if __name__ == "__main__":
 
     args = arg_parser()
@@ -128,16 +276,32 @@ if __name__ == "__main__":
     if not os.path.exists(save_folder_path):
         os.makedirs(save_folder_path)
 
-    for i in range(n_trajectories):
-        print(f'Trajectory: {i}')
-        trajectory = evalreplay(config_file=args.config_file,
-                                save_opt_trajectories=save_opt_trajectories,
-                                save_replay=True)
-        trajectories.append(trajectory)
-
-        if i % 1000 == 0 and save_opt_trajectories:
-            print(f'Saving trajectories to {save_folder_path+file_name}')
-            f = open(save_folder_path+file_name, 'wb')
-            # source, destination
-            pickle.dump(trajectories, f)
-            f.close()
+    # the replays are solved in batches, the batch is shared between the solver workers
+    batch_size = max(1, args.solve_batch_size)
+
+    for start in range(0, n_trajectories, batch_size):
+        batch = range(start, min(start + batch_size, n_trajectories))
+        print(f'Trajectories: {batch.start}-{batch.stop - 1}')
+
+        replay_paths = [create_replay(args.config_file) for _ in batch]
+
+        # Solve optimally
+        opt_actions = solve_replays(replay_paths,
+                                    n_workers=args.n_workers,
+                                    threads=args.solver_threads,
+                                    cache_dir=args.opt_cache_dir)
+
+        for i, replay_path, actions in zip(batch, replay_paths, opt_actions):
+            trajectory = simulate_optimal(config_file=args.config_file,
+                                          replay_path=replay_path,
+                                          opt_actions=actions,
+                                          save_opt_trajectories=save_opt_trajectories,
+                                          save_replay=True)
+            trajectories.append(trajectory)
+
+            if i % 1000 == 0 and save_opt_trajectories:
+                print(f'Saving trajectories to {save_folder_path+file_name}')
+                f = open(save_folder_path+file_name, 'wb')
+                # source, destination
+                pickle.dump(trajectories, f)
+                f.close()
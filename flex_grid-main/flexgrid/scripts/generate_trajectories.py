@@ -1,10 +1,24 @@
+'''
+This script generates offline RL datasets of heuristic trajectories.
+
+The trajectories are generated in parallel in shards of --shard_size trajectories, every shard is
+saved as a compressed .npz file of contiguous arrays as soon as it is done, and the manifest.json of
+the dataset lists the finished shards. Running the same command again resumes the generation, and a
+larger --n_trajectories extends the dataset.
+
+The policy of trajectory i is policies[i % len(policies)], e.g. --policies ASAP,RR alternates
+ChargeAsFastAsPossible and RoundRobin, and --policies ASAP,ASAP,RR uses ASAP for 2/3 of the trajectories.
+
+Example:
+    python -m ev2gym.scripts.generate_trajectories --config_file ev2gym/example_config_files/PublicPST.yaml --n_trajectories 10000 --n_workers 8
+'''
 
 import os
-import time
+import json
 import numpy as np
-import pickle
 import yaml
-from tqdm import tqdm 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
 
 from ev2gym.models import ev2gym_env
 from ev2gym.utilities.arg_parser import arg_parser
@@ -12,94 +26,255 @@ from ev2gym.rl_agent.reward import SquaredTrackingErrorReward, ProfitMax_TrPenal
 from ev2gym.rl_agent.state import V2G_profit_max, PublicPST, V2G_profit_max_loads
 from ev2gym.baselines.heuristics import RoundRobin, ChargeAsLateAsPossible, ChargeAsFastAsPossible
 
-if __name__ == "__main__":
+POLICIES = {'ASAP': ChargeAsFastAsPossible,
+            'RR': RoundRobin,
+            'ALAP': ChargeAsLateAsPossible}
 
-    args = arg_parser()
+PROBLEMS = {'PublicPST': (SquaredTrackingErrorReward, PublicPST),
+            'V2GProfitMax': (profit_maximization, V2G_profit_max),
+            'V2GProfitPlusLoads': (ProfitMax_TrPenalty_UserIncentives, V2G_profit_max_loads)}
 
-    # Define the directory where to save and load models
-    checkpoint_dir = args.save_dir + args.env
+SHARD_KEYS = ["observations", "actions", "rewards", "dones", "masks"]
+
+
+def parse_policies(policies):
+    '''
+    This function returns the list of policy names of a comma separated string, e.g. "ASAP,RR".
+    '''
+    names = [name.strip() for name in policies.split(',') if name.strip()]
+    for name in names:
+        if name not in POLICIES:
+            raise ValueError(f"Unknown policy {name}, choose from {list(POLICIES.keys())}")
+    return names
 
-    reward_function = SquaredTrackingErrorReward
-    state_function = PublicPST
-    problem = "PublicPST"
 
-    env = ev2gym_env.EV2Gym(config_file=args.config_file,
+def generate_shard(config_file, problem, policies, seed, first, n_trajectories, shard_path):
+    '''
+    This function generates the trajectories first:first + n_trajectories and saves them in shard_path.
+
+    Trajectory i is simulated with seed + i, so a shard is the same whatever the number of workers.
+    The steps of all the trajectories are stored one after the other, lengths[i] is the number of
+    steps of trajectory i, observations[t] is the observation before actions[t] and masks[t]
+    are the ports with a connected EV in observations[t].
+
+    Returns the number of steps of the shard.
+    '''
+    reward_function, state_function = PROBLEMS[problem]
+
+    env = ev2gym_env.EV2Gym(config_file=config_file,
                             generate_rnd_game=True,
+                            seed=seed + first,
                             state_function=state_function,
-                            reward_function=reward_function)
-    
-    n_trajectories = args.n_trajectories
-    config = yaml.load(open(args.config_file, 'r'), Loader=yaml.FullLoader)
-    number_of_charging_stations = config["number_of_charging_stations"]
-    n_transformers = config["number_of_transformers"]
-    steps = config["simulation_length"]
-    timescale = config["timescale"]
-    
-    trajectories = []
-
-    # if args.dataset not in ["ddpg", "random", "optimal"]:
-    #     raise ValueError("Dataset not supported")
-
-    trajecotries_type = "mixed-RR-Asap" #args.dataset
-
-    file_name = f"{problem}_{trajecotries_type}_{number_of_charging_stations}_cs_{n_transformers}_tr_{steps}_steps_{timescale}_timescale_{n_trajectories}_trajectories2.pkl"
-    save_folder_path = f"./trajectories/"
-    if not os.path.exists(save_folder_path):
-        os.makedirs(save_folder_path)
-
-    epoch = 0
-    # use tqdm with a fancy bar
-    for i in tqdm(range(n_trajectories)):
-
-        trajectory_i = {"observations": [],
-                        "actions": [],
-                        "rewards": [],
-                        "dones": []}
-
-        epoch_return = 0
-
-        # print(f'Trajectory: {i}')
-        state, _ = env.reset()
-        if i % 2 == 0:
-            agent = ChargeAsFastAsPossible(env)
-        else:
-            agent = RoundRobin(env)
-        
-        test_reward = 0
-        while True:
+                            reward_function=reward_function,
+                            # the observations are copied into the shard arrays
+                            copy_observations=False)
+
+    # the shard is filled in preallocated arrays and trimmed if some trajectories end early
+    capacity = n_trajectories * env.simulation_length
+    data = {"observations": np.zeros((capacity,) + env.observation_space.shape,
+                                     dtype=env.observation_space.dtype),
+            "actions": np.zeros((capacity,) + env.action_space.shape,
+                                dtype=env.action_space.dtype),
+            "rewards": np.zeros(capacity),
+            "dones": np.zeros(capacity, dtype=bool),
+            "masks": np.zeros((capacity, env.number_of_ports), dtype=bool)}
+    lengths = np.zeros(n_trajectories, dtype=np.int64)
+    policy_ids = np.zeros(n_trajectories, dtype=np.int64)
+
+    t = 0
+    for i in range(n_trajectories):
+        trajectory = first + i
+        state, _ = env.reset(seed=seed + trajectory)
+
+        policy_ids[i] = trajectory % len(policies)
+        agent = POLICIES[policies[policy_ids[i]]](env=env)
 
+        start = t
+        while True:
             actions = agent.get_action(env)
 
-            new_state, reward, done, truncated, _ = env.step(actions)
-            test_reward += reward
+            data["observations"][t] = state
+            data["actions"][t] = actions
+            # ports with a connected EV when the observation was taken
+            data["masks"][t] = env.port_mask
+
+            state, reward, done, truncated, info = env.step(actions)
 
-            trajectory_i["observations"].append(state)
-            trajectory_i["actions"].append(actions)
-            trajectory_i["rewards"].append(reward)
-            trajectory_i["dones"].append(done)            
-            state = new_state
+            data["rewards"][t] = reward
+            data["dones"][t] = done
+            t += 1
 
             if done:
                 break
 
-        trajectory_i["observations"] = np.array(trajectory_i["observations"])
-        trajectory_i["actions"] = np.array(trajectory_i["actions"])
-        trajectory_i["rewards"] = np.array(trajectory_i["rewards"])
-        trajectory_i["dones"] = np.array(trajectory_i["dones"])
+        lengths[i] = t - start
 
-        trajectories.append(trajectory_i)
+    env.close()
 
-        if i % 100000 == 0:
-            print(f'Saving trajectories to {save_folder_path+file_name}')
-            f = open(save_folder_path+file_name, 'wb')
-            # source, destination
-            pickle.dump(trajectories, f)
+    data = {key: value[:t] for key, value in data.items()}
 
-    env.close()
-    print(trajectories[:1])
+    # write to a temporary file first so that a crash never leaves a partial shard
+    tmp_path = f'{shard_path}.{os.getpid()}.tmp.npz'
+    np.savez_compressed(tmp_path,
+                        lengths=lengths,
+                        policies=policy_ids,
+                        seeds=seed + first + np.arange(n_trajectories),
+                        **data)
+    os.replace(tmp_path, shard_path)
+
+    return t
+
+
+def load_manifest(dataset_path, settings, state_function):
+    '''
+    This function returns the manifest of the dataset, or a new one if the dataset does not exist.
+    The settings of an existing dataset must be the same, otherwise its shards can not be reused.
+
+    The name of the state function is kept next to the settings, manifests of older datasets
+    without it (or with it in the settings) are updated.
+    '''
+    manifest_path = os.path.join(dataset_path, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return {'settings': settings, 'state_function': state_function, 'shards': {}}
+
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+
+    manifest['settings'].pop('state_function', None)
+    manifest['state_function'] = state_function
+
+    if manifest['settings'] != settings:
+        raise ValueError(f"The dataset at {dataset_path} was generated with different settings:\n"
+                         f"{manifest['settings']}\nUse another --trajectories_dir or the same settings.")
+
+    # shards listed in the manifest but missing on disk are generated again
+    manifest['shards'] = {key: shard for key, shard in manifest['shards'].items()
+                          if os.path.exists(os.path.join(dataset_path, shard['file']))}
+    return manifest
+
+
+def save_manifest(dataset_path, manifest):
+    '''
+    This function saves the manifest of the dataset, the shards are sorted by first trajectory.
+    '''
+    manifest['shards'] = dict(sorted(manifest['shards'].items(),
+                                     key=lambda item: item[1]['first_trajectory']))
+    manifest['n_trajectories'] = sum(shard['n_trajectories']
+                                     for shard in manifest['shards'].values())
+    manifest['n_steps'] = sum(shard['n_steps'] for shard in manifest['shards'].values())
+
+    manifest_path = os.path.join(dataset_path, 'manifest.json')
+    tmp_path = f'{manifest_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def generate_dataset(config_file,
+                     dataset_path,
+                     n_trajectories,
+                     problem="PublicPST",
+                     policies=("ASAP", "RR"),
+                     shard_size=1000,
+                     n_workers=1,
+                     seed=42):
+    '''
+    This function generates the missing shards of the dataset, in a process pool if n_workers > 1.
+    The manifest is updated after every finished shard. Returns the manifest.
+    '''
+    policies = list(policies)
+    os.makedirs(dataset_path, exist_ok=True)
+
+    settings = {'config': yaml.load(open(config_file, 'r'), Loader=yaml.FullLoader),
+                'problem': problem,
+                'policies': policies,
+                'shard_size': shard_size,
+                'seed': seed,
+                'keys': SHARD_KEYS}
+    manifest = load_manifest(dataset_path, settings, PROBLEMS[problem][1].__name__)
+
+    to_generate = []
+    for first in range(0, n_trajectories, shard_size):
+        name = f'shard_{first // shard_size:06d}'
+        n = min(shard_size, n_trajectories - first)
+        shard = manifest['shards'].get(name)
+        # the last shard of a smaller dataset is generated again with all its trajectories
+        if shard is not None and shard['n_trajectories'] == n:
+            continue
+        to_generate.append((name, first, n))
+
+    print(f'Generating {len(to_generate)} shards, '
+          f'{len(manifest["shards"])} found in {dataset_path}')
+
+    def add_shard(name, first, n, n_steps):
+        manifest['shards'][name] = {'file': f'{name}.npz',
+                                    'first_trajectory': first,
+                                    'n_trajectories': n,
+                                    'n_steps': n_steps}
+        save_manifest(dataset_path, manifest)
+
+    if n_workers > 1 and len(to_generate) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = {pool.submit(generate_shard, config_file, problem, policies, seed,
+                                   first, n, os.path.join(dataset_path, f'{name}.npz')):
+                       (name, first, n) for name, first, n in to_generate}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                add_shard(*futures[future], future.result())
+    else:
+        for name, first, n in tqdm(to_generate):
+            n_steps = generate_shard(config_file, problem, policies, seed,
+                                     first, n, os.path.join(dataset_path, f'{name}.npz'))
+            add_shard(name, first, n, n_steps)
+
+    save_manifest(dataset_path, manifest)
+    return manifest
+
+
+def iter_trajectories(dataset_path):
+    '''
+    This function yields the trajectories of a dataset as dictionaries of arrays,
+    in the same format as the old pickled trajectory lists.
+    '''
+    with open(os.path.join(dataset_path, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+
+    for shard in manifest['shards'].values():
+        with np.load(os.path.join(dataset_path, shard['file'])) as data:
+            arrays = {key: data[key] for key in SHARD_KEYS}
+            ends = np.cumsum(data['lengths'])
+
+        for end, length in zip(ends, np.diff(ends, prepend=0)):
+            yield {key: value[end - length:end] for key, value in arrays.items()}
+
+
+if __name__ == "__main__":
+
+    args = arg_parser()
+
+    problem = "PublicPST"
+    policies = parse_policies(args.policies)
+
+    config = yaml.load(open(args.config_file, 'r'), Loader=yaml.FullLoader)
+    number_of_charging_stations = config["number_of_charging_stations"]
+    n_transformers = config["number_of_transformers"]
+    steps = config["simulation_length"]
+    timescale = config["timescale"]
+
+    trajecotries_type = "mixed-" + "-".join(dict.fromkeys(policies)) \
+        if len(set(policies)) > 1 else policies[0]
+
+    # the dataset folder does not depend on n_trajectories, so a larger dataset extends it
+    dataset_name = f"{problem}_{trajecotries_type}_{number_of_charging_stations}_cs_{n_transformers}_tr_{steps}_steps_{timescale}_timescale"
+    dataset_path = os.path.join(args.trajectories_dir, dataset_name)
+
+    manifest = generate_dataset(args.config_file,
+                                dataset_path,
+                                args.n_trajectories,
+                                problem=problem,
+                                policies=policies,
+                                shard_size=args.shard_size,
+                                n_workers=args.n_workers,
+                                seed=args.seed)
 
-    print(f'Saving trajectories to {save_folder_path+file_name}')
-    f = open(save_folder_path+file_name, 'wb')
-    # source, destination
-    pickle.dump(trajectories, f)
-    f.close()
+    print(f'Saved {manifest["n_trajectories"]} trajectories ({manifest["n_steps"]} steps) '
+          f'in {len(manifest["shards"])} shards at {dataset_path}')
@@ -43,11 +43,27 @@ def arg_parser():
     # Generate trajectories specific arguments
     parser.add_argument("--n_trajectories", default=200_000, type=int,
                         help="Num. of trajectories to generate (default: 10)")
+    parser.add_argument("--policies", default="ASAP,RR", type=str,
+                        help="Comma separated policies, trajectory i uses the (i %% n)-th one (default: ASAP,RR)")
+    parser.add_argument("--shard_size", default=1000, type=int,
+                        help="Num. of trajectories saved in every shard file (default: 1000)")
+    parser.add_argument("--trajectories_dir", default="./trajectories/", type=str,
+                        help="Dir. path of the generated datasets (default: ./trajectories/)")
     
     #
     parser.add_argument("--dataset", default="RR", type=str)
     parser.add_argument("--save_opt_trajectories", default=True, type=bool,
                         help="Save Optimal trajectories (default: False)")
+
+    # Optimal replay solving specific arguments
+    parser.add_argument("--n_workers", default=1, type=int,
+                        help="Num. of worker processes solving the optimal problems or generating trajectories (default: 1)")
+    parser.add_argument("--solver_threads", default=None, type=int,
+                        help="Solver threads per worker (default: cores / n_workers)")
+    parser.add_argument("--solve_batch_size", default=100, type=int,
+                        help="Num. of replays solved together (default: 100)")
+    parser.add_argument("--opt_cache_dir", default="./replay/opt_cache/", type=str,
+                        help="Dir. path of the cached optimal solutions (default: ./replay/opt_cache/)")
     
 
     return parser.parse_args()
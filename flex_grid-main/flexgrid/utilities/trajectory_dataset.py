@@ -0,0 +1,316 @@
+'''
+This file contains the memory-mapped reader of the offline RL datasets of scripts/generate_trajectories.py.
+'''
+
+import os
+import json
+import queue
+import tempfile
+import threading
+import shutil
+
+import numpy as np
+import yaml
+
+from ev2gym.rl_agent import state as state_functions
+
+STEP_KEYS = ["observations", "actions", "rewards", "dones", "masks"]
+
+
+def shard_stamp(dataset_path, shard) -> dict:
+    '''
+    This function returns the identity of a compressed shard: its entry in the manifest and the size
+    and modification time of its file, which change when the shard is generated again.
+    '''
+    info = os.stat(os.path.join(dataset_path, shard['file']))
+    return {'n_trajectories': shard['n_trajectories'],
+            'n_steps': shard['n_steps'],
+            'size': info.st_size,
+            'mtime_ns': info.st_mtime_ns}
+
+
+def unpack_shard(dataset_path, shard) -> str:
+    '''
+    This function unpacks a compressed shard into a folder with one .npy file per array,
+    which can be memory-mapped. It also saves the returns-to-go of every step.
+    Returns the path of the folder, a shard is unpacked again only if it was generated again
+    (e.g. the last shard when the dataset is extended).
+    '''
+    name = os.path.splitext(shard['file'])[0]
+    folder = os.path.join(dataset_path, name)
+    stamp = shard_stamp(dataset_path, shard)
+
+    stamp_file = os.path.join(folder, 'shard.json')
+    if os.path.exists(stamp_file):
+        with open(stamp_file, 'r') as f:
+            if json.load(f) == stamp:
+                return folder
+
+    tmp_folder = f'{folder}.{os.getpid()}.tmp'
+    os.makedirs(tmp_folder, exist_ok=True)
+
+    with np.load(os.path.join(dataset_path, shard['file'])) as data:
+        for key in data.files:
+            np.save(os.path.join(tmp_folder, f'{key}.npy'), data[key])
+
+        rewards = data['rewards']
+        lengths = data['lengths']
+
+    # sum of the rewards from every step to the end of its trajectory
+    returns_to_go = np.zeros_like(rewards)
+    start = 0
+    for length in lengths:
+        end = start + length
+        returns_to_go[start:end] = np.cumsum(rewards[start:end][::-1])[::-1]
+        start = end
+    np.save(os.path.join(tmp_folder, 'returns_to_go.npy'), returns_to_go)
+
+    # the stamp is written last, so a folder with a stamp is complete
+    with open(os.path.join(tmp_folder, 'shard.json'), 'w') as f:
+        json.dump(stamp, f)
+
+    # an outdated folder is moved away first, arrays that are already memory-mapped stay valid
+    if os.path.exists(folder):
+        old_folder = f'{folder}.{os.getpid()}.old'
+        try:
+            os.rename(folder, old_folder)
+            shutil.rmtree(old_folder)
+        except OSError:
+            pass
+
+    # another process may have unpacked the same shard in the meantime
+    try:
+        os.rename(tmp_folder, folder)
+    except OSError:
+        shutil.rmtree(tmp_folder)
+
+    return folder
+
+
+def get_observation_indices(env, state_function):
+    '''
+    This function returns the indices of the features in the observations of the state function.
+
+    Returns a dictionary with:
+        header: (n_header,) indices of the features that are not of a transformer or a port.
+        transformer: (n_transformers, n_tr_features) indices of the features of every transformer.
+        port: (n_ports, n_ev_features) indices of the features of every port, in the order of the
+            actions and the masks (the observation groups the ports by transformer).
+    '''
+    env.reset()
+    state_function(env)
+    layout = env.observation_layout
+
+    return {'header': np.arange(layout.n_header),
+            'transformer': np.asarray(layout.tr_offsets, dtype=np.int64)[:, np.newaxis] +
+            np.arange(layout.n_tr_features),
+            'port': layout.port_indices}
+
+
+class TrajectoryDataset():
+    '''
+    This class serves minibatches of trajectory windows of an offline RL dataset, the shards are
+    memory-mapped so only the read windows are loaded in RAM.
+
+    Sample t is the window of context_length steps of its trajectory that ends at step t, windows at
+    the start of a trajectory are padded with zeros on the left (attention_mask is False there).
+    Every batch is a dictionary of arrays of shape (batch_size, context_length, ...) with the keys
+    observations, actions, rewards, dones, masks, returns_to_go, timesteps and attention_mask.
+
+    The order of the samples of every epoch is a permutation of seed and epoch, so the batches are the
+    same in every run. The batches are built by a background thread, prefetch batches ahead.
+
+    If split_observations is True, the observations are replaced by the features of the observation
+    layout of the state function: header_features (..., n_header), transformer_features
+    (..., n_transformers, n_tr_features) and port_features (..., n_ports, n_ev_features).
+    '''
+
+    def __init__(self,
+                 dataset_path,
+                 context_length=20,
+                 batch_size=64,
+                 shuffle=True,
+                 seed=0,
+                 prefetch=2,
+                 drop_last=False,
+                 split_observations=False):
+
+        self.dataset_path = dataset_path
+        self.context_length = context_length
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.prefetch = prefetch
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        with open(os.path.join(dataset_path, 'manifest.json'), 'r') as f:
+            self.manifest = json.load(f)
+
+        self.shards = []
+        shard_starts = []
+        trajectory_starts = []
+        n_steps = 0
+        for shard in self.manifest['shards'].values():
+            folder = unpack_shard(dataset_path, shard)
+            arrays = {key: np.load(os.path.join(folder, f'{key}.npy'), mmap_mode='r')
+                      for key in STEP_KEYS + ['returns_to_go']}
+            lengths = np.load(os.path.join(folder, 'lengths.npy'))
+
+            self.shards.append(arrays)
+            shard_starts.append(n_steps)
+            trajectory_starts.append(n_steps + np.cumsum(lengths) - lengths)
+            n_steps += int(lengths.sum())
+
+        self.n_steps = n_steps
+        self.shard_starts = np.asarray(shard_starts, dtype=np.int64)
+        self.trajectory_starts = np.concatenate(trajectory_starts).astype(np.int64) \
+            if trajectory_starts else np.zeros(0, dtype=np.int64)
+
+        self.observation_indices = None
+        if split_observations:
+            self.observation_indices = self.load_observation_indices()
+
+    def load_observation_indices(self):
+        '''
+        This function builds an environment with the configuration of the dataset to read the
+        observation layout of its state function (e.g. PublicPST or V2G_profit_max_loads).
+        '''
+        from ev2gym.models.ev2gym_env import EV2Gym
+
+        settings = self.manifest['settings']
+        name = self.manifest.get('state_function', settings.get('state_function'))
+        if name is None:
+            raise ValueError(f"The manifest of {self.dataset_path} has no state function, run "
+                             "scripts/generate_trajectories.py with the same settings to update it.")
+        state_function = getattr(state_functions, name)
+
+        with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as f:
+            yaml.dump(settings['config'], f)
+            tmp_config = f.name
+
+        try:
+            env = EV2Gym(config_file=tmp_config, state_function=state_function)
+        finally:
+            os.remove(tmp_config)
+
+        return get_observation_indices(env, state_function)
+
+    def __len__(self):
+        if self.drop_last:
+            return self.n_steps // self.batch_size
+        return -(-self.n_steps // self.batch_size)
+
+    def set_epoch(self, epoch) -> None:
+        self.epoch = epoch
+
+    def sample_order(self, epoch) -> np.ndarray:
+        '''
+        This function returns the order of the samples of the epoch.
+        '''
+        if not self.shuffle:
+            return np.arange(self.n_steps)
+        rng = np.random.default_rng([self.seed, epoch])
+        return rng.permutation(self.n_steps)
+
+    def get_batch(self, samples) -> dict:
+        '''
+        This function returns the windows that end at the steps samples.
+        '''
+        samples = np.asarray(samples, dtype=np.int64)
+        k = self.context_length
+
+        # the first step of the trajectory of every sample
+        trajectory_start = self.trajectory_starts[
+            np.searchsorted(self.trajectory_starts, samples, side='right') - 1]
+        steps = samples[:, np.newaxis] - np.arange(k - 1, -1, -1)
+        valid = steps >= trajectory_start[:, np.newaxis]
+        steps = np.where(valid, steps, trajectory_start[:, np.newaxis])
+
+        batch = {}
+        shard_ids = np.searchsorted(self.shard_starts, samples, side='right') - 1
+        for shard_id in np.unique(shard_ids):
+            rows = np.flatnonzero(shard_ids == shard_id)
+            local_steps = steps[rows] - self.shard_starts[shard_id]
+
+            for key, array in self.shards[shard_id].items():
+                if key not in batch:
+                    batch[key] = np.zeros((len(samples), k) + array.shape[1:],
+                                          dtype=array.dtype)
+                # only the pages of the read windows are loaded
+                batch[key][rows] = array[local_steps]
+
+        for key, value in batch.items():
+            value[~valid] = 0
+
+        batch['timesteps'] = np.where(valid, steps - trajectory_start[:, np.newaxis], 0)
+        batch['attention_mask'] = valid
+
+        if self.observation_indices is not None:
+            observations = batch.pop('observations')
+            batch['header_features'] = observations[..., self.observation_indices['header']]
+            batch['transformer_features'] = observations[..., self.observation_indices['transformer']]
+            batch['port_features'] = observations[..., self.observation_indices['port']]
+
+        return batch
+
+    def batches(self, epoch):
+        '''
+        This function yields the indices of the samples of every batch of the epoch.
+        '''
+        order = self.sample_order(epoch)
+        for start in range(0, self.n_steps, self.batch_size):
+            samples = order[start:start + self.batch_size]
+            if self.drop_last and len(samples) < self.batch_size:
+                break
+            yield samples
+
+    def __iter__(self):
+        '''
+        This function yields the batches of the current epoch, the next iteration uses the next epoch.
+        '''
+        epoch = self.epoch
+        self.epoch += 1
+
+        if self.prefetch <= 0:
+            for samples in self.batches(epoch):
+                yield self.get_batch(samples)
+            return
+
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        end = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def producer():
+            try:
+                for samples in self.batches(epoch):
+                    if not put(self.get_batch(samples)):
+                        return
+                put(end)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                batch = batches.get()
+                if batch is end:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            # the consumer may stop before the end of the epoch
+            stop.set()
+            thread.join()
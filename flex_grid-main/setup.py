@@ -32,6 +32,7 @@ setup(
         'matplotlib',
         'pandas',
         'networkx',
+        'scipy',
         'gurobipy',
     ]
 )
@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+import ev2gym
+from ev2gym.models.ev2gym_env import EV2Gym
+
+# the example config files use paths relative to the parent of the package
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(ev2gym.__file__)))
+CONFIG_DIR = os.path.join('ev2gym', 'example_config_files')
+
+
+@pytest.fixture
+def config_path(monkeypatch):
+    '''
+    This fixture returns a function returning the path of an example config file, the tests run from
+    the parent of the package so that the data files of the config are found.
+    '''
+    monkeypatch.chdir(ROOT)
+
+    def path(config='V2GProfitMax.yaml'):
+        return os.path.join(CONFIG_DIR, config)
+
+    return path
+
+
+@pytest.fixture
+def make_env(config_path):
+    '''
+    This fixture returns a function creating a reset environment from an example config file.
+    '''
+
+    def make(config='V2GProfitMax.yaml', seed=0):
+        env = EV2Gym(config_file=config_path(config), seed=seed)
+        env.reset(seed=seed)
+        return env
+
+    return make
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from ev2gym.rl_agent.action_wrappers import water_filling
+
+
+def bisection_water_filling(values, groups, budgets, iterations=200):
+    '''
+    This function reduces the values of every group over its budget to max(value - level, 0),
+    with the level found by bisection.
+    '''
+    values = values.copy()
+    for g, budget in enumerate(np.maximum(budgets, 0)):
+        members = groups == g
+        if values[members].sum() <= budget:
+            continue
+
+        low, high = 0.0, values[members].max()
+        for _ in range(iterations):
+            level = (low + high) / 2
+            if np.maximum(values[members] - level, 0).sum() > budget:
+                low = level
+            else:
+                high = level
+        values[members] = np.maximum(values[members] - high, 0)
+
+    return values
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_water_filling_matches_bisection(seed):
+    rng = np.random.default_rng(seed)
+    n_groups = rng.integers(1, 10)
+    n = rng.integers(1, 50)
+
+    values = rng.uniform(0, 10, n)
+    # ties and zeros
+    values[rng.random(n) < 0.2] = 0
+    values[rng.random(n) < 0.2] = 5
+    groups = rng.integers(0, n_groups, n)
+    budgets = rng.uniform(-5, 60, n_groups)
+
+    result = water_filling(values, groups, budgets)
+
+    np.testing.assert_allclose(result, bisection_water_filling(values, groups, budgets),
+                               atol=1e-9)
+    assert np.all(np.bincount(groups, result, minlength=n_groups) <=
+                  np.maximum(budgets, 0) + 1e-9)
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from scipy import sparse
+
+from ev2gym.baselines.mpc.decomposition import DecomposedSolver
+from ev2gym.baselines.mpc.solvers import MILP, get_solver
+
+
+def coupled_problem(seed, n_groups=4, n=5, binary=False, coupling_lb=-np.inf, coupling_ub=25):
+    '''
+    This function builds a problem with n_groups groups of n variables, every group has its own
+    limit and a coupling constraint limits the sum of all the variables (by default to 25).
+    '''
+    rng = np.random.default_rng(seed)
+    N = n_groups * n
+
+    problem = MILP("coupled")
+    problem.add_variables("x", N, lb=0, ub=10)
+    if binary:
+        problem.add_variables("z", N, binary=True)
+        problem.add_constraints({"x": sparse.identity(N), "z": -10 * sparse.identity(N)}, ub=0)
+
+    problem.add_constraints({"x": sparse.kron(sparse.identity(n_groups), np.ones((1, n)))}, ub=30)
+    problem.add_constraints({"x": np.ones((1, N))}, lb=coupling_lb, ub=coupling_ub,
+                            coupling=True)
+
+    objective = {"x": -rng.uniform(1, 3, N)}
+    if binary:
+        objective["z"] = rng.uniform(0, 1, N)
+    problem.set_objective(objective)
+
+    groups = np.repeat(np.arange(n_groups), n)
+    problem.groups = np.concatenate([groups, groups]) if binary else groups
+    return problem
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_decomposed_lp_matches_monolithic(seed):
+    problem = coupled_problem(seed)
+    monolithic = get_solver("highs").solve(problem)
+
+    solver = DecomposedSolver("highs")
+    result = solver.solve(problem)
+    solver.close()
+
+    assert result.status == "optimal"
+    assert result.objective == pytest.approx(monolithic.objective,
+                                             rel=solver.gap_tolerance)
+    assert result.x[problem.variables["x"]].sum() <= 25 + solver.tolerance
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_decomposed_milp_is_feasible_and_bounded(seed):
+    problem = coupled_problem(seed, binary=True)
+    monolithic = get_solver("highs").solve(problem)
+
+    solver = DecomposedSolver("highs")
+    result = solver.solve(problem)
+    solver.close()
+
+    # the recovered solution meets the coupling constraint and the duality gap bounds its distance
+    # from the optimum, it is only reported as optimal when the gap is closed
+    assert result.status in ("optimal", "suboptimal")
+    assert result.x[problem.variables["x"]].sum() <= 25 + solver.tolerance
+    assert result.objective >= monolithic.objective - 1e-6
+    assert result.objective - solver.gap <= monolithic.objective + 1e-6
+    if result.status == "optimal":
+        assert result.objective == pytest.approx(monolithic.objective,
+                                                 rel=solver.gap_tolerance)
+
+
+def test_decomposed_solver_without_feasible_solution():
+    # the groups can use at most 4 x 30 = 120 in total
+    problem = coupled_problem(0, coupling_lb=150, coupling_ub=np.inf)
+
+    solver = DecomposedSolver("highs", max_iterations=20)
+    result = solver.solve(problem)
+    solver.close()
+
+    assert result.status == "not_converged"
+    assert result.x is None
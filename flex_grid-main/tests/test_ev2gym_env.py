@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("config", ["PublicPST.yaml", "V2GProfitMax.yaml"])
+def test_observations_are_not_overwritten_by_default(make_env, config):
+    env = make_env(config)
+    rng = np.random.default_rng(0)
+
+    observations = [env.reset(seed=0)[0]]
+    snapshots = [observations[0].copy()]
+    for _ in range(20):
+        observation, *_ = env.step(rng.uniform(0, 1, env.number_of_ports))
+        observations.append(observation)
+        snapshots.append(observation.copy())
+
+    for observation, snapshot in zip(observations, snapshots):
+        np.testing.assert_array_equal(observation, snapshot)
+
+
+def test_in_place_observations_match_copies(make_env):
+    env = make_env("PublicPST.yaml")
+    in_place = make_env("PublicPST.yaml")
+    in_place.copy_observations = False
+    rng = np.random.default_rng(0)
+
+    observation, in_place_observation = env.reset(seed=0)[0], in_place.reset(seed=0)[0]
+    for _ in range(20):
+        np.testing.assert_array_equal(observation, in_place_observation)
+        actions = rng.uniform(0, 1, env.number_of_ports)
+        observation, *_ = env.step(actions)
+        in_place_observation, *_ = in_place.step(actions)
+
+    # the same buffer is returned at every step of an episode
+    assert in_place.step(actions)[0] is in_place_observation
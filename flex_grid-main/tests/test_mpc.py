@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from ev2gym.baselines.mpc.eMPC import eMPC_V2G
+from ev2gym.baselines.mpc.ocmf_mpc import OCMF_V2G
+from ev2gym.baselines.mpc.solvers import get_solver
+
+
+def dense_prediction_matrix(model):
+    '''
+    This function builds Gu with dense products of the station models, as before the sparse shift update.
+    '''
+    h, na, nb = model.control_horizon, model.na, model.nb
+    n = model.n_ports
+    c = nb // na
+
+    # the full station models of every step
+    Amono = np.stack([np.diag(model.Amono[:, k]) for k in range(h + 1)], axis=2)
+    Bmono = np.zeros((na, nb, h + 1))
+    for k in range(h + 1):
+        for p in range(n):
+            Bmono[p, p * c:(p + 1) * c, k] = model.Bmono[p, :, k]
+
+    Gu = np.zeros((h * na, h * nb))
+    for i in range(h):
+        Bbar = Bmono[:, :, 0]
+        for j in range(i + 1):
+            Abar = np.eye(n)
+            if i == j:
+                Gu[i * na:(i + 1) * na, j * nb:(j + 1) * nb] = Bmono[:, :, j]
+            else:
+                for m in range(j + 1, i + 1):
+                    Abar = Abar @ Amono[:, :, m]
+                Gu[i * na:(i + 1) * na, j * nb:(j + 1) * nb] = Abar @ Bbar
+
+            Bbar = Bmono[:, :, j]
+
+    return Gu
+
+
+def test_prediction_matrix_shift_matches_dense_rebuild(make_env):
+    env = make_env()
+    model = eMPC_V2G(env, control_horizon=10, solver='highs')
+
+    shifted = 0
+    for _ in range(30):
+        previous_step = getattr(model, '_Gu_step', None)
+        actions = model.get_action(env)
+
+        if previous_step is not None and model._Gu_step == previous_step + 1:
+            shifted += 1
+        np.testing.assert_allclose(model.Gu.toarray(), dense_prediction_matrix(model),
+                                   rtol=1e-12, atol=1e-12)
+
+        env.step(actions)
+
+    assert shifted == 29
+    model.close()
+
+
+def test_lp_fast_path_matches_milp(make_env):
+    env = make_env()
+    model = eMPC_V2G(env, control_horizon=10, solver='highs')
+    milp_solver = get_solver('highs')
+
+    solve_v2g = model.solve_v2g
+    compared = []
+
+    def compare(build_problem, t=None):
+        result = solve_v2g(build_problem, t)
+        if model.binaries_redundant(t):
+            milp = milp_solver.solve(build_problem(relaxed=False))
+            assert result.status == milp.status == "optimal"
+            assert result.objective == pytest.approx(milp.objective, rel=1e-6, abs=1e-6)
+            assert not model.has_overlap(result.get("u"))
+            compared.append(t)
+        return result
+
+    model.solve_v2g = compare
+    for _ in range(30):
+        env.step(model.get_action(env))
+
+    assert len(compared) == 30
+    assert model.lp_solves > 0
+    model.close()
+
+
+def test_ocmf_v2g_never_drops_binaries_in_auto_mode(make_env):
+    env = make_env()
+    model = OCMF_V2G(env, control_horizon=10, solver='highs')
+
+    assert not model.binaries_redundant(0)
+    model.close()
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("stable_baselines3")
+
+from ev2gym.models.ev2gym_env import EV2Gym
+from ev2gym.rl_agent.reward import SquaredTrackingErrorReward, profit_maximization
+from ev2gym.rl_agent.vec_env import make_ev2gym_vec_env
+
+N_ENVS = 2
+SEED = 7
+# more than one episode, so every environment is reset automatically once
+STEPS = 130
+# step at which the reward function is changed
+CHANGE_STEP = 20
+
+
+def run_sequential(config, actions, change_reward):
+    '''
+    This function runs the environments one by one with the seeds of the vectorized environment:
+    environment i is created with SEED + i and its episode k is reset with SEED + i + k * N_ENVS.
+    '''
+    envs = [EV2Gym(config_file=config, seed=SEED + i, generate_rnd_game=True,
+                   reward_function=SquaredTrackingErrorReward)
+            for i in range(N_ENVS)]
+    episodes = [0] * N_ENVS
+    observations = [env.reset(seed=SEED + i)[0] for i, env in enumerate(envs)]
+
+    history = {'observations': [np.array(observations)], 'rewards': [], 'dones': [],
+               'terminal_observations': []}
+    for step, action in enumerate(actions):
+        if change_reward and step == CHANGE_STEP:
+            for env in envs:
+                env.set_reward_function(profit_maximization)
+
+        rewards, dones = [], []
+        for i, env in enumerate(envs):
+            observation, reward, terminated, truncated, _ = env.step(action[i])
+            if terminated or truncated:
+                history['terminal_observations'].append((step, i, observation))
+                episodes[i] += 1
+                observation, _ = env.reset(seed=SEED + i + episodes[i] * N_ENVS)
+            observations[i] = observation
+            rewards.append(reward)
+            dones.append(terminated or truncated)
+
+        history['observations'].append(np.array(observations))
+        history['rewards'].append(rewards)
+        history['dones'].append(dones)
+
+    return history
+
+
+def run_vectorized(config, actions, change_reward):
+    venv = make_ev2gym_vec_env(config, N_ENVS, n_workers=2, seed=SEED, prefetch=True,
+                               start_method='spawn',
+                               reward_function=SquaredTrackingErrorReward)
+    try:
+        history = {'observations': [venv.reset()], 'rewards': [], 'dones': [],
+                   'terminal_observations': []}
+        for step, action in enumerate(actions):
+            if change_reward and step == CHANGE_STEP:
+                venv.env_method('set_reward_function', profit_maximization)
+
+            observations, rewards, dones, infos = venv.step(action)
+            history['observations'].append(observations)
+            history['rewards'].append(rewards)
+            history['dones'].append(dones)
+            history['terminal_observations'] += [(step, i, info['terminal_observation'])
+                                                 for i, info in enumerate(infos) if dones[i]]
+    finally:
+        venv.close()
+
+    return history
+
+
+@pytest.mark.parametrize("change_reward", [False, True])
+def test_vec_env_matches_sequential_envs(config_path, change_reward):
+    config = config_path('PublicPST.yaml')
+    n_ports = EV2Gym(config_file=config).number_of_ports
+    actions = np.random.default_rng(0).uniform(0, 1, (STEPS, N_ENVS, n_ports))
+
+    expected = run_sequential(config, actions, change_reward)
+    history = run_vectorized(config, actions, change_reward)
+
+    np.testing.assert_allclose(history['observations'], expected['observations'])
+    np.testing.assert_allclose(history['rewards'], expected['rewards'], rtol=1e-6)
+    np.testing.assert_array_equal(history['dones'], expected['dones'])
+
+    assert len(history['terminal_observations']) == N_ENVS
+    for (step, i, observation), (expected_step, expected_i, expected_observation) in \
+            zip(history['terminal_observations'], expected['terminal_observations']):
+        assert (step, i) == (expected_step, expected_i)
+        np.testing.assert_allclose(observation, expected_observation)
@@ -3,6 +3,7 @@
 from stable_baselines3 import PPO, A2C, DDPG, SAC, TD3
 from stable_baselines3.common.callbacks import BaseCallback
 from stable_baselines3.common.callbacks import EvalCallback
+from stable_baselines3.common.vec_env import VecMonitor
 from sb3_contrib import TQC, TRPO, ARS, RecurrentPPO
 
 from ev2gym.models.ev2gym_env import EV2Gym
@@ -10,6 +11,7 @@ from ev2gym.rl_agent.reward import SquaredTrackingErrorReward, ProfitMax_TrPenal
 from ev2gym.rl_agent.reward import profit_maximization
 
 from ev2gym.rl_agent.state import V2G_profit_max, PublicPST, V2G_profit_max_loads
+from ev2gym.rl_agent.vec_env import make_ev2gym_vec_env
 
 import gymnasium as gym
 import argparse
@@ -28,6 +30,11 @@ if __name__ == "__main__":
     parser.add_argument('--config_file', type=str,
                         # default="ev2gym/example_config_files/V2GProfitMax.yaml")
     default="ev2gym/example_config_files/V2GProfitPlusLoads.yaml")
+    parser.add_argument('--n_envs', type=int, default=1,
+                        help="Num. of training environments, more than 1 uses a SharedMemoryVecEnv")
+    parser.add_argument('--n_workers', type=int, default=None,
+                        help="Num. of worker processes of the SharedMemoryVecEnv (default: one per CPU)")
+    parser.add_argument('--seed', type=int, default=None)
 
     algorithm = parser.parse_args().algorithm
     device = parser.parse_args().device
@@ -70,6 +77,19 @@ if __name__ == "__main__":
 
     env = gym.make('evs-v0')
 
+    if parser.parse_args().n_envs > 1:
+        # the training environments step in parallel, the evaluation uses env
+        train_env = VecMonitor(make_ev2gym_vec_env(config_file,
+                                                   n_envs=parser.parse_args().n_envs,
+                                                   n_workers=parser.parse_args().n_workers,
+                                                   seed=parser.parse_args().seed,
+                                                   verbose=False,
+                                                   save_plots=False,
+                                                   reward_function=reward_function,
+                                                   state_function=state_function))
+    else:
+        train_env = env
+
     eval_log_dir = "./eval_logs/" + group_name + "_" + run_name + "/"
     save_path = f"./saved_models/{group_name}/{run_name}/"
     
@@ -82,12 +102,14 @@ if __name__ == "__main__":
     eval_callback = EvalCallback(env,
                                  best_model_save_path=save_path,
                                  log_path=eval_log_dir,
-                                 eval_freq=config['simulation_length']*30,
+                                 # eval_freq counts the steps of every training environment
+                                 eval_freq=max(config['simulation_length']*30 //
+                                               parser.parse_args().n_envs, 1),
                                  n_eval_episodes=50,
                                  deterministic=True)
 
     if algorithm == "ddpg":
-        model = DDPG("MlpPolicy", env, verbose=1,
+        model = DDPG("MlpPolicy", train_env, verbose=1,
                     learning_rate = 1e-3,
                     buffer_size = 1_000_000,  # 1e6
                     learning_starts = 100,
@@ -96,28 +118,28 @@ if __name__ == "__main__":
                     gamma = 0.99,                     
                      device=device, tensorboard_log="./logs/")
     elif algorithm == "td3":
-        model = TD3("MlpPolicy", env, verbose=1,
+        model = TD3("MlpPolicy", train_env, verbose=1,
                     device=device, tensorboard_log="./logs/")
     elif algorithm == "sac":
-        model = SAC("MlpPolicy", env, verbose=1,
+        model = SAC("MlpPolicy", train_env, verbose=1,
                     device=device, tensorboard_log="./logs/")
     elif algorithm == "a2c":
-        model = A2C("MlpPolicy", env, verbose=1,
+        model = A2C("MlpPolicy", train_env, verbose=1,
                     device=device, tensorboard_log="./logs/")
     elif algorithm == "ppo":
-        model = PPO("MlpPolicy", env, verbose=1,
+        model = PPO("MlpPolicy", train_env, verbose=1,
                     device=device, tensorboard_log="./logs/")
     elif algorithm == "tqc":
-        model = TQC("MlpPolicy", env, verbose=1,
+        model = TQC("MlpPolicy", train_env, verbose=1,
                     device=device, tensorboard_log="./logs/")
     elif algorithm == "trpo":
-        model = TRPO("MlpPolicy", env, verbose=1,
+        model = TRPO("MlpPolicy", train_env, verbose=1,
                      device=device, tensorboard_log="./logs/")
     elif algorithm == "ars":
-        model = ARS("MlpPolicy", env, verbose=1,
+        model = ARS("MlpPolicy", train_env, verbose=1,
                     device=device, tensorboard_log="./logs/")
     elif algorithm == "rppo":
-        model = RecurrentPPO("MlpLstmPolicy", env, verbose=1,
+        model = RecurrentPPO("MlpLstmPolicy", train_env, verbose=1,
                              device=device, tensorboard_log="./logs/")
     else:
         raise ValueError("Unknown algorithm")